@@ -1,29 +1,456 @@
-from flask import Flask, request, render_template_string, redirect, url_for, send_from_directory, jsonify, flash
+from flask import Flask, request, render_template, redirect, url_for, send_file, jsonify, flash, Response, stream_with_context, abort
+from markupsafe import Markup
+from werkzeug.datastructures import ContentRange
+from werkzeug.exceptions import RequestedRangeNotSatisfiable
+from werkzeug.http import is_resource_modified, parse_range_header
+from werkzeug.security import safe_join
 import os
+import errno
+import http.cookiejar
 import requests
 import psutil
 import shutil
 from werkzeug.utils import secure_filename
-from datetime import datetime
+from datetime import datetime, timezone
 import threading
 import urllib.parse
 import re
 import hashlib
+import heapq
+import itertools
+import json
 import humanize
 import platform
 import time
+import uuid
+import zlib
+import struct
+import tarfile
+import random
+import atexit
+import collections
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import urllib3
+import metrics
+from state import ACTIVE_STATUSES, MAX_DELETION_VERSIONS, SQLiteJobQueue, create_state_store
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+try:
+    import boto3
+    import botocore.config
+except ImportError:
+    boto3 = None
 
 app = Flask(__name__)
 app.secret_key = os.environ.get("SECRET_KEY", "supersecretkey")  # Use env var for security
+app.config['USE_X_SENDFILE'] = os.environ.get("USE_X_SENDFILE", "").lower() in ("1", "true", "yes")  # Let nginx/Apache send file bodies
 
 UPLOAD_FOLDER = "temp_downloads"
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+RESUME_FOLDER = os.environ.get("RESUME_FOLDER", "resume_state")
+os.makedirs(RESUME_FOLDER, exist_ok=True)
+HASH_INDEX_FILE = os.environ.get("HASH_INDEX_FILE", "hash_index.json")  # only read to import an index from before the state store
+HASH_READ_SIZE = 1024 * 1024
+
+class DownloadStatusTable(dict):
+    def __init__(self):
+        super().__init__()
+        self.condition = threading.Condition()
+        self.version = 0
+        self.versions = {}
+        self.removed = {}
+        self.pruned_version = 0
+        self.store = None
+        self.shared = False
+        self.new_epoch()
+
+    def new_epoch(self):
+        # Local versions only count this process's changes, the epoch tells a client its cursor came from another process
+        self.epoch = self.store.store_id if self.shared else uuid.uuid4().hex[:12]
+
+    def share(self):
+        # Several processes serve the same downloads, cursors follow the store's change batches so any of them can continue one
+        self.shared = True
+        self.new_epoch()
+
+    def current_version(self):
+        return self.store.latest_version() if self.shared else self.version
+
+    def cursor(self, version=None):
+        return f"{self.epoch}.{self.current_version() if version is None else version}"
+
+    def parse_cursor(self, cursor):
+        epoch, _, version = (cursor or '').partition('.')
+        if epoch != self.epoch or not version.isdigit():
+            return None
+        return int(version)
+
+    def attach(self, store, limit):
+        # Only active and recent entries are kept in memory, older history is looked up on demand
+        self.store = store
+        with self.condition:
+            for key, value in store.load_downloads(limit).items():
+                super().__setitem__(key, value)
+                self._bump(key)
+
+    def _fetch(self, key):
+        if self.store is None:
+            return None
+        value = self.store.get_download(key)
+        if value is not None:
+            with self.condition:
+                value = super().setdefault(key, value)
+        return value
+
+    def __contains__(self, key):
+        return super().__contains__(key) or self._fetch(key) is not None
+
+    def __getitem__(self, key):
+        try:
+            return super().__getitem__(key)
+        except KeyError:
+            value = self._fetch(key)
+            if value is None:
+                raise
+            return value
+
+    def get(self, key, default=None):
+        value = super().get(key)
+        if value is None:
+            value = self._fetch(key)
+        return default if value is None else value
+
+    # Store writes are queued under the lock, so the store gets them in the order the table did
+    def __setitem__(self, key, value):
+        with self.condition:
+            super().__setitem__(key, value)
+            self._bump(key)
+            self.removed.pop(key, None)
+            if self.store is not None:
+                self.store.save_download(key, value)
 
-downloads_status = {}
-file_mappings = {}
+    def __delitem__(self, key):
+        with self.condition:
+            if not super().__contains__(key):
+                self._fetch(key)
+            super().__delitem__(key)
+            self._remove(key)
+            if self.store is not None:
+                self.store.delete_download(key)
+
+    def pop(self, key, *default):
+        with self.condition:
+            if key not in self:
+                return super().pop(key, *default)
+            value = super().pop(key)
+            self._remove(key)
+            if self.store is not None:
+                self.store.delete_download(key)
+        return value
+
+    def touch(self, key):
+        # Something rendered with the record changed, viewers fetch the entry again
+        with self.condition:
+            if super().__contains__(key):
+                self._bump(key)
+
+    def _bump(self, key):
+        self.version += 1
+        self.versions[key] = self.version
+        self.condition.notify_all()
+
+    def _remove(self, key):
+        self.versions.pop(key, None)
+        self.version += 1
+        self.removed[key] = self.version
+        if len(self.removed) > MAX_STATUS_TOMBSTONES:
+            oldest = min(self.removed, key=self.removed.get)
+            self.pruned_version = self.removed.pop(oldest)
+        self.condition.notify_all()
+
+    def apply_remote(self, records, deleted):
+        # Changes made by other processes, already in the store so they are not written back
+        with self.condition:
+            for key, value in records.items():
+                if super().get(key) != value:
+                    super().__setitem__(key, value)
+                    self._bump(key)
+                    self.removed.pop(key, None)
+            for key in deleted:
+                if super().__contains__(key):
+                    super().__delitem__(key)
+                    self._remove(key)
+
+    def reload(self, key):
+        # The store's copy as is, for a record another process may have replaced since the last sync
+        value = self.store.get_download(key) if self.store is not None else None
+        if value is not None:
+            self.apply_remote({key: value}, [])
+        return value
+
+    def lookup(self, key):
+        # Like get, without pulling old history into memory
+        value = super().get(key)
+        if value is None and self.store is not None:
+            value = self.store.get_download(key)
+        return value
+
+    def snapshot(self):
+        with self.condition:
+            return dict(self)
+
+    def find_url(self, url):
+        # Entries for url held in memory, then any older ones only the store knows about
+        with self.condition:
+            keys = [key for key, value in super().items() if value.get('url') == url]
+        if self.store is not None:
+            keys += [key for key in self.store.find_downloads(url) if key not in keys]
+        return keys
+
+    def changes_since(self, version):
+        if self.shared:
+            return self._shared_changes_since(version)
+        with self.condition:
+            if version is None or version < self.pruned_version or version > self.version:
+                return self.version, dict(self), [], True
+            changed = {key: self[key] for key, changed_at in self.versions.items() if changed_at > version}
+            removed = [key for key, removed_at in self.removed.items() if removed_at > version]
+            return self.version, changed, removed, False
+
+    def _shared_changes_since(self, version):
+        latest = self.store.latest_version()
+        if version is None or version > latest or version < latest - MAX_DELETION_VERSIONS:
+            return latest, self.snapshot(), [], True
+        latest, changed, removed = self.store.changes_since(version)
+        # This process's own writes, not yet in a batch, come along now and once more when they are
+        for key, value in self.store.unflushed_downloads().items():
+            if value is None:
+                removed.append(key)
+            else:
+                changed[key] = value
+        return latest, changed, removed, False
+
+    def wait_for_change(self, version, timeout):
+        if self.shared:
+            return self._wait_for_shared_change(version, timeout)
+        with self.condition:
+            return self.condition.wait_for(lambda: version is None or self.version > version, timeout)
+
+    def _wait_for_shared_change(self, version, timeout):
+        # Local writes wake waiters at once, other processes' batches are noticed within STATE_SYNC_INTERVAL
+        local = self.version
+        deadline = time.monotonic() + timeout
+        while True:
+            if version is None or self.store.latest_version() > version:
+                return True
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            with self.condition:
+                if self.condition.wait_for(lambda: self.version != local, min(remaining, STATE_SYNC_INTERVAL)):
+                    return True
+
+downloads_status = DownloadStatusTable()
+# A forked worker starts from a copy of the parent's table and diverges from it
+os.register_at_fork(after_in_child=downloads_status.new_epoch)
+class FileMappingTable(dict):
+    def __init__(self):
+        super().__init__()
+        self.reverse = {}
+        self.store = None
+
+    def attach(self, store, filenames):
+        self.store = store
+        for key, value in store.load_mappings(filenames).items():
+            self._cache(key, value)
+
+    def _cache(self, key, value):
+        old = super().get(key)
+        if old is not None and self.reverse.get(old) == key:
+            del self.reverse[old]
+        super().__setitem__(key, value)
+        self.reverse[value] = key
+
+    def _fetch(self, key):
+        if self.store is None:
+            return None
+        value = self.store.get_mapping(key)
+        if value is not None:
+            self._cache(key, value)
+        return value
+
+    def __contains__(self, key):
+        return super().__contains__(key) or self._fetch(key) is not None
+
+    def __getitem__(self, key):
+        try:
+            return super().__getitem__(key)
+        except KeyError:
+            value = self._fetch(key)
+            if value is None:
+                raise
+            return value
+
+    def get(self, key, default=None):
+        value = super().get(key)
+        if value is None:
+            value = self._fetch(key)
+        return default if value is None else value
+
+    def __setitem__(self, key, value):
+        self._cache(key, value)
+        if self.store is not None:
+            self.store.save_mapping(key, value)
+
+    def __delitem__(self, key):
+        if not super().__contains__(key):
+            self._fetch(key)
+        value = super().pop(key)
+        if self.reverse.get(value) == key:
+            del self.reverse[value]
+        if self.store is not None:
+            self.store.delete_mapping(key)
+
+    def pop(self, key, *default):
+        if key not in self:
+            return super().pop(key, *default)
+        value = self[key]
+        del self[key]
+        return value
+
+    def lookup(self, key):
+        # Like get, without caching what only the store knows
+        value = super().get(key)
+        if value is None and self.store is not None:
+            value = self.store.get_mapping(key)
+        return value
+
+    def resolve(self, custom_url):
+        key = self.reverse.get(custom_url)
+        if key is None and self.store is not None:
+            key = self.store.find_mapping(custom_url)
+            if key is not None:
+                self._cache(key, custom_url)
+        return key
+
+file_mappings = FileMappingTable()
 active_downloads = {}
+system_snapshot = {}
+# The totals themselves are in the state store, where worker processes' changes land too
+folder_stats = {'started': False}
+folder_stats_lock = threading.Lock()
 
-def get_system_info():
+SEGMENT_COUNT = int(os.environ.get("SEGMENT_COUNT", 4))
+MIN_SEGMENT_SIZE = int(os.environ.get("MIN_SEGMENT_SIZE", 4 * 1024 * 1024))
+RESUME_CHECKPOINT_INTERVAL = float(os.environ.get("RESUME_CHECKPOINT_INTERVAL", 2))
+MAX_CONCURRENT_DOWNLOADS = int(os.environ.get("MAX_CONCURRENT_DOWNLOADS", 4))
+MAX_DOWNLOADS_PER_HOST = int(os.environ.get("MAX_DOWNLOADS_PER_HOST", 2))
+SYSTEM_SAMPLE_INTERVAL = float(os.environ.get("SYSTEM_SAMPLE_INTERVAL", 2))
+FOLDER_RESCAN_INTERVAL = float(os.environ.get("FOLDER_RESCAN_INTERVAL", 300))
+PROGRESS_PUBLISH_INTERVAL = float(os.environ.get("PROGRESS_PUBLISH_INTERVAL", 0.5))
+SPEED_SMOOTHING = 0.3
+MIN_CHUNK_SIZE = 8 * 1024
+MAX_CHUNK_SIZE = 4 * 1024 * 1024
+CHUNK_ADAPT_INTERVAL = 0.25
+CHUNK_TARGET_SECONDS = 0.05
+EVENTS_MIN_INTERVAL = float(os.environ.get("EVENTS_MIN_INTERVAL", 0.5))
+EVENTS_POLL_TIMEOUT = float(os.environ.get("EVENTS_POLL_TIMEOUT", 25))
+EVENTS_MAX_WAITING = int(os.environ.get("EVENTS_MAX_WAITING", 32))  # streams and long polls per process, each holds a server thread
+EVENTS_STREAM_SECONDS = float(os.environ.get("EVENTS_STREAM_SECONDS", 300))  # after which the browser reconnects with Last-Event-ID
+MAX_STATUS_TOMBSTONES = 1000
+MAX_BYTE_RANGES = 16
+MAX_BUNDLE_FILES = int(os.environ.get("MAX_BUNDLE_FILES", 256))  # each one holds a file descriptor while the bundle streams
+ZIP64_LIMIT = 0xFFFFFFFF
+STATE_BACKEND = os.environ.get("STATE_BACKEND", "sqlite")
+STATE_DB = os.environ.get("STATE_DB", "state.db")
+STATE_FLUSH_INTERVAL = float(os.environ.get("STATE_FLUSH_INTERVAL", 1))
+STATE_RECENT_LIMIT = int(os.environ.get("STATE_RECENT_LIMIT", 1000))
+STATE_SYNC_INTERVAL = float(os.environ.get("STATE_SYNC_INTERVAL", 1))
+DOWNLOAD_MODE = os.environ.get("DOWNLOAD_MODE", "inline")
+JOB_LEASE_SECONDS = float(os.environ.get("JOB_LEASE_SECONDS", 60))
+JOB_HEARTBEAT_INTERVAL = float(os.environ.get("JOB_HEARTBEAT_INTERVAL", 15))
+JOB_POLL_INTERVAL = float(os.environ.get("JOB_POLL_INTERVAL", 1))
+DOWNLOAD_RATE_LIMIT = int(os.environ.get("DOWNLOAD_RATE_LIMIT", 0))  # bytes per second, 0 means unlimited
+HOST_RATE_LIMIT = int(os.environ.get("HOST_RATE_LIMIT", 0))
+HOST_RATE_LIMITS = {
+    host.strip(): int(rate)
+    for host, rate in (item.split('=', 1) for item in os.environ.get("HOST_RATE_LIMITS", "").split(',') if '=' in item)
+}
+SERVE_RATE_LIMIT = int(os.environ.get("SERVE_RATE_LIMIT", 0))
+RATE_BURST_SECONDS = 0.25
+DISK_FREE_MARGIN = int(os.environ.get("DISK_FREE_MARGIN", 256 * 1024 * 1024))
+DISK_RETRY_INTERVAL = float(os.environ.get("DISK_RETRY_INTERVAL", 30))
+REQUEUE_RECHECK_INTERVAL = float(os.environ.get("REQUEUE_RECHECK_INTERVAL", 0.5))
+CONNECT_TIMEOUT = float(os.environ.get("CONNECT_TIMEOUT", 10))
+READ_TIMEOUT = float(os.environ.get("READ_TIMEOUT", 30))  # longest a connection may go without receiving a byte
+MIN_THROUGHPUT = int(os.environ.get("MIN_THROUGHPUT", 0))  # bytes per second below which a connection is restarted, 0 disables
+THROUGHPUT_WINDOW = float(os.environ.get("THROUGHPUT_WINDOW", 30))
+RETRY_ATTEMPTS = int(os.environ.get("RETRY_ATTEMPTS", 5))
+RETRY_BACKOFF = float(os.environ.get("RETRY_BACKOFF", 1))
+RETRY_BACKOFF_MAX = float(os.environ.get("RETRY_BACKOFF_MAX", 60))
+RETRY_STATUSES = (408, 429, 500, 502, 503, 504)
+MIRROR_SPEED_SMOOTHING = 0.5
+MAX_MIRRORS = 8
+MAX_MIRROR_STATS = 1000
+EVICTION_TTL = float(os.environ.get("EVICTION_TTL", 0))  # seconds since a file was last served, 0 disables
+EVICTION_MAX_FOLDER_SIZE = int(os.environ.get("EVICTION_MAX_FOLDER_SIZE", 0))
+EVICT_FOR_SPACE = os.environ.get("EVICT_FOR_SPACE", "").lower() in ("1", "true", "yes")
+EVICTION_INTERVAL = float(os.environ.get("EVICTION_INTERVAL", 60))
+EVICTION_BATCH = int(os.environ.get("EVICTION_BATCH", 100))
+MAX_BATCH_SIZE = int(os.environ.get("MAX_BATCH_SIZE", 1000))
+API_PAGE_SIZE = 100
+API_MAX_PAGE_SIZE = 1000
+TAIL_POLL_INTERVAL = 0.05
+HTTP_POOL_HOSTS = int(os.environ.get("HTTP_POOL_HOSTS", 32))
+HTTP_POOL_PER_HOST = int(os.environ.get("HTTP_POOL_PER_HOST", MAX_DOWNLOADS_PER_HOST * SEGMENT_COUNT))
+DOWNLOAD_ENGINE = os.environ.get("DOWNLOAD_ENGINE", "threads")
+DISK_WRITE_THREADS = int(os.environ.get("DISK_WRITE_THREADS", 4))
+WRITE_BUFFER_SIZE = int(os.environ.get("WRITE_BUFFER_SIZE", 16 * 1024 * 1024))  # received bytes a download may hold before its readers wait for the disk
+WRITE_BATCH_SIZE = int(os.environ.get("WRITE_BATCH_SIZE", 1024 * 1024))
+WRITE_LINGER = float(os.environ.get("WRITE_LINGER", 0.05))  # longest received data waits for more to join its batch
+WRITE_LATENCY_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1)
+S3_BUCKET = os.environ.get("S3_BUCKET", "")  # empty keeps completed files on local disk only
+S3_ENDPOINT_URL = os.environ.get("S3_ENDPOINT_URL") or None  # for MinIO and other S3-compatible stores
+S3_REGION = os.environ.get("S3_REGION") or None
+S3_PREFIX = os.environ.get("S3_PREFIX", "")
+S3_PART_SIZE = max(int(os.environ.get("S3_PART_SIZE", 16 * 1024 * 1024)), 5 * 1024 * 1024)
+S3_UPLOAD_THREADS = int(os.environ.get("S3_UPLOAD_THREADS", 4))
+S3_PRESIGN_EXPIRES = int(os.environ.get("S3_PRESIGN_EXPIRES", 3600))
+S3_REDIRECT = os.environ.get("S3_REDIRECT", "true").lower() in ("1", "true", "yes")
+S3_MAX_PARTS = 10000
+S3_POLL_INTERVAL = 0.2
+PLATFORM = platform.platform()
+PYTHON_VERSION = platform.python_version()
+
+state_store = create_state_store(STATE_BACKEND, STATE_DB, STATE_FLUSH_INTERVAL)
+state_version = state_store.latest_version()
+downloads_status.attach(state_store, STATE_RECENT_LIMIT)
+file_mappings.attach(state_store, list(downloads_status))
+atexit.register(state_store.flush)
+
+# Counters and histograms are per process, a worker.py process exposes its own on WORKER_METRICS_PORT
+bytes_downloaded = metrics.Counter('downloader_bytes_downloaded_total', 'Bytes received from origin servers')
+bytes_served = metrics.Counter('downloader_bytes_served_total', 'Bytes of stored files sent to clients')
+download_outcomes = metrics.Counter('downloader_jobs_total', 'Download attempts by outcome', ('outcome',))
+connection_retries = metrics.Counter('downloader_connection_retries_total', 'Segment connections reopened after a transient error or a stall')
+transfer_seconds = metrics.Histogram('downloader_transfer_seconds', 'Time from response headers to the last byte of a download')
+ttfb_seconds = metrics.Histogram('downloader_ttfb_seconds', 'Time from sending a download request to its response headers')
+connect_seconds = metrics.Histogram('downloader_connect_seconds', 'Time to open a new origin connection, DNS and TLS included')
+chunk_write_seconds = metrics.Histogram('downloader_chunk_write_seconds', 'Time for one write to a download file', WRITE_LATENCY_BUCKETS)
+status_render_seconds = metrics.Histogram('downloader_status_render_seconds', 'Time to build a /status response')
+metrics.Gauge('downloader_active_downloads', 'Downloads transferring in this process', lambda: len(active_downloads))
+metrics.Gauge('downloader_queued_downloads', 'Downloads waiting for a slot', lambda: scheduler.stats()['queued'])
+metrics.Gauge('downloader_folder_bytes', 'Bytes stored in the download folder', lambda: get_folder_size())
+
+# Phase durations of the request the current thread is making, filled in by TimedConnectionMixin
+request_timeline = threading.local()
+
+def sample_system_info():
     disk = psutil.disk_usage('/')
     memory = psutil.virtual_memory()
     
@@ -36,17 +463,64 @@ def get_system_info():
         'memory_used': format_size(memory.used),
         'memory_free': format_size(memory.free),
         'memory_percent': memory.percent,
-        'cpu_percent': psutil.cpu_percent(interval=1),
-        'platform': platform.platform(),
-        'python_version': platform.python_version(),
-        'upload_folder_size': format_size(get_directory_size(UPLOAD_FOLDER)),
-        'upload_file_count': len(os.listdir(UPLOAD_FOLDER))
+        'cpu_percent': psutil.cpu_percent(interval=None),
+        'platform': PLATFORM,
+        'python_version': PYTHON_VERSION,
+        'sampled_at': time.time()
     }
 
+def system_sampler():
+    last_rescan = time.time()
+    while True:
+        time.sleep(SYSTEM_SAMPLE_INTERVAL)
+        try:
+            system_snapshot.update(sample_system_info())
+            # Periodically re-walk the folder to correct any drift in the incremental counters
+            if time.time() - last_rescan >= FOLDER_RESCAN_INTERVAL:
+                rescan_folder_stats()
+                last_rescan = time.time()
+        except Exception:
+            pass
+
+def start_system_sampler():
+    with folder_stats_lock:
+        if folder_stats['started']:
+            return
+        folder_stats['started'] = True
+    psutil.cpu_percent(interval=None)
+    rescan_folder_stats()
+    system_snapshot.update(sample_system_info())
+    threading.Thread(target=system_sampler, daemon=True).start()
+
+def rescan_folder_stats():
+    size = get_directory_size(UPLOAD_FOLDER)
+    count = sum(1 for name in os.listdir(UPLOAD_FOLDER) if not is_part_file(name))
+    state_store.set_folder_totals(size, count)
+
+def adjust_folder_stats(size_delta, count_delta):
+    state_store.adjust_folder_totals(size_delta, count_delta)
+
+def get_folder_size():
+    if not folder_stats['started']:
+        start_system_sampler()
+    return state_store.get_folder_totals()[0]
+
+def get_system_info():
+    if not folder_stats['started']:
+        start_system_sampler()
+    info = dict(system_snapshot)
+    size, count = state_store.get_folder_totals()
+    info['upload_folder_size'] = format_size(size)
+    info['upload_file_count'] = count
+    return info
+
 def get_directory_size(path):
     total = 0
     for dirpath, dirnames, filenames in os.walk(path):
         for f in filenames:
+            if is_part_file(f):
+                # Still downloading, counted by disk admission instead
+                continue
             fp = os.path.join(dirpath, f)
             total += os.path.getsize(fp)
     return total
@@ -57,30 +531,211 @@ def format_size(size):
 def format_time(seconds):
     return humanize.naturaltime(seconds)
 
+class FileHash:
+    # MD5 identifies files for deduplication and ETags, CRC-32 lets bundles write ZIP headers up front
+    def __init__(self):
+        self.md5 = hashlib.md5()
+        self.crc32 = 0
+
+    def update(self, data):
+        self.md5.update(data)
+        self.crc32 = zlib.crc32(data, self.crc32)
+
+    def hexdigest(self):
+        return self.md5.hexdigest()
+
 def get_file_hash(filepath):
     hash_md5 = hashlib.md5()
     with open(filepath, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
+        for chunk in iter(lambda: f.read(HASH_READ_SIZE), b""):
             hash_md5.update(chunk)
     return hash_md5.hexdigest()
 
-def check_duplicate_file(filepath):
-    if not os.path.exists(filepath):
+def import_hash_index():
+    # The index used to be a JSON file per process, entries still matching their files carry over
+    try:
+        with open(HASH_INDEX_FILE) as f:
+            entries = json.load(f)
+    except (OSError, ValueError):
+        return
+    state_store.save_file_hashes({
+        filename: entry for filename, entry in entries.items() if is_index_entry_current(filename, entry)
+    }, replace=False)
+
+def is_index_entry_current(filename, entry):
+    try:
+        stat = os.stat(os.path.join(UPLOAD_FOLDER, filename))
+    except OSError:
         return False
-    new_hash = get_file_hash(filepath)
+    return stat.st_size == entry['size'] and stat.st_mtime == entry['mtime']
+
+def get_hash_entry(filename, file_hash, crc32=None):
+    stat = os.stat(os.path.join(UPLOAD_FOLDER, filename))
+    return {'hash': file_hash, 'size': stat.st_size, 'mtime': stat.st_mtime, 'crc32': crc32}
+
+def index_file_hash(filename, file_hash, crc32=None):
+    state_store.save_file_hashes({filename: get_hash_entry(filename, file_hash, crc32)})
+
+def remove_file_hash(filename):
+    state_store.delete_file_hash(filename)
+
+def rename_file_hash(old_filename, new_filename):
+    state_store.rename_file_hash(old_filename, new_filename)
+
+def index_unknown_files(size, exclude):
+    # Files that predate the index are hashed lazily, and only when their size could match
+    found = {}
     for filename in os.listdir(UPLOAD_FOLDER):
-        if filename != os.path.basename(filepath):
-            existing_file = os.path.join(UPLOAD_FOLDER, filename)
-            if os.path.exists(existing_file):
-                if get_file_hash(existing_file) == new_hash:
-                    return True
+        if filename == exclude or filename in active_downloads or is_part_file(filename):
+            continue
+        filepath = os.path.join(UPLOAD_FOLDER, filename)
+        if not os.path.isfile(filepath) or os.path.getsize(filepath) != size:
+            continue
+        entry = state_store.get_file_hash(filename)
+        if entry is None or not is_index_entry_current(filename, entry):
+            found[filename] = get_hash_entry(filename, get_file_hash(filepath))
+    if found:
+        state_store.save_file_hashes(found)
+
+def check_duplicate_file(filepath, file_hash, filename=None):
+    if not os.path.exists(filepath):
+        return False
+    filename = filename or os.path.basename(filepath)
+    size = os.path.getsize(filepath)
+    index_unknown_files(size, filename)
+    for existing, entry in state_store.find_file_hashes(file_hash):
+        if existing == filename:
+            continue
+        if is_index_entry_current(existing, entry):
+            return True
+        existing_file = os.path.join(UPLOAD_FOLDER, existing)
+        if not os.path.exists(existing_file):
+            remove_file_hash(existing)
+            continue
+        existing_hash = get_file_hash(existing_file)
+        index_file_hash(existing, existing_hash)
+        if existing_hash == file_hash:
+            return True
     return False
 
-def calculate_download_speed(start_time, downloaded):
-    elapsed_time = time.time() - start_time
-    if elapsed_time > 0:
-        return downloaded / elapsed_time
-    return 0
+class DiskSpaceUnavailable(Exception):
+    def __init__(self, message, retry):
+        super().__init__(message)
+        self.retry = retry
+
+disk_reservations = {}
+disk_lock = threading.Lock()
+
+def get_unwritten_bytes(filepath, size):
+    try:
+        stat = os.stat(filepath)
+    except FileNotFoundError:
+        return size
+    # Segmented downloads write sparse files, only count the blocks actually allocated
+    allocated = stat.st_blocks * 512 if hasattr(stat, 'st_blocks') else stat.st_size
+    return max(size - allocated, 0)
+
+def reserve_disk_space(save_filename, filepath, size):
+    with disk_lock:
+        outstanding = sum(
+            get_unwritten_bytes(path, total)
+            for name, (path, total) in disk_reservations.items() if name != save_filename
+        )
+        available = psutil.disk_usage(UPLOAD_FOLDER).free - DISK_FREE_MARGIN - outstanding
+        shortfall = get_unwritten_bytes(filepath, size) - available
+        if shortfall <= 0:
+            disk_reservations[save_filename] = (filepath, size)
+        return max(shortfall, 0)
+
+def release_disk_space(save_filename):
+    with disk_lock:
+        disk_reservations.pop(save_filename, None)
+
+def admit_download(save_filename, filepath, size):
+    if not size:
+        return
+    shortfall = reserve_disk_space(save_filename, filepath, size)
+    if shortfall and EVICT_FOR_SPACE:
+        run_eviction(shortfall)
+        shortfall = reserve_disk_space(save_filename, filepath, size)
+    if not shortfall:
+        return
+    needed = get_unwritten_bytes(filepath, size)
+    free = max(psutil.disk_usage(UPLOAD_FOLDER).free - DISK_FREE_MARGIN, 0)
+    if needed <= free:
+        # Only other downloads' reservations are in the way, waiting for them can help
+        raise DiskSpaceUnavailable(f"Waiting for {format_size(needed)} of disk space held by other downloads", True)
+    raise DiskSpaceUnavailable(f"Not enough disk space: needs {format_size(needed)}, {format_size(free)} free", False)
+
+def is_eviction_protected(filename):
+    if filename in active_downloads or filename in disk_reservations or os.path.exists(get_resume_path(filename)):
+        return True
+    # Looked up without caching, one pass over the folder must not pull the whole history into memory
+    info = downloads_status.lookup(filename)
+    if info and (info.get('pinned') or info.get('status') != 'completed'):
+        return True
+    return file_mappings.lookup(filename) is not None
+
+def run_eviction(bytes_needed=0, limit=None):
+    # Least recently served first, send_upload keeps each file's atime current
+    now = time.time()
+    candidates = []
+    folder_size = 0
+    with os.scandir(UPLOAD_FOLDER) as entries:
+        for entry in entries:
+            if not entry.is_file():
+                continue
+            stat = entry.stat()
+            folder_size += stat.st_size
+            if not is_part_file(entry.name) and not is_eviction_protected(entry.name):
+                candidates.append((stat.st_atime, entry.name, stat.st_size))
+    candidates.sort()
+
+    freed = 0
+    for evicted, (last_served, filename, size) in enumerate(candidates):
+        expired = EVICTION_TTL and now - last_served > EVICTION_TTL
+        oversized = EVICTION_MAX_FOLDER_SIZE and folder_size - freed > EVICTION_MAX_FOLDER_SIZE
+        if not (expired or oversized or freed < bytes_needed) or evicted == limit:
+            break
+        try:
+            remove_download(filename)
+        except OSError:
+            continue
+        freed += size
+    return freed
+
+def evictor():
+    while True:
+        time.sleep(EVICTION_INTERVAL)
+        try:
+            run_eviction(limit=EVICTION_BATCH)
+        except Exception:
+            pass
+
+def start_evictor():
+    if EVICTION_TTL or EVICTION_MAX_FOLDER_SIZE:
+        threading.Thread(target=evictor, daemon=True).start()
+
+def remove_download(filename):
+    filepath = os.path.join(UPLOAD_FOLDER, filename)
+    if os.path.exists(filepath):
+        size = os.path.getsize(filepath)
+        os.remove(filepath)
+        adjust_folder_stats(-size, -1)
+    if os.path.exists(get_part_path(filepath)):
+        os.remove(get_part_path(filepath))
+    stored = (downloads_status.get(filename) or {}).get('s3')
+    if object_store and stored and stored.get('state') == 'completed':
+        try:
+            object_store.delete(stored['key'])
+        except Exception:
+            pass
+    if filename in downloads_status:
+        del downloads_status[filename]
+    if filename in file_mappings:
+        del file_mappings[filename]
+    remove_resume_record(filename)
+    remove_file_hash(filename)
 
 def estimate_time_remaining(total_size, downloaded, speed):
     if speed > 0:
@@ -88,13 +743,16 @@ def estimate_time_remaining(total_size, downloaded, speed):
         return remaining_bytes / speed
     return 0
 
-def get_filename_from_url(url, response):
+def get_response_filename(response):
+    cd = response.headers.get('Content-Disposition', '')
+    if 'filename=' in cd:
+        return urllib.parse.unquote(re.findall('filename="?([^"]+)"?', cd)[0])
+    return None
+
+def get_filename_from_url(url, response=None):
     try:
-        if 'Content-Disposition' in response.headers:
-            cd = response.headers['Content-Disposition']
-            if 'filename=' in cd:
-                filename = re.findall('filename="?([^"]+)"?', cd)[0]
-                return urllib.parse.unquote(filename)
+        if response is not None and get_response_filename(response):
+            return get_response_filename(response)
         
         path = urllib.parse.unquote(urllib.parse.urlparse(url).path)
         if path and '/' in path:
@@ -108,467 +766,2413 @@ def get_filename_from_url(url, response):
         pass
     return None
 
+class RangeNotSupported(Exception):
+    pass
+
+class TransferInterrupted(IOError):
+    pass
+
+class SlowTransfer(TransferInterrupted):
+    pass
+
+class MirrorMismatch(TransferInterrupted):
+    pass
+
+def is_retryable(error):
+    if isinstance(error, requests.HTTPError):
+        return error.response is not None and error.response.status_code in RETRY_STATUSES
+    if aiohttp is not None and isinstance(error, aiohttp.ClientResponseError):
+        return error.status in RETRY_STATUSES
+    retryable = (TransferInterrupted, requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError,
+                 urllib3.exceptions.HTTPError, ConnectionError, TimeoutError, asyncio.TimeoutError)
+    if aiohttp is not None:
+        retryable += (aiohttp.ClientError,)
+    return isinstance(error, retryable)
+
+def get_backoff(attempt):
+    return min(RETRY_BACKOFF * 2 ** max(attempt - 1, 0), RETRY_BACKOFF_MAX)
+
+def get_retry_delay(attempt, error=None):
+    # Full jitter, downloads that failed together do not all come back together
+    delay = random.uniform(0, get_backoff(attempt))
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None) or getattr(error, 'headers', None) or {}
+    retry_after = headers.get('Retry-After', '')
+    if retry_after.isdigit():
+        delay = max(delay, min(int(retry_after), RETRY_BACKOFF_MAX))
+    return delay
+
+mirror_stats = {}
+mirror_stats_lock = threading.Lock()
+
+def record_mirror(url, received=0, seconds=0, failed=False):
+    # Shared by every download, a copy that is slow or down for one of them is for all of them
+    with mirror_stats_lock:
+        stats = mirror_stats.setdefault(url, {'speed': None, 'failures': 0, 'retry_at': 0})
+        if received and seconds > 0:
+            speed = received / seconds
+            if stats['speed'] is not None:
+                speed = MIRROR_SPEED_SMOOTHING * speed + (1 - MIRROR_SPEED_SMOOTHING) * stats['speed']
+            stats['speed'] = speed
+        if failed:
+            stats['failures'] += 1
+            stats['retry_at'] = time.monotonic() + get_backoff(stats['failures'])
+        elif received:
+            stats['failures'] = 0
+            stats['retry_at'] = 0
+        stats['updated'] = time.monotonic()
+        if len(mirror_stats) > MAX_MIRROR_STATS:
+            del mirror_stats[min(mirror_stats, key=lambda key: mirror_stats[key]['updated'])]
+
+def pick_mirror(urls):
+    # Healthy copies first, any not measured yet get a turn before the fastest measured one
+    now = time.monotonic()
+    with mirror_stats_lock:
+        stats = [mirror_stats.get(url, {'speed': None, 'retry_at': 0}) for url in urls]
+
+    def rank(i):
+        cooling = stats[i]['retry_at'] > now
+        return cooling, stats[i]['retry_at'] if cooling else 0, stats[i]['speed'] is not None, -(stats[i]['speed'] or 0), i
+
+    return urls[min(range(len(urls)), key=rank)]
+
+def get_source(url, settings):
+    # The first attempt asks the origin, retries go to the best copy known
+    if not settings['attempt'] or not settings['mirrors']:
+        return url
+    return pick_mirror([url] + settings['mirrors'])
+
+class ThroughputWatchdog:
+    # Only time spent waiting on the socket counts, not rate limiting or a slow disk
+    def __init__(self):
+        self.window_start = time.monotonic()
+        self.received = 0
+        self.waited = 0.0
+
+    def update(self, received, waited):
+        if not MIN_THROUGHPUT:
+            return
+        self.received += received
+        self.waited += waited
+        now = time.monotonic()
+        if now - self.window_start < THROUGHPUT_WINDOW:
+            return
+        if self.waited > 0 and self.received / self.waited < MIN_THROUGHPUT:
+            raise SlowTransfer(f"Slower than {format_size(MIN_THROUGHPUT)}/s for {THROUGHPUT_WINDOW:g}s")
+        self.window_start = now
+        self.received = 0
+        self.waited = 0.0
+
+class Segment:
+    def __init__(self, start, end, pos=None):
+        self.start = start
+        self.end = end
+        self.pos = start if pos is None else pos
+        self.committed = self.pos
+
+    @property
+    def remaining(self):
+        return max(self.end - self.pos, 0)
+
+class SequentialHasher:
+    def __init__(self, fd):
+        self.fd = fd
+        self.file_hash = FileHash()
+        self.pos = 0
+        self.lock = threading.Lock()
+
+    def advance(self, limit, blocking=False):
+        # Hash the contiguous prefix behind the writers while it is still in the page cache
+        if not self.lock.acquire(blocking=blocking):
+            return
+        try:
+            while self.pos < limit:
+                data = os.pread(self.fd, min(HASH_READ_SIZE, limit - self.pos), self.pos)
+                if not data:
+                    break
+                self.file_hash.update(data)
+                self.pos += len(data)
+        finally:
+            self.lock.release()
+
+class DiskWriter:
+    # Readers hand received data to one writer thread per file, so a stalled disk only holds them back
+    # once WRITE_BUFFER_SIZE is queued. Adjacent chunks are merged and written in block-aligned batches.
+    def __init__(self, fd, on_write=None, file_hash=None):
+        self.fd = fd
+        self.on_write = on_write
+        # Only for a single stream, whose batches are written in file order
+        self.file_hash = file_hash
+        self.block_size = max(os.fstat(fd).st_blksize, 512)
+        self.condition = threading.Condition()
+        self.items = collections.deque()
+        self.queued = 0
+        self.closed = False
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def write(self, offset, data, stream=None):
+        with self.condition:
+            while self.queued >= WRITE_BUFFER_SIZE and self.error is None:
+                self.condition.wait()
+            self.put(offset, data, stream)
+
+    def put(self, offset, data, stream):
+        if self.error is not None:
+            raise self.error
+        self.items.append((offset, data, stream))
+        self.queued += len(data)
+        self.condition.notify_all()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def run(self):
+        runs = {}  # end offset -> [start, buffer, stream, when its oldest byte arrived]
+        try:
+            while True:
+                with self.condition:
+                    if not self.items and not self.closed:
+                        timeout = None
+                        if runs:
+                            timeout = min(run[3] for run in runs.values()) + WRITE_LINGER - time.monotonic()
+                        if timeout is None or timeout > 0:
+                            self.condition.wait(timeout)
+                    items, self.items = self.items, collections.deque()
+                    closing = self.closed
+                now = time.monotonic()
+                for offset, data, stream in items:
+                    run = runs.pop(offset, None) or [offset, bytearray(), stream, now]
+                    run[1] += data
+                    runs[run[0] + len(run[1])] = run
+                for end, run in list(runs.items()):
+                    start, buffer, stream, since = run
+                    if closing or now - since >= WRITE_LINGER:
+                        # Lingered long enough, write it all so readers tailing the file are not kept behind
+                        cut = end
+                    elif len(buffer) >= WRITE_BATCH_SIZE:
+                        cut = end - end % self.block_size
+                    else:
+                        continue
+                    if cut <= start:
+                        continue
+                    self.flush(start, memoryview(buffer)[:cut - start], stream)
+                    del runs[end]
+                    if cut < end:
+                        runs[end] = [cut, buffer[cut - start:], stream, now]
+                if closing and not runs:
+                    return
+        except Exception as e:
+            with self.condition:
+                self.error = e
+                self.condition.notify_all()
+
+    def flush(self, offset, data, stream):
+        write_at(self.fd, offset, data)
+        if self.file_hash is not None:
+            self.file_hash.update(data)
+        with self.condition:
+            self.queued -= len(data)
+            self.condition.notify_all()
+        if self.on_write is not None:
+            self.on_write(stream, offset + len(data))
+
+def write_at(fd, offset, data):
+    started = time.perf_counter()
+    written = 0
+    while written < len(data):
+        written += os.pwrite(fd, data[written:], offset + written)
+    chunk_write_seconds.observe(time.perf_counter() - started)
+
+def preallocate(fd, size):
+    # Allocated up front the file is not fragmented, and a full disk fails the download before the transfer
+    if not size:
+        return
+    try:
+        os.posix_fallocate(fd, 0, size)
+    except AttributeError:
+        os.ftruncate(fd, size)
+    except OSError as e:
+        if e.errno == errno.ENOSPC:
+            raise
+        os.ftruncate(fd, size)
+
+def get_part_path(filepath):
+    # Hidden and suffixed, secure_filename never produces a name starting with a dot
+    directory, name = os.path.split(filepath)
+    return os.path.join(directory, f".{name}.part")
+
+def is_part_file(filename):
+    return filename.startswith('.') and filename.endswith('.part')
+
+def get_contiguous_end(segments):
+    end = 0
+    for segment in sorted(segments, key=lambda s: s.start):
+        if segment.start > end:
+            break
+        if segment.committed < segment.end:
+            return max(end, segment.committed)
+        end = segment.end
+    return end
+
+def get_resume_path(save_filename):
+    return os.path.join(RESUME_FOLDER, save_filename + '.json')
+
+def load_resume_record(save_filename):
+    try:
+        with open(get_resume_path(save_filename)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def save_resume_record(save_filename, record):
+    path = get_resume_path(save_filename)
+    tmp_path = f"{path}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(record, f)
+    os.replace(tmp_path, path)
+
+def remove_resume_record(save_filename):
+    try:
+        os.remove(get_resume_path(save_filename))
+    except FileNotFoundError:
+        pass
+
+def get_validator(record):
+    # Weak ETags are not allowed in If-Range, fall back to Last-Modified
+    etag = record.get('etag')
+    if etag and not etag.startswith('W/'):
+        return etag
+    return record.get('last_modified')
+
+def matches_record(record, response, total_size, source=None):
+    if record.get('total_size') != total_size:
+        return False
+    if source is not None and source != record.get('source', record['url']):
+        # Validators from one copy say nothing about another, mirrors are only compared by size
+        return True
+    if record.get('etag'):
+        return record['etag'] == response.headers.get('ETag')
+    return bool(record.get('last_modified')) and record['last_modified'] == response.headers.get('Last-Modified')
+
+def get_resume_headers(record, source):
+    headers = {'Range': f"bytes={record['downloaded']}-"}
+    # If-Range only means something to the copy the validator came from
+    if record.get('source', record['url']) == source:
+        headers['If-Range'] = get_validator(record)
+    return headers
+
+def get_resumed_size(response, record):
+    total_size = get_content_range_total(response) or record['total_size']
+    if total_size != record['total_size']:
+        raise MirrorMismatch(f"{response.url} does not serve a file of {record['total_size']} bytes")
+    return total_size
+
+def get_content_range_total(response):
+    content_range = response.headers.get('Content-Range', '')
+    if '/' in content_range:
+        total = content_range.rsplit('/', 1)[1]
+        if total.isdigit():
+            return int(total)
+    return 0
+
+def supports_ranges(response, total_size):
+    if SEGMENT_COUNT < 2 or total_size < MIN_SEGMENT_SIZE * 2:
+        return False
+    if response.headers.get('Content-Encoding', 'identity') != 'identity':
+        return False
+    return response.headers.get('Accept-Ranges', '').lower() == 'bytes'
+
+def split_segments(total_size):
+    count = max(1, min(SEGMENT_COUNT, total_size // MIN_SEGMENT_SIZE))
+    segment_size = total_size // count
+    segments = []
+    for i in range(count):
+        start = i * segment_size
+        end = total_size if i == count - 1 else start + segment_size
+        segments.append(Segment(start, end))
+    return segments
+
+def download_segmented(url, filepath, total_size, on_progress, segments=None, validator=None, buckets=(), mirrors=()):
+    lock = threading.Lock()
+    sources = [url] + list(mirrors)
+    resuming = segments is not None
+    if not resuming:
+        segments = split_segments(total_size)
+    pending = [s for s in segments if s.remaining]
+    errors = []
+    progress = {'downloaded': sum(s.pos - s.start for s in segments)}
+
+    def next_segment():
+        with lock:
+            if pending:
+                return pending.pop(0)
+            # Re-split the slowest segment so an idle connection can take its tail
+            victim = max(segments, key=lambda s: s.remaining)
+            if victim.remaining < MIN_SEGMENT_SIZE * 2:
+                return None
+            middle = victim.pos + victim.remaining // 2
+            segment = Segment(middle, victim.end)
+            victim.end = middle
+            segments.append(segment)
+            return segment
+
+    def fetch(writer, segment, source):
+        headers = {'Range': f'bytes={segment.pos}-{segment.end - 1}', 'Accept-Encoding': 'identity'}
+        # The validator came from url, a mirror's copy is checked by its size instead
+        if validator and source == url:
+            headers['If-Range'] = validator
+        started = time.monotonic()
+        received = 0
+        try:
+            with http_session.get(source, headers=headers, stream=True, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT)) as response:
+                response.raise_for_status()
+                if response.status_code != 206:
+                    raise RangeNotSupported(f"Expected 206 for range request, got {response.status_code}")
+                if get_content_range_total(response) not in (0, total_size):
+                    raise MirrorMismatch(f"{source} does not serve a file of {total_size} bytes")
+                for data in iter_chunks(response, buckets):
+                    if errors:
+                        return
+                    with lock:
+                        offset = segment.pos
+                        length = min(len(data), segment.end - offset)
+                        if length <= 0:
+                            break
+                        segment.pos += length
+                        progress['downloaded'] += length
+                        downloaded = progress['downloaded']
+                    received += length
+                    writer.write(offset, data[:length], segment)
+                    if segment.start <= hasher.pos <= segment.committed:
+                        with lock:
+                            contiguous_end = get_contiguous_end(segments)
+                        hasher.advance(contiguous_end)
+                    on_progress(downloaded, segments)
+        finally:
+            if mirrors:
+                record_mirror(source, received, time.monotonic() - started)
+        if segment.remaining:
+            raise TransferInterrupted(f"Segment {segment.start}-{segment.end} ended early at {segment.pos}")
+
+    def fetch_segment(writer, segment, source):
+        failures = 0
+        while True:
+            pos = segment.pos
+            try:
+                fetch(writer, segment, source)
+                return
+            except Exception as e:
+                # A mirror that cannot serve the range is skipped, the origin failing that way is for the caller
+                if errors or (source == url and not is_retryable(e)):
+                    raise
+                failures = 1 if segment.pos > pos else failures + 1
+                if failures > RETRY_ATTEMPTS:
+                    raise
+                connection_retries.inc()
+            if mirrors:
+                record_mirror(source, failed=True)
+                source = pick_mirror(sources)
+            time.sleep(get_retry_delay(failures))
+
+    def worker(writer, index):
+        # Connections start spread over the copies, later segments go to the fastest healthy one
+        source = sources[index % len(sources)]
+        try:
+            while not errors:
+                segment = next_segment()
+                if segment is None:
+                    return
+                fetch_segment(writer, segment, source)
+                source = pick_mirror(sources)
+        except Exception as e:
+            errors.append(e)
+
+    def on_write(segment, end):
+        segment.committed = end
+
+    flags = os.O_RDWR | os.O_CREAT | (0 if resuming else os.O_TRUNC)
+    fd = os.open(filepath, flags, 0o644)
+    hasher = SequentialHasher(fd)
+    try:
+        preallocate(fd, total_size)
+        writer = DiskWriter(fd, on_write)
+        try:
+            workers = [threading.Thread(target=worker, args=(writer, i), daemon=True) for i in range(max(len(pending), 1))]
+            for thread in workers:
+                thread.start()
+            for thread in workers:
+                thread.join()
+        finally:
+            # Everything received reaches the disk, a failed download resumes from it
+            writer.close()
+        if errors:
+            raise errors[0]
+        on_progress(progress['downloaded'], segments)
+        hasher.advance(total_size, blocking=True)
+    finally:
+        os.close(fd)
+    return hasher.file_hash
+
+def hash_prefix(file, file_hash, offset):
+    while file.tell() < offset:
+        chunk = file.read(min(HASH_READ_SIZE, offset - file.tell()))
+        if not chunk:
+            break
+        file_hash.update(chunk)
+    file.seek(offset)
+    file.truncate()
+
+def download_single(response, filepath, on_progress, offset=0, buckets=(), total_size=0):
+    downloaded = offset
+    written = {'end': offset}
+    file_hash = FileHash()
+    with open(filepath, 'r+b' if offset else 'wb') as file:
+        if offset:
+            hash_prefix(file, file_hash, offset)
+        fd = file.fileno()
+        preallocate(fd, total_size)
+        writer = DiskWriter(fd, lambda stream, end: written.update(end=end), file_hash)
+        try:
+            for data in iter_chunks(response, buckets):
+                writer.write(downloaded, data)
+                downloaded += len(data)
+                on_progress(downloaded, None, written['end'])
+        finally:
+            writer.close()
+        # Preallocation guessed from Content-Length, the file ends where the data did
+        os.ftruncate(fd, downloaded)
+        on_progress(downloaded, None, downloaded)
+    return file_hash
+
+class DownloadProgress:
+    __slots__ = ('save_filename', 'url', 'original_name', 'total_size', 'start_time', 'resumed', 'downloaded',
+                 'written', 'segments', 'speed', 'sample_time', 'sample_bytes', 'published_at', 'timeline')
+
+    def __init__(self, save_filename, url, original_name, total_size, start_time, resumed=0, timeline=None):
+        self.save_filename = save_filename
+        self.url = url
+        self.original_name = original_name
+        self.total_size = total_size
+        self.start_time = start_time
+        self.resumed = resumed
+        self.downloaded = resumed
+        self.written = resumed
+        self.segments = None
+        self.speed = 0.0
+        self.sample_time = time.monotonic()
+        self.sample_bytes = resumed
+        self.published_at = 0.0
+        self.timeline = timeline or {}
+
+    def update(self, downloaded, segments=None, written=None):
+        self.downloaded = downloaded
+        if written is not None:
+            self.written = written
+        self.segments = segments
+        now = time.monotonic()
+        if now - self.published_at >= PROGRESS_PUBLISH_INTERVAL:
+            self.published_at = now
+            self.sample(now)
+            downloads_status[self.save_filename] = self.to_record()
+
+    def sample(self, now):
+        elapsed = now - self.sample_time
+        if elapsed <= 0:
+            return
+        rate = (self.downloaded - self.sample_bytes) / elapsed
+        if self.speed:
+            rate = SPEED_SMOOTHING * rate + (1 - SPEED_SMOOTHING) * self.speed
+        self.speed = rate
+        self.sample_time = now
+        self.sample_bytes = self.downloaded
+
+    def available_bytes(self):
+        # Readers may only follow the contiguous prefix, segments land out of order
+        if self.segments:
+            return get_contiguous_end(self.segments)
+        return self.written
+
+    def written_ranges(self):
+        if self.segments:
+            return [(s.start, s.committed) for s in self.segments]
+        return [(0, self.written)]
+
+    def to_record(self):
+        total_size = self.total_size
+        record = {
+            'status': 'downloading',
+            'progress': int((self.downloaded / total_size) * 100) if total_size else 0,
+            'size': total_size,
+            'downloaded': self.downloaded,
+            'original_name': self.original_name,
+            'url': self.url,
+            'speed_bps': self.speed,
+            'eta_seconds': estimate_time_remaining(total_size, self.downloaded, self.speed) if total_size else 0,
+            'available': self.available_bytes(),
+            'start_time': self.start_time,
+            'timeline': format_timeline(self.timeline)
+        }
+        if self.resumed:
+            record['resumed_from'] = self.resumed
+        upload = object_store.get(self.save_filename) if object_store else None
+        if upload is not None:
+            record['s3'] = upload.to_record()
+        if self.segments:
+            record['segments'] = [
+                {
+                    'start': s.start,
+                    'end': s.end,
+                    'progress': int(((s.pos - s.start) / (s.end - s.start)) * 100) if s.end > s.start else 100
+                }
+                for s in sorted(self.segments, key=lambda s: s.start)
+            ]
+        return record
+
+def add_phase(timeline, phase, seconds):
+    if timeline is not None:
+        timeline[phase] = timeline.get(phase, 0) + seconds
+
+def start_timeline(settings, start_time):
+    timeline = {}
+    if settings['queued_at']:
+        timeline['queued'] = max(start_time - settings['queued_at'], 0)
+    return timeline
+
+def record_response_headers(timeline, requested):
+    now = time.perf_counter()
+    ttfb_seconds.observe(now - requested)
+    # Whatever part of the wait was not spent opening a connection was the server thinking
+    timeline['wait'] = max(now - requested - timeline.get('dns', 0) - timeline.get('connect', 0), 0)
+    return now
+
+def format_timeline(timeline):
+    return {phase: round(seconds, 4) for phase, seconds in timeline.items()}
+
+def serialize_status(info):
+    data = dict(info)
+    if info.get('status') in ('downloading', 'completed'):
+        data['formatted_size'] = format_size(info.get('size', 0))
+        data['formatted_downloaded'] = format_size(info.get('downloaded', 0))
+    if 'speed_bps' in info:
+        data['speed'] = format_size(info['speed_bps']) + '/s'
+    if 'eta_seconds' in info:
+        data['eta'] = format_time(info['eta_seconds']) if info['eta_seconds'] else 'Calculating...'
+    if 'duration' in info:
+        data['completion_time'] = format_time(info['duration'])
+    return data
+
+class TokenBucket:
+    def __init__(self, rate):
+        self.rate = rate
+        self.capacity = max(rate * RATE_BURST_SECONDS, MIN_CHUNK_SIZE)
+        # Chunks this size from every stream interleave on the bucket, so active transfers share it evenly
+        self.chunk_size = int(max(rate * CHUNK_TARGET_SECONDS, MIN_CHUNK_SIZE))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self, amount):
+        # Tokens may go negative, the caller sleeps off the debt outside the lock
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= amount
+            return -self.tokens / self.rate if self.tokens < 0 else 0
+
+download_bucket = TokenBucket(DOWNLOAD_RATE_LIMIT) if DOWNLOAD_RATE_LIMIT else None
+serve_bucket = TokenBucket(SERVE_RATE_LIMIT) if SERVE_RATE_LIMIT else None
+host_buckets = {}
+host_buckets_lock = threading.Lock()
+
+def get_rate_buckets(url, rate_limit=None):
+    buckets = [download_bucket] if download_bucket else []
+    host = urllib.parse.urlparse(url).hostname or ''
+    host_rate = HOST_RATE_LIMITS.get(host, HOST_RATE_LIMIT)
+    if host_rate:
+        with host_buckets_lock:
+            if host not in host_buckets:
+                host_buckets[host] = TokenBucket(host_rate)
+            buckets.append(host_buckets[host])
+    if rate_limit:
+        buckets.append(TokenBucket(rate_limit))
+    return buckets
+
+def take_tokens(buckets, amount):
+    return max(bucket.reserve(amount) for bucket in buckets)
+
+def throttle_chunks(chunks, buckets):
+    chunk_size = min(bucket.chunk_size for bucket in buckets)
+    try:
+        for data in chunks:
+            for start in range(0, len(data), chunk_size):
+                piece = data[start:start + chunk_size]
+                delay = take_tokens(buckets, len(piece))
+                if delay:
+                    time.sleep(delay)
+                yield piece
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+def iter_chunks(response, buckets=()):
+    # Grow or shrink reads with the link speed so fast transfers are not split into tiny chunks
+    block_size = MIN_CHUNK_SIZE
+    max_block_size = min([MAX_CHUNK_SIZE] + [bucket.chunk_size for bucket in buckets])
+    window_start = time.monotonic()
+    window_bytes = 0
+    watchdog = ThroughputWatchdog()
+    while True:
+        started = time.monotonic()
+        data = response.raw.read(block_size, decode_content=True)
+        if not data:
+            return
+        watchdog.update(len(data), time.monotonic() - started)
+        bytes_downloaded.inc(len(data))
+        if buckets:
+            delay = take_tokens(buckets, len(data))
+            if delay:
+                time.sleep(delay)
+        yield data
+        window_bytes += len(data)
+        now = time.monotonic()
+        if now - window_start >= CHUNK_ADAPT_INTERVAL:
+            target = int(window_bytes / (now - window_start) * CHUNK_TARGET_SECONDS)
+            block_size = min(max(1 << max(target.bit_length() - 1, 0), MIN_CHUNK_SIZE), max_block_size)
+            window_start = now
+            window_bytes = 0
+
+def get_validators(response):
+    return {'etag': response.headers.get('ETag'), 'last_modified': response.headers.get('Last-Modified')}
+
+def get_conditional_headers(info):
+    headers = {}
+    if info.get('etag'):
+        headers['If-None-Match'] = info['etag']
+    if info.get('last_modified'):
+        headers['If-Modified-Since'] = info['last_modified']
+    return headers
+
+def get_cached_download(save_filename, filepath):
+    # A completed download that was submitted again, fetched only if the origin copy changed
+    info = downloads_status.get(save_filename)
+    if info and info.get('status') == 'completed' and info.get('revalidating') and os.path.isfile(filepath):
+        return info
+    return None
+
+def keep_cached_download(save_filename, cached, timeline, validators=None, error=None):
+    record = dict(cached, revalidated_at=time.time(), timeline=format_timeline(timeline))
+    record.pop('revalidating', None)
+    record.pop('revalidation_error', None)
+    record.update({key: value for key, value in (validators or {}).items() if value})
+    if error is not None:
+        record['revalidation_error'] = str(error)
+    downloads_status[save_filename] = record
+    download_outcomes.inc(1, ('failed' if error is not None else 'not_modified',))
+    if object_store:
+        object_store.cancel(save_filename)
+    active_downloads.pop(save_filename, None)
+    release_disk_space(save_filename)
+
+def get_job_settings(save_filename):
+    info = downloads_status.get(save_filename, {})
+    return {
+        'priority': info.get('priority', 0),
+        'rate_limit': info.get('rate_limit'),
+        'queued_at': info.get('queued_at'),
+        'mirrors': info.get('mirrors') or [],
+        'attempt': info.get('attempt', 0)
+    }
+
+def build_resume_record(url, save_filename, original_filename, settings, response, total_size, downloaded, source=None):
+    # Offsets count decoded bytes, a Range on an encoded body would not line up with them, so no validators
+    resumable = response.headers.get('Content-Encoding', 'identity') == 'identity'
+    return {
+        'url': url,
+        'source': source or url,
+        'mirrors': settings['mirrors'],
+        'original_name': original_filename,
+        'custom_url': file_mappings.get(save_filename),
+        'priority': settings['priority'],
+        'rate_limit': settings['rate_limit'],
+        'etag': response.headers.get('ETag') if resumable else None,
+        'last_modified': response.headers.get('Last-Modified') if resumable else None,
+        'total_size': total_size,
+        'downloaded': downloaded,
+        'segments': None
+    }
+
+def finish_download(url, save_filename, original_filename, filepath, file_hash, downloaded, start_time, timeline, validators, crc32=None):
+    finalize_started = time.perf_counter()
+    part_path = get_part_path(filepath)
+    remove_resume_record(save_filename)
+    upload = object_store.take(save_filename) if object_store else None
+    # A completed file fetched again because its origin copy changed keeps its name, even when the new body matches another file
+    info = downloads_status.lookup(save_filename)
+    revalidated = info is not None and info.get('status') == 'completed' and os.path.exists(filepath)
+
+    if not revalidated and check_duplicate_file(part_path, file_hash, save_filename):
+        if upload is not None:
+            upload.cancel()
+        os.remove(part_path)
+        timeline['finalize'] = time.perf_counter() - finalize_started
+        downloads_status[save_filename] = {
+            'status': 'duplicate',
+            'error': 'File already exists',
+            'original_name': original_filename,
+            'url': url,
+            'timeline': format_timeline(timeline)
+        }
+        download_outcomes.inc(1, ('duplicate',))
+    else:
+        new_filename = secure_filename(original_filename)
+        new_path = os.path.join(UPLOAD_FOLDER, new_filename)
+        if not revalidated and new_filename and new_filename != save_filename and new_filename not in downloads_status and not os.path.exists(new_path):
+            # Queued under the URL's name, keep the one the server sent instead
+            active_downloads.pop(save_filename, None)
+            downloads_status.pop(save_filename, None)
+            if save_filename in file_mappings:
+                file_mappings[new_filename] = file_mappings.pop(save_filename)
+            save_filename, filepath = new_filename, new_path
+        if os.path.exists(filepath):
+            # A revalidated file whose origin copy changed, readers see the old or the new one, never a mix
+            adjust_folder_stats(-os.path.getsize(filepath), -1)
+            remove_file_hash(save_filename)
+        os.replace(part_path, filepath)
+        timeline['finalize'] = time.perf_counter() - finalize_started
+        record = {
+            'status': 'completed',
+            'progress': 100,
+            'size': downloaded,
+            'downloaded': downloaded,
+            'original_name': original_filename,
+            'url': url,
+            'duration': time.time() - start_time,
+            'hash': file_hash,
+            'crc32': crc32,
+            'timeline': format_timeline(timeline),
+            **validators
+        }
+        if upload is not None:
+            record['s3'] = upload.to_record()
+        downloads_status[save_filename] = record
+        if upload is not None:
+            # Only once the record is written, so the uploader's final state lands on the completed one
+            upload.finish(save_filename, downloaded)
+        download_outcomes.inc(1, ('completed',))
+        index_file_hash(save_filename, file_hash, crc32)
+        adjust_folder_stats(os.path.getsize(filepath), 1)
+
+    active_downloads.pop(save_filename, None)
+    release_disk_space(save_filename)
+
+def fail_download(url, save_filename, original_filename, settings, error, timeline=None):
+    downloads_status[save_filename] = {
+        'status': 'failed',
+        'error': str(error),
+        'original_name': original_filename,
+        'url': url,
+        'priority': settings['priority'],
+        'rate_limit': settings['rate_limit'],
+        'mirrors': settings['mirrors'],
+        'attempt': settings['attempt'],
+        'resumable': os.path.exists(get_resume_path(save_filename)),
+        'timeline': format_timeline(timeline or {})
+    }
+    download_outcomes.inc(1, ('failed',))
+    if object_store:
+        object_store.cancel(save_filename)
+    active_downloads.pop(save_filename, None)
+    release_disk_space(save_filename)
+
+def defer_download(url, save_filename, original_filename, settings, error, delay=DISK_RETRY_INTERVAL, outcome='deferred'):
+    status = {'progress': 0, 'size': 0, 'downloaded': 0, 'attempt': settings['attempt']}
+    downloads_status[save_filename] = dict(
+        status,
+        status='queued',
+        original_name=original_filename,
+        url=url,
+        priority=settings['priority'],
+        rate_limit=settings['rate_limit'],
+        mirrors=settings['mirrors'],
+        waiting=str(error)
+    )
+    download_outcomes.inc(1, (outcome,))
+    if object_store:
+        object_store.cancel(save_filename)
+    active_downloads.pop(save_filename, None)
+    release_disk_space(save_filename)
+    schedule_requeue(delay, url, save_filename, original_filename, settings, status)
+
+def schedule_requeue(delay, *args):
+    timer = threading.Timer(delay, requeue_download, args)
+    timer.daemon = True
+    timer.start()
+
+def requeue_download(url, save_filename, original_filename, settings, status):
+    # Unless it was retried by hand, finished or removed in the meantime, all of which replace the waiting record
+    info = downloads_status.get(save_filename, {})
+    if info.get('status') != 'queued' or 'waiting' not in info:
+        return
+    if not queue_download(url, save_filename, original_filename, settings['priority'], status, settings['rate_limit'], settings['mirrors']):
+        # The attempt that deferred itself still holds its slot, try again once it has let go
+        schedule_requeue(REQUEUE_RECHECK_INTERVAL, url, save_filename, original_filename, settings, status)
+
+def retry_download_later(url, save_filename, original_filename, settings, error):
+    # Backs off without holding a download slot, the part file and resume record carry over
+    attempt = settings['attempt'] + 1
+    delay = get_retry_delay(attempt, error)
+    message = f"Retry {attempt} of {RETRY_ATTEMPTS} in {delay:.0f}s after: {error}"
+    defer_download(url, save_filename, original_filename, dict(settings, attempt=attempt), message, delay, 'retried')
+
+def handle_download_error(url, save_filename, original_filename, settings, error, timeline, source):
+    # A mirror failing in any way is skipped next time, only the origin's own errors can be final
+    retryable = not isinstance(error, DiskSpaceUnavailable) and (is_retryable(error) or source != url)
+    if retryable and settings['mirrors']:
+        record_mirror(source, failed=True)
+    if isinstance(error, DiskSpaceUnavailable) and error.retry:
+        defer_download(url, save_filename, original_filename, settings, error)
+    elif retryable and settings['attempt'] < RETRY_ATTEMPTS:
+        retry_download_later(url, save_filename, original_filename, settings, error)
+    else:
+        fail_download(url, save_filename, original_filename, settings, error, timeline)
+
 def download_file_async(url, save_filename, original_filename):
+    filepath = os.path.join(UPLOAD_FOLDER, save_filename)
+    part_path = get_part_path(filepath)
+    settings = get_job_settings(save_filename)
+    buckets = get_rate_buckets(url, settings['rate_limit'])
+    cached = get_cached_download(save_filename, filepath)
+    record = load_resume_record(save_filename)
+    if record and (cached or record.get('url') != url or not os.path.exists(part_path)):
+        record = None
+    source = get_source(url, settings)
+    checkpoint_lock = threading.Lock()
+    state = {'downloaded': 0, 'segments': None, 'last_checkpoint': 0}
+    resume = None
+    timeline = {}
+
+    def checkpoint(force=False):
+        if resume is None or not get_validator(resume):
+            return
+        now = time.time()
+        if not force and now - state['last_checkpoint'] < RESUME_CHECKPOINT_INTERVAL:
+            return
+        with checkpoint_lock:
+            state['last_checkpoint'] = now
+            segments = state['segments']
+            if segments:
+                resume['segments'] = [[s.start, s.end, s.committed] for s in segments]
+                resume['downloaded'] = sum(s.committed - s.start for s in segments)
+            else:
+                resume['segments'] = None
+                resume['downloaded'] = state['downloaded']
+            save_resume_record(save_filename, resume)
+
     try:
         start_time = time.time()
-        response = requests.get(url, stream=True, allow_redirects=True)
+        timeline = start_timeline(settings, start_time)
+        # Identity, so resume offsets count the same bytes the origin's ranges do
+        headers = {'Accept-Encoding': 'identity'}
+        if cached:
+            headers.update(get_conditional_headers(cached))
+        elif record and record.get('segments') is None and record.get('downloaded') and get_validator(record):
+            headers.update(get_resume_headers(record, source))
+        request_timeline.current = timeline
+        requested = time.perf_counter()
+        try:
+            response = http_session.get(source, stream=True, allow_redirects=True, headers=headers, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
+        finally:
+            request_timeline.current = None
+        headers_received = record_response_headers(timeline, requested)
         response.raise_for_status()
-        
+        validators = get_validators(response)
+        if cached:
+            if response.status_code == 304:
+                response.close()
+                keep_cached_download(save_filename, cached, timeline, validators)
+                return
+        original_filename = get_response_filename(response) or original_filename
+
+        resumed = 0
+        if response.status_code == 206 and 'Range' in headers:
+            resumed = record['downloaded']
+            total_size = get_resumed_size(response, record)
+        else:
+            total_size = int(response.headers.get('content-length', 0))
+            if record and (record.get('segments') is None or not matches_record(record, response, total_size, source)):
+                record = None
+
+        resume = build_resume_record(url, save_filename, original_filename, settings, response, total_size, resumed, source)
+        admit_download(save_filename, part_path, total_size)
+        segments = None
+        if record and record.get('segments'):
+            segments = [Segment(start, end, pos) for start, end, pos in record['segments']]
+            resumed = sum(s.pos - s.start for s in segments)
+        state['downloaded'] = resumed
+        state['segments'] = segments
+
+        progress = DownloadProgress(save_filename, url, original_filename, total_size, start_time, resumed, timeline)
+        active_downloads[save_filename] = progress
+        if object_store:
+            object_store.start(save_filename, part_path, total_size)
+
+        def on_progress(downloaded, segments, written=None):
+            # Resume records only cover what is on disk, not what is still queued for the writer
+            state['downloaded'] = written
+            state['segments'] = segments
+            progress.update(downloaded, segments, written)
+            checkpoint()
+
+        mirrors = [mirror for mirror in [url] + settings['mirrors'] if mirror != source]
+        if segments:
+            response.close()
+            validator = get_validator(record) if record.get('source', url) == source else None
+            try:
+                file_hash = download_segmented(response.url, part_path, total_size, on_progress, segments, validator, buckets, mirrors)
+            except RangeNotSupported:
+                progress = DownloadProgress(save_filename, url, original_filename, total_size, start_time, timeline=timeline)
+                active_downloads[save_filename] = progress
+                state['segments'] = None
+                response = http_session.get(source, stream=True, allow_redirects=True, headers={'Accept-Encoding': 'identity'}, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
+                response.raise_for_status()
+                file_hash = download_single(response, part_path, on_progress, buckets=buckets, total_size=total_size)
+        elif not resumed and supports_ranges(response, total_size):
+            response.close()
+            try:
+                file_hash = download_segmented(response.url, part_path, total_size, on_progress, buckets=buckets, mirrors=mirrors)
+            except RangeNotSupported:
+                state['segments'] = None
+                response = http_session.get(source, stream=True, allow_redirects=True, headers={'Accept-Encoding': 'identity'}, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
+                response.raise_for_status()
+                file_hash = download_single(response, part_path, on_progress, buckets=buckets, total_size=total_size)
+        else:
+            file_hash = download_single(response, part_path, on_progress, resumed, buckets, total_size)
+
+        timeline['transfer'] = time.perf_counter() - headers_received
+        transfer_seconds.observe(timeline['transfer'])
+        finish_download(url, save_filename, original_filename, filepath, file_hash.hexdigest(), progress.downloaded, start_time, timeline, validators, file_hash.crc32)
+
+    except Exception as e:
+        if cached:
+            # The stored copy is only replaced by the rename of a complete new one
+            keep_cached_download(save_filename, cached, timeline, error=e)
+            return
+        checkpoint(force=True)
+        handle_download_error(url, save_filename, original_filename, settings, e, timeline, source)
+
+class AsyncDownloadEngine:
+    # One event loop multiplexes every transfer, blocking file I/O goes to a small thread pool
+    def __init__(self, disk_threads):
+        self.disk_threads = disk_threads
+        self.loop = None
+        self.disk = None
+        self.session = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.loop is not None:
+                return
+            raise_open_file_limit()
+            self.disk = ThreadPoolExecutor(self.disk_threads, thread_name_prefix='disk-writer')
+            self.loop = asyncio.new_event_loop()
+            threading.Thread(target=self.loop.run_forever, daemon=True).start()
+
+    def submit(self, url, save_filename, original_filename):
+        self.start()
+        return asyncio.run_coroutine_threadsafe(self.download(url, save_filename, original_filename), self.loop)
+
+    def run(self, url, save_filename, original_filename):
+        return self.submit(url, save_filename, original_filename).result()
+
+    def io(self, func, *args):
+        return self.loop.run_in_executor(self.disk, func, *args)
+
+    def get_session(self):
+        if self.session is None:
+            # The scheduler enforces concurrency limits, the connector must not add its own
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=0, limit_per_host=0),
+                cookie_jar=aiohttp.DummyCookieJar(),
+                timeout=aiohttp.ClientTimeout(total=None, sock_connect=CONNECT_TIMEOUT, sock_read=READ_TIMEOUT),
+                trace_configs=[create_trace_config()]
+            )
+        return self.session
+
+    async def download(self, url, save_filename, original_filename):
         filepath = os.path.join(UPLOAD_FOLDER, save_filename)
-        total_size = int(response.headers.get('content-length', 0))
-        block_size = 8192
+        part_path = get_part_path(filepath)
+        settings = get_job_settings(save_filename)
+        buckets = get_rate_buckets(url, settings['rate_limit'])
+        cached = get_cached_download(save_filename, filepath)
+        record = await self.io(load_resume_record, save_filename)
+        # Segmented records can only be continued by the threaded engine
+        if record and (cached or record.get('url') != url or record.get('segments') or not os.path.exists(part_path)):
+            record = None
+        source = get_source(url, settings)
+        resume = None
+        file = None
         downloaded = 0
+        # Received data is coalesced here while the previous batch is on a disk thread, at most one per download
+        buffer = bytearray()
+        pending = None
+        timeline = {}
 
-        active_downloads[save_filename] = {
-            'start_time': start_time,
-            'total_size': total_size
+        async def drain():
+            nonlocal buffer, pending
+            if pending is not None:
+                batch, pending = pending, None
+                await batch
+            if buffer:
+                batch, buffer = buffer, bytearray()
+                await self.io(write_batch, file.fileno(), downloaded - len(batch), batch, file_hash, progress)
+
+        try:
+            start_time = time.time()
+            timeline = start_timeline(settings, start_time)
+            headers = {'Accept-Encoding': 'identity'}
+            if cached:
+                headers.update(get_conditional_headers(cached))
+            elif record and record.get('downloaded') and get_validator(record):
+                headers.update(get_resume_headers(record, source))
+            requested = time.perf_counter()
+            async with self.get_session().get(source, headers=headers, trace_request_ctx=timeline) as response:
+                headers_received = record_response_headers(timeline, requested)
+                response.raise_for_status()
+                validators = get_validators(response)
+                if cached:
+                    if response.status == 304:
+                        keep_cached_download(save_filename, cached, timeline, validators)
+                        return
+                original_filename = get_response_filename(response) or original_filename
+                resumed = 0
+                if response.status == 206 and 'Range' in headers:
+                    resumed = record['downloaded']
+                    total_size = get_resumed_size(response, record)
+                else:
+                    total_size = int(response.headers.get('content-length', 0))
+
+                resume = build_resume_record(url, save_filename, original_filename, settings, response, total_size, resumed, source)
+                await self.io(admit_download, save_filename, part_path, total_size)
+                progress = DownloadProgress(save_filename, url, original_filename, total_size, start_time, resumed, timeline)
+                active_downloads[save_filename] = progress
+                if object_store:
+                    object_store.start(save_filename, part_path, total_size)
+                file_hash = FileHash()
+                file = await self.io(open, part_path, 'r+b' if resumed else 'wb')
+                if resumed:
+                    await self.io(hash_prefix, file, file_hash, resumed)
+                await self.io(preallocate, file.fileno(), total_size)
+
+                downloaded = resumed
+                last_checkpoint = time.time()
+                watchdog = ThroughputWatchdog()
+                while True:
+                    started = time.monotonic()
+                    data = await response.content.readany()
+                    if not data:
+                        break
+                    watchdog.update(len(data), time.monotonic() - started)
+                    bytes_downloaded.inc(len(data))
+                    if buckets:
+                        delay = take_tokens(buckets, len(data))
+                        if delay:
+                            await asyncio.sleep(delay)
+                    buffer += data
+                    downloaded += len(data)
+                    progress.update(downloaded)
+                    # Only a full buffer waits for the disk, the loop keeps serving other transfers meanwhile
+                    if pending is not None and (pending.done() or len(buffer) >= WRITE_BUFFER_SIZE):
+                        batch, pending = pending, None
+                        await batch
+                    if pending is None:
+                        pending = self.io(write_batch, file.fileno(), downloaded - len(buffer), buffer, file_hash, progress)
+                        buffer = bytearray()
+                    if get_validator(resume) and time.time() - last_checkpoint >= RESUME_CHECKPOINT_INTERVAL:
+                        last_checkpoint = time.time()
+                        resume['downloaded'] = progress.written
+                        await self.io(save_resume_record, save_filename, resume)
+
+            await drain()
+            await self.io(close_download_file, file, downloaded)
+            file = None
+            timeline['transfer'] = time.perf_counter() - headers_received
+            transfer_seconds.observe(timeline['transfer'])
+            await self.io(finish_download, url, save_filename, original_filename, filepath, file_hash.hexdigest(), downloaded, start_time, timeline, validators, file_hash.crc32)
+
+        except Exception as e:
+            if cached:
+                keep_cached_download(save_filename, cached, timeline, error=e)
+                return
+            if file is not None:
+                try:
+                    await drain()
+                except Exception:
+                    pass
+                try:
+                    await self.io(close_download_file, file)
+                except Exception:
+                    pass
+                if get_validator(resume):
+                    resume['downloaded'] = progress.written
+                    await self.io(save_resume_record, save_filename, resume)
+            handle_download_error(url, save_filename, original_filename, settings, e, timeline, source)
+
+def write_batch(fd, offset, data, file_hash, progress):
+    # Batches of one download are written one at a time and in order, so the hash can follow them
+    write_at(fd, offset, data)
+    file_hash.update(data)
+    progress.written = offset + len(data)
+
+def close_download_file(file, size=None):
+    try:
+        if size is not None:
+            # Preallocation guessed from Content-Length, the file ends where the data did
+            os.ftruncate(file.fileno(), size)
+    finally:
+        file.close()
+
+def raise_open_file_limit():
+    # Every transfer holds a socket and a file, lift the soft limit to the hard one
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft != hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError):
+        pass
+
+def create_trace_config():
+    # A request's trace_request_ctx is its timeline, or None for requests nobody is timing
+    trace_config = aiohttp.TraceConfig()
+
+    async def on_connection_create_start(session, context, params):
+        context.connect_started = time.perf_counter()
+        context.dns = 0
+
+    async def on_dns_resolvehost_start(session, context, params):
+        context.dns_started = time.perf_counter()
+
+    async def on_dns_resolvehost_end(session, context, params):
+        context.dns = time.perf_counter() - context.dns_started
+        add_phase(context.trace_request_ctx, 'dns', context.dns)
+
+    async def on_connection_create_end(session, context, params):
+        elapsed = time.perf_counter() - context.connect_started
+        connect_seconds.observe(elapsed)
+        add_phase(context.trace_request_ctx, 'connect', elapsed - context.dns)
+
+    trace_config.on_connection_create_start.append(on_connection_create_start)
+    trace_config.on_dns_resolvehost_start.append(on_dns_resolvehost_start)
+    trace_config.on_dns_resolvehost_end.append(on_dns_resolvehost_end)
+    trace_config.on_connection_create_end.append(on_connection_create_end)
+    return trace_config
+
+class TimedConnectionMixin:
+    # urllib3 does not report connection setup, time connect() and charge it to the thread's request
+    def connect(self):
+        started = time.perf_counter()
+        super().connect()
+        elapsed = time.perf_counter() - started
+        connect_seconds.observe(elapsed)
+        add_phase(getattr(request_timeline, 'current', None), 'connect', elapsed)
+
+class TimedHTTPConnectionPool(urllib3.HTTPConnectionPool):
+    ConnectionCls = type('TimedHTTPConnection', (TimedConnectionMixin, urllib3.connection.HTTPConnection), {})
+
+class TimedHTTPSConnectionPool(urllib3.HTTPSConnectionPool):
+    ConnectionCls = type('TimedHTTPSConnection', (TimedConnectionMixin, urllib3.connection.HTTPSConnection), {})
+
+class TimedHTTPAdapter(requests.adapters.HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {'http': TimedHTTPConnectionPool, 'https': TimedHTTPSConnectionPool}
+
+def create_http_session():
+    session = requests.Session()
+    # Keep-alive connections are reused across downloads, at most HTTP_POOL_PER_HOST idle per host
+    adapter = TimedHTTPAdapter(pool_connections=HTTP_POOL_HOSTS, pool_maxsize=HTTP_POOL_PER_HOST)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    # Unrelated downloads share the pool, not their cookies
+    session.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+    return session
+
+def create_download_engine():
+    if DOWNLOAD_ENGINE == 'threads':
+        return None
+    if DOWNLOAD_ENGINE == 'asyncio':
+        if aiohttp is None:
+            raise ValueError("DOWNLOAD_ENGINE=asyncio needs the aiohttp package")
+        return AsyncDownloadEngine(DISK_WRITE_THREADS)
+    raise ValueError(f"Unknown download engine: {DOWNLOAD_ENGINE}")
+
+def merge_ranges(ranges):
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        elif start < end:
+            merged.append([start, end])
+    return merged
+
+class MultipartUpload:
+    def __init__(self, store, save_filename, filepath, total_size):
+        self.store = store
+        self.save_filename = save_filename
+        self.key = store.prefix + save_filename
+        self.part_size = max(store.part_size, -(-total_size // S3_MAX_PARTS))
+        self.filepath = filepath
+        self.fd = None
+        self.finished = threading.Event()
+        self.final_name = None
+        self.final_size = 0
+        self.cancelled = False
+        self.uploaded = 0
+        self.parts = []
+        self.error = None
+        self.lock = threading.Lock()
+
+    def finish(self, final_name, size):
+        self.final_name = final_name
+        self.final_size = size
+        self.finished.set()
+
+    def cancel(self):
+        with self.lock:
+            self.cancelled = True
+        self.finished.set()
+
+    def to_record(self):
+        with self.lock:
+            return {'state': 'uploading', 'key': self.key, 'uploaded': self.uploaded, 'parts': len(self.parts)}
+
+    def open_file(self, done):
+        # Opened once the download created the file, the descriptor then follows it through the rename on completion
+        if self.fd is None:
+            try:
+                self.fd = os.open(os.path.join(UPLOAD_FOLDER, self.final_name) if done else self.filepath, os.O_RDONLY)
+            except FileNotFoundError:
+                if done:
+                    raise
+        return self.fd is not None
+
+    def run(self):
+        client = self.store.client
+        upload_id = None
+        futures = []
+        try:
+            upload_id = client.create_multipart_upload(Bucket=self.store.bucket, Key=self.key)['UploadId']
+            submitted = set()
+            while not self.cancelled and self.error is None:
+                done = self.finished.is_set()
+                if done:
+                    size, written = self.final_size, [(0, self.final_size)]
+                else:
+                    progress = active_downloads.get(self.save_filename)
+                    size, written = (progress.total_size, progress.written_ranges()) if progress else (0, [])
+                if written and not self.open_file(done):
+                    written = []
+                # Parts may arrive in any order, each goes out once its whole byte range is on disk
+                for start, end in merge_ranges(written):
+                    for index in range(-(-start // self.part_size), end // self.part_size + 1):
+                        offset = index * self.part_size
+                        length = min(self.part_size, size - offset) if size else self.part_size
+                        if index in submitted or length <= 0 or offset + length > end:
+                            continue
+                        submitted.add(index)
+                        self.store.slots.acquire()
+                        futures.append(self.store.parts.submit(self.upload_part, upload_id, index + 1, offset, length))
+                if done:
+                    break
+                self.finished.wait(S3_POLL_INTERVAL)
+            for future in futures:
+                future.result()
+            if self.error is not None:
+                raise self.error
+            if self.cancelled:
+                client.abort_multipart_upload(Bucket=self.store.bucket, Key=self.key, UploadId=upload_id)
+                return
+            if not self.parts:
+                # A multipart upload needs at least one part, an empty file is a plain put
+                client.abort_multipart_upload(Bucket=self.store.bucket, Key=self.key, UploadId=upload_id)
+                client.put_object(Bucket=self.store.bucket, Key=self.key, Body=b'')
+            else:
+                client.complete_multipart_upload(
+                    Bucket=self.store.bucket, Key=self.key, UploadId=upload_id,
+                    MultipartUpload={'Parts': sorted(self.parts, key=lambda part: part['PartNumber'])}
+                )
+            self.publish({'state': 'completed', 'bucket': self.store.bucket, 'key': self.key, 'size': self.final_size})
+        except Exception as e:
+            if upload_id is not None:
+                try:
+                    client.abort_multipart_upload(Bucket=self.store.bucket, Key=self.key, UploadId=upload_id)
+                except Exception:
+                    pass
+            self.publish({'state': 'failed', 'key': self.key, 'error': str(e)})
+        finally:
+            if self.fd is not None:
+                os.close(self.fd)
+
+    def upload_part(self, upload_id, part_number, offset, length):
+        try:
+            if self.error is None and not self.cancelled:
+                data = os.pread(self.fd, length, offset)
+                if len(data) != length:
+                    raise IOError(f"{self.save_filename} is shorter than expected at {offset + len(data)} bytes")
+                response = self.store.client.upload_part(
+                    Bucket=self.store.bucket, Key=self.key, UploadId=upload_id, PartNumber=part_number, Body=data
+                )
+                with self.lock:
+                    self.parts.append({'ETag': response['ETag'], 'PartNumber': part_number})
+                    self.uploaded += length
+        except Exception as e:
+            self.error = self.error or e
+        finally:
+            self.store.slots.release()
+
+    def publish(self, state):
+        # Under the lock, so a cancel that returned is never followed by a publish
+        with self.lock:
+            if self.cancelled:
+                return
+            filename = self.final_name or self.save_filename
+            info = downloads_status.get(filename)
+            if info and info.get('status') == 'completed':
+                downloads_status[filename] = dict(info, s3=state)
+
+class ObjectStore:
+    # Files are pushed to S3-compatible storage while they download, parts go out as the file fills
+    def __init__(self, bucket, prefix, threads, part_size):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.part_size = part_size
+        self.client = boto3.client('s3', endpoint_url=S3_ENDPOINT_URL, region_name=S3_REGION,
+                                   config=botocore.config.Config(max_pool_connections=threads))
+        self.parts = ThreadPoolExecutor(threads, thread_name_prefix='s3-part')
+        # Bounds the parts waiting on the pool, a fast download must not queue the whole file in memory
+        self.slots = threading.BoundedSemaphore(threads * 2)
+        self.uploads = {}
+        self.lock = threading.Lock()
+
+    def start(self, save_filename, filepath, total_size):
+        upload = MultipartUpload(self, save_filename, filepath, total_size)
+        with self.lock:
+            previous = self.uploads.get(save_filename)
+            self.uploads[save_filename] = upload
+        if previous is not None:
+            previous.cancel()
+        threading.Thread(target=upload.run, daemon=True).start()
+
+    def get(self, save_filename):
+        return self.uploads.get(save_filename)
+
+    def take(self, save_filename):
+        with self.lock:
+            return self.uploads.pop(save_filename, None)
+
+    def cancel(self, save_filename):
+        upload = self.take(save_filename)
+        if upload is not None:
+            upload.cancel()
+
+    def presign(self, key, filename):
+        # The key keeps the name the object was uploaded under, the response is named after the file as it is now
+        params = {'Bucket': self.bucket, 'Key': key, 'ResponseContentDisposition': f"attachment; filename={filename}"}
+        return self.client.generate_presigned_url('get_object', Params=params, ExpiresIn=S3_PRESIGN_EXPIRES)
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=key)
+
+def create_object_store():
+    if not S3_BUCKET:
+        return None
+    if boto3 is None:
+        raise ValueError("S3_BUCKET needs the boto3 package")
+    return ObjectStore(S3_BUCKET, S3_PREFIX, S3_UPLOAD_THREADS, S3_PART_SIZE)
+
+class DownloadScheduler:
+    def __init__(self, workers, per_host, engine=None):
+        self.workers = workers
+        self.per_host = per_host
+        self.engine = engine
+        self.condition = threading.Condition()
+        self.queues = {}
+        self.running = {}
+        self.jobs = {}
+        self.wait_times = {}
+        self.counter = itertools.count()
+        self.threads = []
+
+    def start(self):
+        # With an async engine a single thread only dispatches, the transfers share its event loop
+        threads = 1 if self.engine else self.workers
+        with self.condition:
+            while len(self.threads) < threads:
+                thread = threading.Thread(target=self._run, daemon=True)
+                thread.start()
+                self.threads.append(thread)
+
+    def reserve(self, url, save_filename, original_filename, priority=0):
+        # Claims the name, the job only runs once dispatched
+        with self.condition:
+            if save_filename in self.jobs:
+                return None
+            self.jobs[save_filename] = url
+        return {
+            'url': url,
+            'save_filename': save_filename,
+            'original_filename': original_filename,
+            'host': urllib.parse.urlparse(url).hostname or '',
+            'priority': priority
         }
 
-        with open(filepath, 'wb') as file:
-            for data in response.iter_content(block_size):
-                downloaded += len(data)
-                file.write(data)
-                
-                if total_size:
-                    progress = int((downloaded / total_size) * 100)
-                    speed = calculate_download_speed(start_time, downloaded)
-                    eta = estimate_time_remaining(total_size, downloaded, speed)
-                    
-                    downloads_status[save_filename] = {
-                        'status': 'downloading',
-                        'progress': progress,
-                        'size': total_size,
-                        'downloaded': downloaded,
-                        'original_name': original_filename,
-                        'formatted_size': format_size(total_size),
-                        'formatted_downloaded': format_size(downloaded),
-                        'speed': format_size(speed) + '/s',
-                        'eta': format_time(eta) if eta else 'Calculating...',
-                        'start_time': start_time
-                    }
-
-        if check_duplicate_file(filepath):
-            os.remove(filepath)
-            downloads_status[save_filename] = {
-                'status': 'duplicate',
-                'error': 'File already exists',
-                'original_name': original_filename
+    def dispatch(self, job):
+        with self.condition:
+            job['queued_at'] = time.time()
+            heapq.heappush(self.queues.setdefault(job['host'], []), (-job['priority'], next(self.counter), job))
+            self.condition.notify()
+        self.start()
+
+    def is_scheduled(self, save_filename):
+        return self.get_scheduled_url(save_filename) is not None
+
+    def get_scheduled_url(self, save_filename):
+        with self.condition:
+            return self.jobs.get(save_filename)
+
+    def _take(self):
+        if sum(self.running.values()) >= self.workers:
+            return None
+        best = None
+        for host, queue in self.queues.items():
+            if queue and self.running.get(host, 0) < self.per_host:
+                if best is None or queue[0] < self.queues[best][0]:
+                    best = host
+        if best is None:
+            return None
+        _, _, job = heapq.heappop(self.queues[best])
+        if not self.queues[best]:
+            del self.queues[best]
+        return job
+
+    def _run(self):
+        while True:
+            with self.condition:
+                job = self._take()
+                while job is None:
+                    self.condition.wait()
+                    job = self._take()
+                host = job['host']
+                self.running[host] = self.running.get(host, 0) + 1
+                self.wait_times[host] = time.time() - job['queued_at']
+            mark_starting(job['save_filename'])
+            if self.engine:
+                future = self.engine.submit(job['url'], job['save_filename'], job['original_filename'])
+                future.add_done_callback(lambda _, job=job: self._finish(job))
+                continue
+            try:
+                download_file_async(job['url'], job['save_filename'], job['original_filename'])
+            finally:
+                self._finish(job)
+
+    def _finish(self, job):
+        host = job['host']
+        with self.condition:
+            self.running[host] -= 1
+            if not self.running[host]:
+                del self.running[host]
+            self.jobs.pop(job['save_filename'], None)
+            self.condition.notify_all()
+
+    def stats(self):
+        now = time.time()
+        with self.condition:
+            hosts = {}
+            for host in set(self.queues) | set(self.running) | set(self.wait_times):
+                queue = self.queues.get(host, [])
+                hosts[host] = {
+                    'queued': len(queue),
+                    'running': self.running.get(host, 0),
+                    'oldest_wait': round(now - min(job['queued_at'] for _, _, job in queue), 3) if queue else 0,
+                    'last_wait': round(self.wait_times.get(host, 0), 3)
+                }
+            return {
+                'mode': 'inline',
+                'engine': DOWNLOAD_ENGINE,
+                'workers': self.workers,
+                'per_host_limit': self.per_host,
+                'running': sum(self.running.values()),
+                'queued': sum(len(queue) for queue in self.queues.values()),
+                'hosts': hosts
             }
+
+class QueuedScheduler:
+    def __init__(self, job_queue, per_host):
+        self.job_queue = job_queue
+        self.per_host = per_host
+        self.owner = f"submitter:{uuid.uuid4().hex}"
+
+    def reserve(self, url, save_filename, original_filename, priority=0):
+        # The jobs table is shared, a name another process holds fails here before any record is written
+        host = urllib.parse.urlparse(url).hostname or ''
+        job_id = self.job_queue.enqueue(url, save_filename, original_filename, host, priority, self.owner, JOB_LEASE_SECONDS)
+        return None if job_id is None else {'id': job_id}
+
+    def dispatch(self, job):
+        # The queued record must reach the shared store before a worker can overwrite it
+        state_store.flush()
+        self.job_queue.release(job['id'], self.owner)
+
+    def is_scheduled(self, save_filename):
+        return self.job_queue.is_pending(save_filename)
+
+    def get_scheduled_url(self, save_filename):
+        return self.job_queue.get_url(save_filename)
+
+    def stats(self):
+        return dict(self.job_queue.stats(), mode='queue', per_host_limit=self.per_host)
+
+def create_scheduler():
+    if DOWNLOAD_MODE == 'inline':
+        return DownloadScheduler(MAX_CONCURRENT_DOWNLOADS, MAX_DOWNLOADS_PER_HOST, download_engine)
+    if DOWNLOAD_MODE == 'queue':
+        if STATE_BACKEND != 'sqlite':
+            raise ValueError("DOWNLOAD_MODE=queue needs STATE_BACKEND=sqlite")
+        return QueuedScheduler(SQLiteJobQueue(STATE_DB), MAX_DOWNLOADS_PER_HOST)
+    raise ValueError(f"Unknown download mode: {DOWNLOAD_MODE}")
+
+def sync_state_store(version):
+    while True:
+        time.sleep(STATE_SYNC_INTERVAL)
+        try:
+            version, records, deleted = state_store.changes_since(version)
+            downloads_status.apply_remote(records, deleted)
+        except Exception:
+            pass
+
+download_engine = create_download_engine()
+http_session = create_http_session()
+object_store = create_object_store()
+scheduler = create_scheduler()
+if DOWNLOAD_MODE == 'queue':
+    # Downloads run in worker processes, pull their progress from the shared store
+    downloads_status.share()
+    threading.Thread(target=sync_state_store, args=(state_version,), daemon=True).start()
+import_hash_index()
+
+submit_lock = threading.Lock()
+
+def queue_download(url, save_filename, original_filename, priority=0, status=None, rate_limit=None, mirrors=None, custom_url=None):
+    # The name is claimed first, a submission that loses the race leaves the winner's record alone
+    job = scheduler.reserve(url, save_filename, original_filename, priority)
+    if job is None:
+        return False
+    if custom_url:
+        file_mappings[save_filename] = custom_url
+    downloads_status[save_filename] = dict(status or {
+        'progress': 0,
+        'size': 0,
+        'downloaded': 0
+    }, status='queued', original_name=original_filename, priority=priority, rate_limit=rate_limit, mirrors=list(mirrors or []), url=url, queued_at=time.time())
+    scheduler.dispatch(job)
+    return True
+
+def allocate_filename(url, original_filename, taken=()):
+    # Another URL already owns this name, number the new one instead of overwriting it
+    save_filename = secure_filename(original_filename) or 'download'
+    base, ext = os.path.splitext(save_filename)
+    for n in itertools.count(1):
+        if save_filename not in taken:
+            info = downloads_status.get(save_filename)
+            if info is None and not os.path.exists(os.path.join(UPLOAD_FOLDER, save_filename)):
+                return save_filename
+            if info is not None and info.get('url') == url:
+                return save_filename
+        save_filename = f"{base}_{n}{ext}"
+
+def find_download(url):
+    # What a new submission of url attaches to: a job in flight, else a stored copy to revalidate
+    completed = None
+    for filename in downloads_status.find_url(url):
+        info = downloads_status.lookup(filename)
+        if not info or info.get('url') != url:
+            continue
+        if info.get('status') in ACTIVE_STATUSES or scheduler.is_scheduled(filename):
+            return filename, info
+        if completed is None and info.get('status') == 'completed' and os.path.isfile(os.path.join(UPLOAD_FOLDER, filename)):
+            completed = filename, info
+    return completed
+
+def mark_starting(save_filename):
+    info = downloads_status.get(save_filename)
+    # A file being revalidated stays completed, it is still being served
+    if info is not None and not info.get('revalidating'):
+        downloads_status[save_filename] = dict(info, status='starting')
+
+def revalidate_download(url, save_filename, info, priority=0, rate_limit=None, mirrors=None):
+    # The record stays completed so the file keeps being served while the origin is asked about it
+    job = scheduler.reserve(url, save_filename, info.get('original_name', save_filename), priority)
+    if job is None:
+        return False
+    downloads_status[save_filename] = dict(info, revalidating=True, priority=priority, rate_limit=rate_limit, mirrors=list(mirrors or []), queued_at=time.time())
+    scheduler.dispatch(job)
+    return True
+
+def check_custom_url(save_filename, custom_url):
+    owner = file_mappings.resolve(custom_url) if custom_url else None
+    if owner is not None and owner != save_filename:
+        raise ValueError(f"Custom URL '{custom_url}' is already used by {owner}")
+
+def submit_download(url, custom_url=None, priority=0, rate_limit=None, mirrors=None):
+    if urllib.parse.urlparse(url).scheme not in ('http', 'https'):
+        raise ValueError("Only http and https URLs are supported")
+    mirrors = [mirror for mirror in dict.fromkeys(mirrors or []) if mirror != url]
+    if len(mirrors) > MAX_MIRRORS:
+        raise ValueError(f"At most {MAX_MIRRORS} mirrors per download")
+    if any(urllib.parse.urlparse(mirror).scheme not in ('http', 'https') for mirror in mirrors):
+        raise ValueError("Only http and https mirrors are supported")
+    with submit_lock:
+        existing = find_download(url)
+        if existing:
+            save_filename, info = existing
+            check_custom_url(save_filename, custom_url)
+            if custom_url and file_mappings.get(save_filename) != custom_url:
+                file_mappings[save_filename] = custom_url
+                downloads_status.touch(save_filename)
+            if info.get('status') == 'completed' and not scheduler.is_scheduled(save_filename):
+                return save_filename, revalidate_download(url, save_filename, info, priority, rate_limit, mirrors)
+            return save_filename, False
+
+        # The worker's GET supplies the Content-Disposition name, no HEAD round-trip here
+        original_filename = get_filename_from_url(url) or f"download_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+        taken = set()
+        while True:
+            save_filename = allocate_filename(url, original_filename, taken)
+            check_custom_url(save_filename, custom_url)
+            if queue_download(url, save_filename, original_filename, priority, rate_limit=rate_limit, mirrors=mirrors, custom_url=custom_url):
+                return save_filename, True
+            if scheduler.get_scheduled_url(save_filename) == url:
+                # Another process queued the same URL under this name first
+                return save_filename, False
+            # Another process claimed the name for a different URL
+            taken.add(save_filename)
+
+def resume_pending_downloads():
+    for name in os.listdir(RESUME_FOLDER):
+        if not name.endswith('.json'):
+            continue
+        save_filename = name[:-len('.json')]
+        record = load_resume_record(save_filename)
+        if not record:
+            continue
+        queue_download(record['url'], save_filename, record['original_name'], record.get('priority', 0), {
+            'progress': 0,
+            'size': record.get('total_size', 0),
+            'downloaded': record.get('downloaded', 0)
+        }, record.get('rate_limit'), record.get('mirrors'), record.get('custom_url'))
+
+    # Entries that were queued or running when the process stopped
+    for save_filename in state_store.filenames(ACTIVE_STATUSES):
+        info = downloads_status.get(save_filename)
+        if not info or scheduler.is_scheduled(save_filename):
+            continue
+        filepath = os.path.join(UPLOAD_FOLDER, save_filename)
+        if os.path.isfile(filepath) and not os.path.exists(get_part_path(filepath)) and not os.path.exists(get_resume_path(save_filename)):
+            # It finished, only its completed record had not reached the store when the process stopped
+            downloads_status[save_filename] = get_recovered_record(save_filename, filepath, info)
+        elif info.get('url'):
+            queue_download(info['url'], save_filename, info.get('original_name', save_filename), info.get('priority', 0), rate_limit=info.get('rate_limit'), mirrors=info.get('mirrors'))
         else:
-            downloads_status[save_filename] = {
-                'status': 'completed',
-                'progress': 100,
-                'size': total_size,
-                'downloaded': total_size,
-                'original_name': original_filename,
-                'formatted_size': format_size(total_size),
-                'formatted_downloaded': format_size(total_size),
-                'completion_time': format_time(time.time() - start_time)
-            }
-            
-        del active_downloads[save_filename]
-        
-    except Exception as e:
-        downloads_status[save_filename] = {
-            'status': 'failed',
-            'error': str(e),
-            'original_name': original_filename
-        }
-        if save_filename in active_downloads:
-            del active_downloads[save_filename]
-
-HTML_TEMPLATE = """
-<!DOCTYPE html>
-<html lang="en">
-<head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>FDL Server</title>
-    <link href="https://cdn.jsdelivr.net/npm/bootstrap@5.1.3/dist/css/bootstrap.min.css" rel="stylesheet">
-    <link href="https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.0.0/css/all.min.css" rel="stylesheet">
-    <style>
-        :root {
-            --primary-color: #1a237e;
-            --secondary-color: #0d47a1;
-        }
-        
-        body { 
-            background-color: #f8f9fa; 
-            font-family: 'Segoe UI', system-ui, -apple-system, sans-serif;
-        }
-        
-        .navbar { 
-            background-color: var(--primary-color) !important;
-            box-shadow: 0 2px 4px rgba(0,0,0,0.1);
-        }
-        
-        .card {
-            border: none;
-            border-radius: 12px;
-            box-shadow: 0 2px 15px rgba(0,0,0,0.08);
-            margin-bottom: 20px;
-            overflow: hidden;
-        }
-        
-        .system-info {
-            background: linear-gradient(135deg, var(--primary-color), var(--secondary-color));
-            color: white;
-            padding: 20px;
-            border-radius: 12px;
-            margin-bottom: 20px;
-        }
-        
-        .system-info-item {
-            padding: 10px;
-            border-radius: 8px;
-            background: rgba(255, 255, 255, 0.1);
-            margin-bottom: 10px;
-        }
-        
-        .progress {
-            height: 8px;
-            border-radius: 4px;
-            background-color: #e9ecef;
-        }
-        
-        .progress-bar {
-            background-color: var(--primary-color);
-        }
-        
-        .download-item {
-            background: white;
-            padding: 20px;
-            border-radius: 10px;
-            margin-bottom: 15px;
-            border: 1px solid #eee;
-            transition: all 0.3s ease;
-        }
-        
-        .download-item:hover {
-            box-shadow: 0 5px 15px rgba(0,0,0,0.05);
-        }
-        
-        .filename {
-            font-size: 0.95rem;
-            font-weight: 500;
-            color: #2c3e50;
-            word-break: break-word;
-            margin-bottom: 10px;
-            display: block;
-        }
-        
-        .custom-url {
-            font-family: monospace;
-            background: #f8f9fa;
-            padding: 8px 12px;
-            border-radius: 6px;
-            font-size: 0.85em;
-            color: #666;
-            word-break: break-all;
-        }
-        
-        .size-info {
-            font-size: 0.85rem;
-            color: #6c757d;
-        }
-        
-        .speed-info {
-            font-size: 0.85rem;
-            color: var(--primary-color);
-            font-weight: 500;
-        }
-        
-        .btn {
-            border-radius: 6px;
-            padding: 0.5rem 1rem;
-        }
-        
-        .btn-sm {
-            padding: 0.25rem 0.5rem;
-        }
-        
-        .btn-primary {
-            background-color: var(--primary-color);
-            border-color: var(--primary-color);
-        }
-        
-        .btn-primary:hover {
-            background-color: var(--secondary-color);
-            border-color: var(--secondary-color);
-        }
-        
-        @media (max-width: 768px) {
-            .download-item {
-                padding: 15px;
-            }
-            
-            .filename {
-                font-size: 0.9rem;
-            }
-            
-            .custom-url {
-                font-size: 0.8em;
-            }
-            
-            .btn-sm {
-                padding: 0.2rem 0.4rem;
-            }
-            
-            .system-info {
-                padding: 15px;
-            }
-        }
-    </style>
-</head>
-<body>
-    <nav class="navbar navbar-dark mb-4">
-        <div class="container">
-            <a class="navbar-brand" href="/">
-                <i class="fas fa-bolt me-2"></i>FDL Server
-            </a>
-        </div>
-    </nav>
-
-    <div class="container">
-        <div class="system-info">
-            <h5 class="mb-3"><i class="fas fa-server me-2"></i>System Information</h5>
-            <div class="row">
-                <div class="col-md-6">
-                    <div class="system-info-item">
-                        <div class="d-flex justify-content-between">
-                            <span>Disk Space:</span>
-                            <span>{{ system_info.disk_used }} / {{ system_info.disk_total }}</span>
-                        </div>
-                        <div class="progress mt-2">
-                            <div class="progress-bar" role="progressbar" 
-                                 style="width: {{ system_info.disk_percent }}%">
-                            </div>
-                        </div>
-                    </div>
-                    <div class="system-info-item">
-                        <div class="d-flex justify-content-between">
-                            <span>Memory:</span>
-                            <span>{{ system_info.memory_used }} / {{ system_info.memory_total }}</span>
-                        </div>
-                        <div class="progress mt-2">
-                            <div class="progress-bar" role="progressbar" 
-                                 style="width: {{ system_info.memory_percent }}%">
-                            </div>
-                        </div>
-                    </div>
-                </div>
-                <div class="col-md-6">
-                    <div class="system-info-item">
-                        <div><i class="fas fa-microchip me-2"></i>CPU Usage: {{ system_info.cpu_percent }}%</div>
-                    </div>
-                    <div class="system-info-item">
-                        <div><i class="fas fa-folder me-2"></i>Upload Folder: {{ system_info.upload_folder_size }}</div>
-                        <div><i class="fas fa-file me-2"></i>Files: {{ system_info.upload_file_count }}</div>
-                    </div>
-                </div>
-            </div>
-        </div>
-
-        {% with messages = get_flashed_messages(with_categories=true) %}
-            {% if messages %}
-                {% for category, message in messages %}
-                    <div class="alert alert-{{ category }} alert-dismissible fade show">
-                        {{ message }}
-                        <button type="button" class="btn-close" data-bs-dismiss="alert"></button>
-                    </div>
-                {% endfor %}
-            {% endif %}
-        {% endwith %}
-
-        <div class="row">
-            <div class="col-12">
-                <div class="card">
-                    <div class="card-header bg-white py-3">
-                        <h5 class="mb-0"><i class="fas fa-download me-2"></i>New Download</h5>
-                    </div>
-                    <div class="card-body">
-                        <form method="post" class="row g-3">
-                            <div class="col-md-8 col-sm-12">
-                                <input type="url" class="form-control" name="url" 
-                                       placeholder="Enter download URL" required>
-                            </div>
-                            <div class="col-md-2 col-sm-6">
-                                <input type="text" class="form-control" name="custom_url" 
-                                       placeholder="Custom URL path">
-                            </div>
-                            <div class="col-md-2 col-sm-6">
-                                <button type="submit" class="btn btn-primary w-100">
-                                    <i class="fas fa-download me-2"></i>Download
-                                </button>
-                            </div>
-                        </form>
-                    </div>
-                </div>
-            </div>
-
-            <div class="col-12">
-                <div class="card">
-                    <div class="card-header bg-white py-3">
-                        <h5 class="mb-0"><i class="fas fa-list me-2"></i>Downloads</h5>
-                    </div>
-                    <div class="card-body" id="downloads-list">
-                        {% for filename, info in downloads.items() %}
-                            <div class="download-item">
-                                <div class="d-flex flex-column flex-md-row justify-content-between align-items-start align-items-md-center mb-3">
-                                    <span class="filename">{{ info.get('original_name', filename) }}</span>
-                                    <div class="mt-2 mt-md-0">
-                                        {% if info.status == 'completed' %}
-                                            <button class="btn btn-sm btn-outline-primary me-1" 
-                                                    onclick="renameFile('{{ filename }}')">
-                                                <i class="fas fa-edit"></i>
-                                            </button>
-                                            <a href="{{ url_for('download_file', filename=filename) }}" 
-                                               class="btn btn-sm btn-success me-1">
-                                                <i class="fas fa-download"></i>
-                                            </a>
-                                            <button class="btn btn-sm btn-danger" 
-                                                    onclick="deleteFile('{{ filename }}')">
-                                                <i class="fas fa-trash"></i>
-                                            </button>
-                                        {% endif %}
-                                    </div>
-                                </div>
-                                
-                                {% if info.status == 'completed' and filename in file_mappings %}
-                                    <div class="custom-url mb-3">
-                                        {{ request.host_url }}download/{{ file_mappings[filename] }}
-                                    </div>
-                                {% endif %}
-                                
-                                <div class="progress mb-2">
-                                    <div class="progress-bar {% if info.status == 'downloading' %}progress-bar-striped progress-bar-animated{% endif %}"
-                                         role="progressbar" 
-                                         style="width: {{ info.progress if info.progress else 0 }}%">
-                                    </div>
-                                </div>
-                                
-                                <div class="d-flex justify-content-between align-items-center">
-                                    <div>
-                                        <span class="size-info">
-                                            {% if info.formatted_downloaded %}
-                                                {{ info.formatted_downloaded }} / {{ info.formatted_size }}
-                                            {% endif %}
-                                        </span>
-                                        {% if info.status == 'downloading' %}
-                                            <span class="speed-info ms-2">
-                                                {{ info.speed }} • {{ info.eta }}
-                                            </span>
-                                        {% endif %}
-                                        {% if info.status == 'completed' and info.completion_time %}
-                                            <span class="text-success ms-2">
-                                                <i class="fas fa-check-circle"></i> Completed {{ info.completion_time }}
-                                            </span>
-                                        {% endif %}
-                                    </div>
-                                    <span class="badge {% if info.status == 'completed' %}bg-success{% elif info.status == 'failed' %}bg-danger{% else %}bg-primary{% endif %}">
-                                        {{ info.status|title }}
-                                    </span>
-                                </div>
-                            </div>
-                        {% endfor %}
-                    </div>
-                </div>
-            </div>
-        </div>
-    </div>
-
-    <script src="https://code.jquery.com/jquery-3.6.0.min.js"></script>
-    <script src="https://cdn.jsdelivr.net/npm/bootstrap@5.1.3/dist/js/bootstrap.bundle.min.js"></script>
-    <script>
-        function updateDownloads() {
-            $.get('/status', function(data) {
-                $('#downloads-list').load(location.href + ' #downloads-list>*');
-            });
-        }
+            downloads_status[save_filename] = dict(info, status='failed', error='Interrupted by restart')
 
-        function renameFile(filename) {
-            const newName = prompt("Enter new filename:");
-            if (newName) {
-                $.post('/rename/' + filename, {new_name: newName}, function(response) {
-                    if (response.status === 'success') {
-                        location.reload();
-                    } else {
-                        alert('Error: ' + response.message);
-                    }
-                });
-            }
-        }
+def get_recovered_record(save_filename, filepath, info):
+    entry = state_store.get_file_hash(save_filename)
+    if entry is None or not is_index_entry_current(save_filename, entry):
+        index_file_hash(save_filename, get_file_hash(filepath))
+        entry = state_store.get_file_hash(save_filename)
+    return {
+        'status': 'completed',
+        'progress': 100,
+        'size': entry['size'],
+        'downloaded': entry['size'],
+        'original_name': info.get('original_name', save_filename),
+        'url': info.get('url'),
+        'hash': entry['hash'],
+        'crc32': entry.get('crc32')
+    }
 
-        function deleteFile(filename) {
-            if (confirm('Are you sure you want to delete this file?')) {
-                $.post('/delete/' + filename, function(response) {
-                    if (response.status === 'success') {
-                        location.reload();
-                    }
-                });
-            }
+def verify_state_store():
+    on_disk = set(os.listdir(UPLOAD_FOLDER))
+    for filename in state_store.filenames(('completed',)):
+        if filename not in on_disk:
+            downloads_status.pop(filename, None)
+            file_mappings.pop(filename, None)
+
+    known = set(state_store.filenames()) | set(downloads_status.snapshot())
+    for filename in on_disk - known:
+        filepath = os.path.join(UPLOAD_FOLDER, filename)
+        if filename in active_downloads or is_part_file(filename) or os.path.exists(get_resume_path(filename)) or not os.path.isfile(filepath):
+            continue
+        size = os.path.getsize(filepath)
+        record = {
+            'status': 'completed',
+            'progress': 100,
+            'size': size,
+            'downloaded': size,
+            'original_name': filename
         }
+        entry = state_store.get_file_hash(filename)
+        if entry:
+            record['hash'] = entry['hash']
+        downloads_status[filename] = record
 
-        setInterval(updateDownloads, 1000);
-    </script>
-</body>
-</html>
-"""
+# Compiled once at startup instead of parsing the page source on every request
+page_template = app.jinja_env.get_template('fdl.html')
+downloads_list_template = app.jinja_env.get_template('downloads_list.html')
+download_item_template = app.jinja_env.get_template('download_item.html')
+item_html_cache = {}
 
 @app.route("/", methods=["GET", "POST"])
 def index():
     if request.method == "POST":
         url = request.form.get("url")
         custom_url = request.form.get("custom_url")
+        priority = request.form.get("priority", 0, type=int)
+        rate_limit = max(request.form.get("rate_limit", 0, type=int), 0) * 1024 or None
+        mirrors = request.form.get("mirrors", "").split()
         
         if url:
             try:
-                response = requests.head(url, allow_redirects=True, timeout=10)
-                original_filename = get_filename_from_url(url, response) or f"download_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
-                save_filename = secure_filename(original_filename)
-                
-                if custom_url:
-                    file_mappings[save_filename] = custom_url
-                
-                thread = threading.Thread(
-                    target=download_file_async,
-                    args=(url, save_filename, original_filename)
-                )
-                thread.daemon = True
-                thread.start()
-                
-                downloads_status[save_filename] = {
-                    'status': 'starting',
-                    'progress': 0,
-                    'size': 0,
-                    'downloaded': 0,
-                    'original_name': original_filename
-                }
-                flash("Download started!", "success")
+                _, queued = submit_download(url, custom_url, priority, rate_limit, mirrors)
+                if queued:
+                    flash("Download queued!", "success")
+                else:
+                    flash("This download is already queued or running", "warning")
                 
             except Exception as e:
                 flash(f"Error starting download: {str(e)}", "danger")
                 
         return redirect(url_for("index"))
     
-    return render_template_string(HTML_TEMPLATE, 
-                                downloads=downloads_status, 
-                                file_mappings=file_mappings,
-                                system_info=get_system_info())
+    return render_template(page_template,
+                           downloads=downloads_status.snapshot(),
+                           system_info=get_system_info(),
+                           version=downloads_status.cursor(),
+                           render_download_item=render_download_item)
+
+@app.route("/downloads/list")
+def downloads_list():
+    # The list alone, for viewers refreshing it; unchanged since their last fetch costs a 304 and no render
+    version = downloads_status.cursor()
+    etag = f"downloads-{version}"
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = Response(render_template(downloads_list_template,
+                                            downloads=downloads_status.snapshot(),
+                                            version=version,
+                                            render_download_item=render_download_item))
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
 
 @app.route("/status")
 def get_status():
+    started = time.perf_counter()
+    response = jsonify({
+        'downloads': {filename: serialize_status(info) for filename, info in downloads_status.snapshot().items()},
+        'system_info': get_system_info(),
+        'scheduler': scheduler.stats()
+    })
+    status_render_seconds.observe(time.perf_counter() - started)
+    return response
+
+@app.route("/metrics")
+def get_metrics():
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+@app.route("/api/downloads", methods=["POST"])
+def submit_downloads():
+    payload = request.get_json(silent=True)
+    items = payload.get('downloads') if isinstance(payload, dict) else payload
+    if not isinstance(items, list) or not items:
+        return jsonify({'error': 'Expected a non-empty "downloads" list'}), 400
+    if len(items) > MAX_BATCH_SIZE:
+        return jsonify({'error': f'At most {MAX_BATCH_SIZE} downloads per request'}), 413
+
+    jobs = []
+    for item in items:
+        if isinstance(item, str):
+            item = {'url': item}
+        try:
+            if not isinstance(item, dict) or not isinstance(item.get('url'), str):
+                raise ValueError("Each download needs a url")
+            rate_limit = int(item.get('rate_limit') or 0)
+            mirrors = item.get('mirrors') or []
+            if not isinstance(mirrors, list) or not all(isinstance(mirror, str) for mirror in mirrors):
+                raise ValueError("mirrors must be a list of URLs")
+            save_filename, queued = submit_download(
+                item['url'], item.get('custom_url'), int(item.get('priority', 0)), max(rate_limit, 0) or None, mirrors
+            )
+            jobs.append({
+                'id': save_filename,
+                'url': item['url'],
+                'queued': queued,
+                'status': downloads_status.get(save_filename, {}).get('status')
+            })
+        except (ValueError, TypeError) as e:
+            jobs.append({'url': item.get('url') if isinstance(item, dict) else item, 'error': str(e)})
+    return jsonify({'jobs': jobs}), 202
+
+def get_download_names(states):
+    # Committed rows plus writes still waiting for the store's writer, without forcing a flush
+    names = set(state_store.filenames(states or None))
+    names.update(name for name, info in downloads_status.snapshot().items() if not states or info.get('status') in states)
+    return names
+
+@app.route("/api/downloads")
+def list_downloads():
+    ids = [name for value in request.args.getlist('ids') for name in value.split(',') if name]
+    states = [state for value in request.args.getlist('state') for state in value.split(',') if state]
+    since = request.args.get('since')
+    offset = max(request.args.get('offset', 0, type=int), 0)
+    limit = min(max(request.args.get('limit', API_PAGE_SIZE, type=int), 1), API_MAX_PAGE_SIZE)
+
+    if since is not None:
+        version, changed, removed, reset = downloads_status.changes_since(downloads_status.parse_cursor(since))
+    else:
+        version, changed, removed, reset = downloads_status.current_version(), {}, [], True
+    if reset and not ids:
+        changed = {}
+        names = get_download_names(states)
+    else:
+        # Filtered before paging so every page is full and total counts what matches
+        if reset:
+            changed = {name: downloads_status.lookup(name) for name in ids}
+        changed = {
+            name: info for name, info in changed.items()
+            if info is not None and (not ids or name in ids) and (not states or info.get('status') in states)
+        }
+        names = set(changed)
+        removed = [name for name in removed if not ids or name in ids]
+
+    names = sorted(names)
+    downloads = {}
+    for name in names[offset:offset + limit]:
+        info = changed.get(name) or downloads_status.lookup(name)
+        if info is not None and (not states or info.get('status') in states):
+            downloads[name] = serialize_status(info)
     return jsonify({
-        'downloads': downloads_status,
-        'system_info': get_system_info()
+        'version': downloads_status.cursor(version),
+        'reset': since is not None and reset,
+        'downloads': downloads,
+        'removed': removed,
+        'total': len(names),
+        'offset': offset,
+        'next_offset': offset + limit if offset + limit < len(names) else None
+    })
+
+@app.route("/retry/<filename>", methods=["POST"])
+def retry_download(filename):
+    record = load_resume_record(filename)
+    info = downloads_status.get(filename, {})
+    url = record['url'] if record else info.get('url')
+    if not url:
+        return jsonify({"status": "error", "message": "Nothing to retry"})
+
+    original_filename = info.get('original_name') or (record or {}).get('original_name') or filename
+    priority = info.get('priority', (record or {}).get('priority', 0))
+    rate_limit = info.get('rate_limit', (record or {}).get('rate_limit'))
+    mirrors = info.get('mirrors', (record or {}).get('mirrors'))
+    if not queue_download(url, filename, original_filename, priority, {
+        'progress': info.get('progress', 0),
+        'size': info.get('size', 0),
+        'downloaded': info.get('downloaded', 0)
+    }, rate_limit, mirrors):
+        return jsonify({"status": "error", "message": "Download already running"})
+    return jsonify({"status": "success"})
+
+def render_download_item(filename, info):
+    # Records are replaced, never changed in place, so an entry renders once for every viewer
+    # until its record or its custom URL changes
+    key = (request.host_url, file_mappings.get(filename))
+    cached = item_html_cache.get(filename)
+    if cached is not None and cached[0] is info and cached[1] == key:
+        return cached[2]
+    html = Markup(download_item_template.render(filename=filename, info=serialize_status(info), file_mappings=file_mappings))
+    item_html_cache[filename] = (info, key, html)
+    if len(item_html_cache) > len(downloads_status) + MAX_STATUS_TOMBSTONES:
+        for stale in set(item_html_cache) - set(downloads_status.snapshot()):
+            item_html_cache.pop(stale, None)
+    return html
+
+def get_changes(version, system_sampled_at=None):
+    version, changed, removed, reset = downloads_status.changes_since(version)
+    payload = {
+        'version': downloads_status.cursor(version),
+        'reset': reset,
+        'downloads': {filename: serialize_status(info) for filename, info in changed.items()},
+        'html': {filename: render_download_item(filename, info) for filename, info in changed.items()},
+        'removed': removed
+    }
+    system_info = get_system_info()
+    if system_info.get('sampled_at') != system_sampled_at:
+        payload['system_info'] = system_info
+    return payload
+
+event_waiters = threading.BoundedSemaphore(EVENTS_MAX_WAITING)
+
+@app.route("/events")
+def events():
+    # An EventSource reconnecting sends the last id it got, newer than the since fixed in its URL
+    since = downloads_status.parse_cursor(request.headers.get('Last-Event-ID') or request.args.get('since'))
+
+    if request.args.get('poll'):
+        # With every waiting slot taken the poll is answered at once, the page asks again a second later
+        if event_waiters.acquire(blocking=False):
+            try:
+                downloads_status.wait_for_change(since, EVENTS_POLL_TIMEOUT)
+            finally:
+                event_waiters.release()
+        return jsonify(get_changes(since))
+
+    if not event_waiters.acquire(blocking=False):
+        # The page falls back to polling, the remaining threads stay free for downloads and the API
+        return Response('Too many event streams', status=503, headers={'Retry-After': '5'})
+
+    def stream():
+        version = since
+        system_sampled_at = None
+        deadline = time.monotonic() + EVENTS_STREAM_SECONDS
+        yield 'retry: 2000\n\n'
+        while time.monotonic() < deadline:
+            if not downloads_status.wait_for_change(version, SYSTEM_SAMPLE_INTERVAL):
+                if get_system_info().get('sampled_at') == system_sampled_at:
+                    yield ': keepalive\n\n'
+                    continue
+            payload = get_changes(version, system_sampled_at)
+            version = downloads_status.parse_cursor(payload['version'])
+            system_sampled_at = payload.get('system_info', {}).get('sampled_at', system_sampled_at)
+            yield f"id: {payload['version']}\nevent: progress\ndata: {json.dumps(payload)}\n\n"
+            # Coalesce bursts of progress updates into one event per interval
+            time.sleep(EVENTS_MIN_INTERVAL)
+
+    response = Response(stream_with_context(stream()), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
     })
+    # Also released when the client goes away before the first event
+    response.call_on_close(event_waiters.release)
+    return response
+
+def get_file_etag(filename, stat):
+    entry = state_store.get_file_hash(filename)
+    if entry and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime:
+        return entry['hash']
+    # In queue mode the hash was computed by a worker process and reaches us through the store
+    info = downloads_status.get(filename)
+    if info and info.get('status') == 'completed' and info.get('hash') and info.get('size') == stat.st_size:
+        return info['hash']
+    return f"{stat.st_mtime_ns:x}-{stat.st_size:x}"
+
+def get_byte_ranges(ranges, size):
+    spans = []
+    for start, end in ranges:
+        if end is None:
+            end = size
+            if start < 0:
+                start = max(size + start, 0)
+        end = min(end, size)
+        if 0 <= start < end:
+            spans.append([start, end])
+    spans.sort()
+    merged = []
+    for start, end in spans:
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+def send_byteranges(filepath, filename, parsed_range, etag, stat, last_modified):
+    size = stat.st_size
+    spans = get_byte_ranges(parsed_range.ranges, size)
+    if not spans:
+        raise RequestedRangeNotSatisfiable(size)
+    if len(spans) > MAX_BYTE_RANGES:
+        return None
+    if len(spans) == 1:
+        start, end = spans[0]
+        body = iter_file_range(filepath, [(start, end)])
+        response = Response(body, status=206, mimetype='application/octet-stream')
+        response.content_range = ContentRange('bytes', start, end, size)
+        response.content_length = end - start
+    else:
+        boundary = uuid.uuid4().hex
+        headers = [
+            f"--{boundary}\r\nContent-Type: application/octet-stream\r\nContent-Range: bytes {start}-{end - 1}/{size}\r\n\r\n".encode()
+            for start, end in spans
+        ]
+        closing = f"--{boundary}--\r\n".encode()
+        length = sum(len(header) + (end - start) + 2 for header, (start, end) in zip(headers, spans)) + len(closing)
+
+        def body():
+            for header, span in zip(headers, spans):
+                yield header
+                yield from iter_file_range(filepath, [span])
+                yield b"\r\n"
+            yield closing
+
+        response = Response(body(), status=206, mimetype=f'multipart/byteranges; boundary={boundary}')
+        response.content_length = length
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.accept_ranges = 'bytes'
+    response.headers['Content-Disposition'] = f"attachment; filename={filename}"
+    return response
+
+def iter_file_range(filepath, spans):
+    fd = os.open(filepath, os.O_RDONLY)
+    try:
+        for start, end in spans:
+            while start < end:
+                data = os.pread(fd, min(HASH_READ_SIZE, end - start), start)
+                if not data:
+                    return
+                yield data
+                start += len(data)
+    finally:
+        os.close(fd)
+
+def get_live_state(filename):
+    progress = active_downloads.get(filename)
+    if progress is not None:
+        return 'downloading', progress.available_bytes(), progress.total_size
+    # Downloads running in a worker process publish their progress through the store
+    info = downloads_status.get(filename) or {}
+    return info.get('status'), info.get('available', 0), info.get('size', 0)
+
+def open_growing_file(filepath):
+    try:
+        return os.open(get_part_path(filepath), os.O_RDONLY)
+    except FileNotFoundError:
+        # Renamed into place since the caller looked
+        return os.open(filepath, os.O_RDONLY)
+
+def iter_growing_file(filepath, filename, start, end):
+    fd = open_growing_file(filepath)
+    try:
+        pos = start
+        while end is None or pos < end:
+            status, available, _ = get_live_state(filename)
+            if status in (None, 'completed', 'duplicate'):
+                # Finished, renamed or deduplicated, the open descriptor still sees every byte
+                available = os.fstat(fd).st_size
+            elif status not in ACTIVE_STATUSES:
+                raise IOError(f"Download of {filename} stopped: {status}")
+            limit = available if end is None else min(available, end)
+            if pos < limit:
+                data = os.pread(fd, min(HASH_READ_SIZE, limit - pos), pos)
+                if not data:
+                    raise IOError(f"{filename} was truncated while being served")
+                pos += len(data)
+                yield data
+            elif status in ACTIVE_STATUSES:
+                # Queued again means waiting out a retry, the reader stays attached until the next attempt catches up
+                time.sleep(TAIL_POLL_INTERVAL)
+            elif end is None:
+                return
+            else:
+                raise IOError(f"{filename} ended at {pos} bytes, expected {end}")
+    finally:
+        os.close(fd)
+
+def send_growing_file(filename, filepath):
+    status, _, total_size = get_live_state(filename)
+    if status != 'downloading' or not os.path.isfile(get_part_path(filepath)):
+        response = Response("Download has not started yet", status=503, mimetype='text/plain')
+        response.retry_after = int(DISK_RETRY_INTERVAL) if status == 'queued' else 5
+        return response
+
+    # The final length is unknown until the origin transfer ends, so only ranges get a Content-Length
+    parsed_range = parse_range_header(request.headers.get('Range'))
+    span = parsed_range.range_for_length(total_size) if parsed_range and total_size else None
+    start, end = span or (0, None)
+    response = Response(iter_growing_file(filepath, filename, start, end),
+                        status=206 if span else 200, mimetype='application/octet-stream')
+    if span:
+        response.content_range = ContentRange('bytes', start, end, total_size)
+        response.content_length = end - start
+    response.headers['Content-Disposition'] = f"attachment; filename={os.path.basename(filepath)}"
+    response.headers['Cache-Control'] = 'no-store'
+    return throttle_response(response)
+
+def get_known_crc32(filename, stat):
+    # Recorded while the file downloaded, files that predate that get theirs computed as they stream
+    entry = state_store.get_file_hash(filename)
+    if entry and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime and entry.get('crc32') is not None:
+        return entry['crc32']
+    info = downloads_status.get(filename)
+    if info and info.get('status') == 'completed' and info.get('size') == stat.st_size:
+        return info.get('crc32')
+    return None
+
+def get_dos_time(mtime):
+    t = time.localtime(mtime)
+    if t.tm_year < 1980:
+        return 0, (1 << 5) | 1
+    return (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2), ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+
+def open_bundle_files(names):
+    entries = []
+    missing = []
+    try:
+        for name in names:
+            filename = file_mappings.resolve(name) or name
+            filepath = safe_join(UPLOAD_FOLDER, filename)
+            if filepath is None or is_part_file(os.path.basename(filepath)) or not os.path.isfile(filepath):
+                missing.append(name)
+                continue
+            if any(entry['path'] == filepath for entry in entries):
+                continue
+            # Held open, a file evicted or replaced while the bundle streams is still read in full
+            fd = os.open(filepath, os.O_RDONLY)
+            stat = os.fstat(fd)
+            entries.append({
+                'path': filepath,
+                'name': os.path.basename(filepath),
+                'fd': fd,
+                'size': stat.st_size,
+                'mtime': stat.st_mtime,
+                'crc32': get_known_crc32(filename, stat)
+            })
+            try:
+                os.utime(fd, (time.time(), stat.st_mtime))
+            except OSError:
+                pass
+    except Exception:
+        close_bundle_files(entries)
+        raise
+    for entry in entries:
+        entry['descriptor'] = entry['crc32'] is None
+    return entries, missing
+
+def close_bundle_files(entries):
+    for entry in entries:
+        os.close(entry['fd'])
+
+def iter_bundle_file(entry):
+    crc32 = 0
+    pos = 0
+    while pos < entry['size']:
+        data = os.pread(entry['fd'], min(HASH_READ_SIZE, entry['size'] - pos), pos)
+        if not data:
+            raise IOError(f"{entry['name']} was truncated while being bundled")
+        if entry['descriptor']:
+            crc32 = zlib.crc32(data, crc32)
+        pos += len(data)
+        yield data
+    return crc32
+
+def zip_local_header(entry):
+    # Stored entries only, already-compressed downloads gain nothing from deflate
+    name = entry['name'].encode()
+    zip64 = entry['size'] >= ZIP64_LIMIT
+    if entry['descriptor']:
+        # CRC and sizes follow the data, in the descriptor
+        flags, crc32, size = 0x0808, 0, 0
+    else:
+        flags, crc32, size = 0x0800, entry['crc32'], entry['size']
+    extra = struct.pack('<HHQQ', 1, 16, size, size) if zip64 else b''
+    dos_time, dos_date = get_dos_time(entry['mtime'])
+    return struct.pack('<IHHHHHIIIHH', 0x04034b50, 45 if zip64 else 20, flags, 0, dos_time, dos_date, crc32,
+                       ZIP64_LIMIT if zip64 else size, ZIP64_LIMIT if zip64 else size, len(name), len(extra)) + name + extra
+
+def zip_descriptor(entry):
+    if entry['size'] >= ZIP64_LIMIT:
+        return struct.pack('<IIQQ', 0x08074b50, entry['crc32'] or 0, entry['size'], entry['size'])
+    return struct.pack('<IIII', 0x08074b50, entry['crc32'] or 0, entry['size'], entry['size'])
+
+def zip_central_header(entry):
+    name = entry['name'].encode()
+    size = entry['size']
+    offset = entry['offset']
+    fields = []
+    if size >= ZIP64_LIMIT:
+        fields += [size, size]
+        size = ZIP64_LIMIT
+    if offset >= ZIP64_LIMIT:
+        fields.append(offset)
+        offset = ZIP64_LIMIT
+    extra = struct.pack(f'<HH{len(fields)}Q', 1, 8 * len(fields), *fields) if fields else b''
+    version = 45 if fields else 20
+    flags = 0x0808 if entry['descriptor'] else 0x0800
+    dos_time, dos_date = get_dos_time(entry['mtime'])
+    return struct.pack('<IHHHHHHIIIHHHHHII', 0x02014b50, (3 << 8) | version, version, flags, 0, dos_time, dos_date,
+                       entry['crc32'] or 0, size, size, len(name), len(extra), 0, 0, 0, 0o100644 << 16, offset) + name + extra
+
+def zip_end(count, cd_offset, cd_size):
+    end = b''
+    if count >= 0xFFFF or cd_offset >= ZIP64_LIMIT or cd_size >= ZIP64_LIMIT:
+        end += struct.pack('<IQHHIIQQQQ', 0x06064b50, 44, 45, 45, 0, 0, count, count, cd_size, cd_offset)
+        end += struct.pack('<IIQI', 0x07064b50, 0, cd_offset + cd_size, 1)
+    return end + struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, min(count, 0xFFFF), min(count, 0xFFFF),
+                             min(cd_size, ZIP64_LIMIT), min(cd_offset, ZIP64_LIMIT), 0)
+
+def plan_zip(entries):
+    # Every header has a known length before any data is read, and so does the archive
+    pos = 0
+    for entry in entries:
+        entry['offset'] = pos
+        pos += len(zip_local_header(entry)) + entry['size']
+        if entry['descriptor']:
+            pos += len(zip_descriptor(entry))
+    cd_size = sum(len(zip_central_header(entry)) for entry in entries)
+    return pos + cd_size + len(zip_end(len(entries), pos, cd_size))
+
+def iter_zip(entries):
+    pos = 0
+    for entry in entries:
+        header = zip_local_header(entry)
+        yield header
+        crc32 = yield from iter_bundle_file(entry)
+        pos += len(header) + entry['size']
+        if entry['descriptor']:
+            entry['crc32'] = crc32
+            descriptor = zip_descriptor(entry)
+            yield descriptor
+            pos += len(descriptor)
+    central = b''.join(zip_central_header(entry) for entry in entries)
+    yield central + zip_end(len(entries), pos, len(central))
+
+def tar_header(entry):
+    info = tarfile.TarInfo(entry['name'])
+    info.size = entry['size']
+    info.mtime = int(entry['mtime'])
+    info.mode = 0o644
+    return info.tobuf(tarfile.PAX_FORMAT, 'utf-8', 'surrogateescape')
+
+def plan_tar(entries):
+    return sum(len(tar_header(entry)) + entry['size'] + -entry['size'] % tarfile.BLOCKSIZE for entry in entries) + 2 * tarfile.BLOCKSIZE
+
+def iter_tar(entries):
+    for entry in entries:
+        yield tar_header(entry)
+        yield from iter_bundle_file(entry)
+        if entry['size'] % tarfile.BLOCKSIZE:
+            yield bytes(-entry['size'] % tarfile.BLOCKSIZE)
+    yield bytes(2 * tarfile.BLOCKSIZE)
+
+BUNDLE_FORMATS = {
+    'zip': (plan_zip, iter_zip, 'application/zip'),
+    'tar': (plan_tar, iter_tar, 'application/x-tar')
+}
+
+def send_upload(filename):
+    filepath = safe_join(UPLOAD_FOLDER, filename)
+    if filepath is None or is_part_file(os.path.basename(filepath)):
+        abort(404)
+    if not os.path.isfile(filepath):
+        # Until the rename on completion only the .part file exists, a file being replaced keeps serving the old copy
+        if filename in active_downloads or downloads_status.get(filename, {}).get('status') in ACTIVE_STATUSES:
+            return send_growing_file(filename, filepath)
+        abort(404)
+    stat = os.stat(filepath)
+    try:
+        # atime records the last time the file was served, the evictor drops the stalest first
+        os.utime(filepath, (time.time(), stat.st_mtime))
+    except OSError:
+        pass
+    etag = get_file_etag(filename, stat)
+    last_modified = datetime.fromtimestamp(stat.st_mtime, timezone.utc)
+
+    # Werkzeug only serves a single range, multipart/byteranges responses are built here
+    parsed_range = parse_range_header(request.headers.get('Range'))
+    if parsed_range and parsed_range.units == 'bytes' and len(parsed_range.ranges) > 1:
+        environ = request.environ
+        if not is_resource_modified(environ, etag, last_modified=last_modified):
+            response = Response(status=304)
+            response.set_etag(etag)
+            return response
+        if 'HTTP_IF_RANGE' not in environ or not is_resource_modified(environ, etag, last_modified=last_modified, ignore_if_range=False):
+            response = send_byteranges(filepath, os.path.basename(filepath), parsed_range, etag, stat, last_modified)
+            if response is not None:
+                return throttle_response(response)
+
+    return throttle_response(send_file(os.path.abspath(filepath), as_attachment=True, etag=etag, last_modified=last_modified))
+
+def count_served_bytes(response):
+    # Counted when the response is built, a client that disconnects early still counts in full
+    if response.status_code not in (200, 206):
+        return
+    if response.content_length is not None:
+        bytes_served.inc(response.content_length)
+    else:
+        response.response = count_chunks(response.response)
+
+def count_chunks(chunks):
+    try:
+        for data in chunks:
+            bytes_served.inc(len(data))
+            yield data
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+def throttle_response(response):
+    count_served_bytes(response)
+    # With X-Sendfile the front-end server sends the body, it has to enforce its own limit
+    if serve_bucket is None or app.config['USE_X_SENDFILE'] or response.status_code not in (200, 206):
+        return response
+    response.response = throttle_chunks(response.response, [serve_bucket])
+    return response
 
 @app.route("/download/<path:filename>")
 def download_file(filename):
-    for real_filename, custom_url in file_mappings.items():
-        if custom_url == filename:
-            return send_from_directory(UPLOAD_FOLDER, real_filename, as_attachment=True)
-    return send_from_directory(UPLOAD_FOLDER, filename, as_attachment=True)
+    filename = file_mappings.resolve(filename) or filename
+    if object_store and S3_REDIRECT:
+        stored = (downloads_status.get(filename) or {}).get('s3')
+        if stored and stored.get('state') == 'completed':
+            # The object store serves the body, this process only signs the URL
+            return redirect(object_store.presign(stored['key'], filename))
+    return send_upload(filename)
+
+@app.route("/bundle", methods=["GET", "POST"])
+def download_bundle():
+    payload = request.get_json(silent=True)
+    if isinstance(payload, dict):
+        names = payload.get('files')
+        archive_format = payload.get('format', 'zip')
+    else:
+        names = [name for value in request.values.getlist('files') for name in value.split(',') if name]
+        archive_format = request.values.get('format', 'zip')
+    if not isinstance(names, list) or not names or not all(isinstance(name, str) for name in names):
+        return jsonify({'error': 'Expected a non-empty "files" list'}), 400
+    if len(names) > MAX_BUNDLE_FILES:
+        return jsonify({'error': f'At most {MAX_BUNDLE_FILES} files per bundle'}), 413
+    if archive_format not in BUNDLE_FORMATS:
+        return jsonify({'error': f'Unknown format, expected one of: {", ".join(BUNDLE_FORMATS)}'}), 400
+
+    entries, missing = open_bundle_files(names)
+    if missing:
+        close_bundle_files(entries)
+        return jsonify({'error': 'Not found', 'missing': missing}), 404
+    plan, build, mimetype = BUNDLE_FORMATS[archive_format]
+    # Built as it is sent from the open files, nothing of the archive is kept on disk or in memory
+    response = Response(build(entries), mimetype=mimetype)
+    response.content_length = plan(entries)
+    response.call_on_close(lambda: close_bundle_files(entries))
+    response.headers['Content-Disposition'] = f"attachment; filename=downloads.{archive_format}"
+    return throttle_response(response)
 
 @app.route("/rename/<filename>", methods=["POST"])
 def rename_file(filename):
@@ -582,10 +3186,10 @@ def rename_file(filename):
         os.rename(old_path, new_path)
         
         if filename in downloads_status:
-            downloads_status[secure_filename(new_name)] = downloads_status.pop(filename)
-            downloads_status[secure_filename(new_name)]['original_name'] = new_name
+            downloads_status[secure_filename(new_name)] = dict(downloads_status.pop(filename), original_name=new_name)
         if filename in file_mappings:
             file_mappings[secure_filename(new_name)] = file_mappings.pop(filename)
+        rename_file_hash(filename, secure_filename(new_name))
             
         return jsonify({"status": "success"})
     except Exception as e:
@@ -594,17 +3198,22 @@ def rename_file(filename):
 @app.route("/delete/<filename>", methods=["POST"])
 def delete_file(filename):
     try:
-        filepath = os.path.join(UPLOAD_FOLDER, filename)
-        if os.path.exists(filepath):
-            os.remove(filepath)
-            if filename in downloads_status:
-                del downloads_status[filename]
-            if filename in file_mappings:
-                del file_mappings[filename]
+        remove_download(filename)
         return jsonify({"status": "success"})
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)})
 
+@app.route("/pin/<filename>", methods=["POST"])
+def pin_file(filename):
+    info = downloads_status.get(filename)
+    if not info or info.get('status') != 'completed':
+        return jsonify({"status": "error", "message": "Only completed files can be pinned"})
+    downloads_status[filename] = dict(info, pinned=not info.get('pinned'))
+    return jsonify({"status": "success", "pinned": not info.get('pinned')})
+
 if __name__ == "__main__":
+    verify_state_store()
+    resume_pending_downloads()
+    start_evictor()
     port = int(os.environ.get("PORT", 5000))  # Use Scalingo's PORT or default to 5000 locally
     app.run(debug=False, host="0.0.0.0", port=port)  # Debug off for production
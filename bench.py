@@ -0,0 +1,345 @@
+import argparse
+import hashlib
+import http.server
+import json
+import os
+import platform
+import random
+import re
+import shutil
+import socket
+import socketserver
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import psutil
+import requests
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+BASE_DATA = random.Random(0).randbytes(1024 * 1024)
+SEND_SIZE = 64 * 1024
+TERMINAL_STATUSES = ('completed', 'duplicate', 'failed')
+SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+def parse_size(value):
+    match = re.fullmatch(r'(\d+(?:\.\d+)?)([KMG]?)B?', value.strip().upper())
+    if not match:
+        raise argparse.ArgumentTypeError(f"Invalid size: {value}")
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2)])
+
+class OriginHandler(http.server.BaseHTTPRequestHandler):
+    # Stand-in for a remote file host, every file is a deterministic slice of BASE_DATA
+    protocol_version = 'HTTP/1.1'
+    files = {}
+    latency = 0.0
+    bandwidth = 0
+    ranges = True
+    fail_rate = 0.0
+    requests_served = 0
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self.respond(send_body=False)
+
+    def do_GET(self):
+        self.respond(send_body=True)
+
+    def respond(self, send_body):
+        OriginHandler.requests_served += 1
+        name = self.path.split('?')[0].rsplit('/', 1)[-1]
+        if name not in self.files:
+            self.send_error(404)
+            return
+        size = self.files[name]
+        etag = f'"{name}-{size}"'
+        if self.latency:
+            time.sleep(self.latency)
+
+        start, end, status = 0, size, 200
+        match = re.fullmatch(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+        if match and self.ranges and self.headers.get('If-Range', etag) == etag:
+            start = int(match.group(1))
+            end = min(int(match.group(2)) + 1, size) if match.group(2) else size
+            status = 206
+        self.send_response(status)
+        self.send_header('Content-Length', str(end - start))
+        self.send_header('ETag', etag)
+        if self.ranges:
+            self.send_header('Accept-Ranges', 'bytes')
+        if status == 206:
+            self.send_header('Content-Range', f'bytes {start}-{end - 1}/{size}')
+        self.end_headers()
+        if send_body:
+            cut_at = random.randint(start, end) if random.random() < self.fail_rate else None
+            self.send_file_bytes(name, start, end, cut_at)
+
+    def send_file_bytes(self, name, start, end, cut_at):
+        shift = int(hashlib.md5(name.encode()).hexdigest()[:8], 16) % len(BASE_DATA)
+        view = memoryview(BASE_DATA)
+        began = time.monotonic()
+        pos = start
+        try:
+            while pos < end:
+                if cut_at is not None and pos >= cut_at:
+                    self.close_connection = True
+                    self.connection.shutdown(socket.SHUT_RDWR)
+                    return
+                offset = (pos + shift) % len(BASE_DATA)
+                length = min(end - pos, len(BASE_DATA) - offset, SEND_SIZE)
+                self.wfile.write(view[offset:offset + length])
+                pos += length
+                if self.bandwidth:
+                    delay = began + (pos - start) / self.bandwidth - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+class OriginServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+def start_origin(args):
+    OriginHandler.latency = args.latency / 1000
+    OriginHandler.bandwidth = args.bandwidth
+    OriginHandler.ranges = not args.no_ranges
+    OriginHandler.fail_rate = args.fail_rate
+    server = OriginServer(('127.0.0.1', 0), OriginHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_address[1]}/files/"
+
+def get_free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def start_app(workdir, port, extra_env):
+    env = dict(os.environ, PORT=str(port), **extra_env)
+    process = subprocess.Popen([sys.executable, APP_PATH], cwd=workdir, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base = f"http://127.0.0.1:{port}"
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"app.py exited with code {process.returncode}")
+        try:
+            requests.get(f"{base}/status", timeout=1)
+            return process, base
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("app.py did not start within 30 seconds")
+
+class ResourceMonitor:
+    def __init__(self, pid):
+        self.process = psutil.Process(pid)
+        self.peak_rss = 0
+        self.running = True
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+        self.thread.start()
+
+    def sample(self):
+        while self.running:
+            try:
+                self.peak_rss = max(self.peak_rss, self.process.memory_info().rss)
+            except psutil.Error:
+                return
+            time.sleep(0.05)
+
+    def cpu_seconds(self):
+        times = self.process.cpu_times()
+        return times.user + times.system
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+
+def percentiles(samples):
+    if not samples:
+        return {}
+    ordered = sorted(samples)
+
+    def pick(fraction):
+        return round(ordered[min(int(fraction * len(ordered)), len(ordered) - 1)] * 1000, 3)
+
+    return {'count': len(ordered), 'p50_ms': pick(0.5), 'p90_ms': pick(0.9), 'p99_ms': pick(0.99), 'max_ms': pick(1.0)}
+
+def wait_for_downloads(base, names, retries, timeout):
+    attempts = dict.fromkeys(names, 0)
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        downloads = requests.get(f"{base}/status").json()['downloads']
+        statuses = {name: downloads.get(name, {}).get('status') for name in names}
+        for name, status in statuses.items():
+            if status == 'failed' and attempts[name] < retries:
+                attempts[name] += 1
+                requests.post(f"{base}/retry/{name}")
+                statuses[name] = 'queued'
+        if all(status in TERMINAL_STATUSES for status in statuses.values()):
+            return statuses, sum(attempts.values())
+        time.sleep(0.1)
+    raise RuntimeError(f"Downloads did not finish within {timeout} seconds")
+
+def submit(base, url):
+    response = requests.post(f"{base}/", data={'url': url}, allow_redirects=False)
+    response.raise_for_status()
+
+def bench_downloads(base, origin, monitor, args):
+    names = [f"bench-{i}.bin" for i in range(args.count)]
+    for name in names:
+        OriginHandler.files[name] = args.size
+    cpu_before = monitor.cpu_seconds()
+    started = time.time()
+    for name in names:
+        submit(base, origin + name)
+    statuses, retries = wait_for_downloads(base, names, args.retries, args.timeout)
+    elapsed = time.time() - started
+    cpu = monitor.cpu_seconds() - cpu_before
+    completed = [name for name, status in statuses.items() if status == 'completed']
+    transferred = len(completed) * args.size
+    return {
+        'files': args.count,
+        'file_size': args.size,
+        'completed': len(completed),
+        'failed': sum(1 for status in statuses.values() if status == 'failed'),
+        'retries': retries,
+        'seconds': round(elapsed, 3),
+        'throughput_bps': round(transferred / elapsed) if elapsed else 0,
+        'cpu_seconds': round(cpu, 3),
+        'cpu_seconds_per_gb': round(cpu / (transferred / 1e9), 3) if transferred else None
+    }, completed
+
+def bench_status(base, args):
+    samples = []
+    lock = threading.Lock()
+    deadline = time.time() + args.poll_seconds
+
+    def poll():
+        session = requests.Session()
+        while time.time() < deadline:
+            started = time.perf_counter()
+            session.get(f"{base}/status").raise_for_status()
+            elapsed = time.perf_counter() - started
+            with lock:
+                samples.append(elapsed)
+
+    pollers = [threading.Thread(target=poll) for _ in range(args.pollers)]
+    for poller in pollers:
+        poller.start()
+    for poller in pollers:
+        poller.join()
+    return dict(percentiles(samples), pollers=args.pollers, requests_per_second=round(len(samples) / args.poll_seconds, 1))
+
+def bench_serve(base, names, monitor, args):
+    if not names:
+        return {}
+    transferred = []
+    cpu_before = monitor.cpu_seconds()
+    started = time.time()
+
+    def fetch(name):
+        with requests.get(f"{base}/download/{name}", stream=True) as response:
+            response.raise_for_status()
+            transferred.append(sum(len(chunk) for chunk in response.iter_content(SEND_SIZE)))
+
+    readers = [threading.Thread(target=fetch, args=(names[i % len(names)],)) for i in range(args.readers)]
+    for reader in readers:
+        reader.start()
+    for reader in readers:
+        reader.join()
+    elapsed = time.time() - started
+    total = sum(transferred)
+    cpu = monitor.cpu_seconds() - cpu_before
+    return {
+        'readers': args.readers,
+        'bytes': total,
+        'seconds': round(elapsed, 3),
+        'throughput_bps': round(total / elapsed) if elapsed else 0,
+        'cpu_seconds_per_gb': round(cpu / (total / 1e9), 3) if total else None
+    }
+
+def bench_dedup(base, origin, workdir, args):
+    # Files the hash index has never seen are hashed when a download of the same size completes
+    results = []
+    seeded = 0
+    for step, target in enumerate(args.dedup_steps):
+        while seeded < target:
+            with open(os.path.join(workdir, 'temp_downloads', f"seed-{seeded}.bin"), 'wb') as f:
+                f.write(os.urandom(args.dedup_size))
+            seeded += 1
+        name = f"dedup-{step}.bin"
+        OriginHandler.files[name] = args.dedup_size
+        started = time.time()
+        submit(base, origin + name)
+        wait_for_downloads(base, [name], args.retries, args.timeout)
+        results.append({'folder_files': seeded, 'seconds': round(time.time() - started, 3)})
+    return {'file_size': args.dedup_size, 'steps': results}
+
+def get_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(APP_PATH),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark app.py against a local stand-in origin")
+    parser.add_argument('--count', type=int, default=8, help="files downloaded in the throughput run")
+    parser.add_argument('--size', type=parse_size, default=parse_size('32M'))
+    parser.add_argument('--latency', type=float, default=0, help="origin latency before headers, in ms")
+    parser.add_argument('--bandwidth', type=parse_size, default=0, help="origin bytes/s per connection, 0 for unlimited")
+    parser.add_argument('--no-ranges', action='store_true', help="origin ignores Range requests")
+    parser.add_argument('--fail-rate', type=float, default=0, help="fraction of origin responses cut mid-body")
+    parser.add_argument('--retries', type=int, default=3, help="retries per failed download through /retry")
+    parser.add_argument('--pollers', type=int, default=8)
+    parser.add_argument('--poll-seconds', type=float, default=5)
+    parser.add_argument('--readers', type=int, default=4, help="concurrent /download readers")
+    parser.add_argument('--dedup-steps', type=lambda v: [int(n) for n in v.split(',')], default=[0, 100, 500])
+    parser.add_argument('--dedup-size', type=parse_size, default=parse_size('256K'))
+    parser.add_argument('--timeout', type=float, default=600)
+    parser.add_argument('--env', action='append', default=[], metavar='KEY=VALUE', help="extra environment for app.py")
+    parser.add_argument('--output', help="also write the JSON results to this file")
+    parser.add_argument('--keep', action='store_true', help="keep the scratch directory")
+    args = parser.parse_args()
+
+    extra_env = dict(item.split('=', 1) for item in args.env)
+    workdir = tempfile.mkdtemp(prefix='url-rm-bench-')
+    origin = start_origin(args)
+    process, base = start_app(workdir, get_free_port(), extra_env)
+    monitor = ResourceMonitor(process.pid)
+    try:
+        downloads, completed = bench_downloads(base, origin, monitor, args)
+        results = {
+            'revision': get_revision(),
+            'timestamp': time.time(),
+            'platform': platform.platform(),
+            'python_version': platform.python_version(),
+            'cpu_count': os.cpu_count(),
+            'config': dict(vars(args), env=extra_env),
+            'downloads': downloads,
+            'status': bench_status(base, args),
+            'serve': bench_serve(base, completed, monitor, args),
+            'dedup': bench_dedup(base, origin, workdir, args),
+            'origin_requests': OriginHandler.requests_served
+        }
+        monitor.stop()
+        results['peak_rss_bytes'] = monitor.peak_rss
+    finally:
+        monitor.stop()
+        process.terminate()
+        process.wait()
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    output = json.dumps(results, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,6 @@
+#!/bin/sh
+# Web processes serve and queue, worker.py downloads and is restarted whenever it exits
+export DOWNLOAD_MODE=queue
+(while true; do python worker.py; echo "worker.py exited with status $?, restarting" >&2; sleep 1; done) &
+# Threads, not greenlets: the state store, hashing and psutil all block in C calls
+exec gunicorn --bind 0.0.0.0:${PORT:-5000} --worker-class gthread --threads ${WEB_THREADS:-64} --workers ${WEB_CONCURRENCY:-2} app:app
@@ -0,0 +1,533 @@
+import json
+import sqlite3
+import threading
+import time
+import uuid
+
+ACTIVE_STATUSES = ('queued', 'starting', 'downloading')
+TERMINAL_STATUSES = ('completed', 'failed', 'duplicate')
+MAX_DELETION_VERSIONS = 100000
+HASH_ENTRY_FIELDS = ('hash', 'size', 'mtime', 'crc32')
+
+def open_connection(local, path):
+    # One per thread for its lifetime, web and worker threads are long-lived
+    conn = getattr(local, 'conn', None)
+    if conn is None:
+        conn = sqlite3.connect(path, timeout=30)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        local.conn = conn
+    return conn
+
+class MemoryStateStore:
+    def __init__(self):
+        # Downloads and mappings live in the app's tables, the hash index and folder totals have no other home
+        self.file_hashes = {}
+        self.folder_totals = (0, 0)
+        self.folder_lock = threading.Lock()
+
+    def load_downloads(self, limit):
+        return {}
+
+    def get_download(self, filename):
+        return None
+
+    def save_download(self, filename, record):
+        pass
+
+    def delete_download(self, filename):
+        pass
+
+    def filenames(self, statuses=None):
+        return []
+
+    def find_downloads(self, url):
+        return []
+
+    def load_mappings(self, filenames):
+        return {}
+
+    def get_mapping(self, filename):
+        return None
+
+    def find_mapping(self, custom_url):
+        return None
+
+    def save_mapping(self, filename, custom_url):
+        pass
+
+    def delete_mapping(self, filename):
+        pass
+
+    def flush(self):
+        pass
+
+    def unflushed_downloads(self):
+        return {}
+
+    def latest_version(self):
+        return 0
+
+    def changes_since(self, version):
+        return version, {}, []
+
+    def get_file_hash(self, filename):
+        return self.file_hashes.get(filename)
+
+    def find_file_hashes(self, file_hash):
+        return [(filename, entry) for filename, entry in list(self.file_hashes.items()) if entry['hash'] == file_hash]
+
+    def save_file_hashes(self, entries, replace=True):
+        for filename, entry in entries.items():
+            if replace or filename not in self.file_hashes:
+                self.file_hashes[filename] = entry
+
+    def delete_file_hash(self, filename):
+        self.file_hashes.pop(filename, None)
+
+    def rename_file_hash(self, old_filename, new_filename):
+        entry = self.file_hashes.pop(old_filename, None)
+        if entry is not None:
+            self.file_hashes[new_filename] = entry
+
+    def get_folder_totals(self):
+        return self.folder_totals
+
+    def set_folder_totals(self, size, count):
+        self.folder_totals = (size, count)
+
+    def adjust_folder_totals(self, size_delta, count_delta):
+        with self.folder_lock:
+            size, count = self.folder_totals
+            self.folder_totals = (max(size + size_delta, 0), max(count + count_delta, 0))
+
+class SQLiteStateStore(MemoryStateStore):
+    def __init__(self, path, flush_interval=1.0):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.wake = threading.Event()
+        # Writes are coalesced per key and committed in batches by the writer thread
+        self.pending_downloads = {}
+        self.pending_mappings = {}
+        self.flushing_downloads = {}
+        self.flushing_mappings = {}
+
+        with self.connect() as conn:
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS downloads (
+                    filename TEXT PRIMARY KEY,
+                    status TEXT,
+                    url TEXT,
+                    updated_at REAL,
+                    record TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS downloads_by_status ON downloads (status);
+                CREATE INDEX IF NOT EXISTS downloads_by_updated ON downloads (updated_at);
+                CREATE TABLE IF NOT EXISTS file_mappings (
+                    filename TEXT PRIMARY KEY,
+                    custom_url TEXT NOT NULL UNIQUE
+                );
+                CREATE TABLE IF NOT EXISTS change_batches (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT
+                );
+                CREATE TABLE IF NOT EXISTS download_deletions (
+                    filename TEXT PRIMARY KEY,
+                    version INTEGER NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS file_hashes (
+                    filename TEXT PRIMARY KEY,
+                    hash TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    mtime REAL NOT NULL,
+                    crc32 INTEGER
+                );
+                CREATE INDEX IF NOT EXISTS file_hashes_by_hash ON file_hashes (hash);
+                CREATE TABLE IF NOT EXISTS folder_totals (
+                    id INTEGER PRIMARY KEY CHECK (id = 1),
+                    size INTEGER NOT NULL,
+                    count INTEGER NOT NULL
+                );
+                INSERT OR IGNORE INTO folder_totals (id, size, count) VALUES (1, 0, 0);
+                CREATE TABLE IF NOT EXISTS store_info (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL
+                );
+            """)
+            # Versions count this database's change batches, the id tells them apart from another database's
+            conn.execute("INSERT OR IGNORE INTO store_info (key, value) VALUES ('id', ?)", (uuid.uuid4().hex[:12],))
+            self.store_id = conn.execute("SELECT value FROM store_info WHERE key = 'id'").fetchone()[0]
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(downloads)")]
+            if 'version' not in columns:
+                conn.execute("ALTER TABLE downloads ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+            conn.execute("CREATE INDEX IF NOT EXISTS downloads_by_version ON downloads (version)")
+            conn.execute("CREATE INDEX IF NOT EXISTS downloads_by_url ON downloads (url)")
+
+        threading.Thread(target=self._writer, daemon=True).start()
+
+    def connect(self):
+        return open_connection(self.local, self.path)
+
+    def _writer(self):
+        while True:
+            self.wake.wait(self.flush_interval)
+            self.wake.clear()
+            try:
+                self.flush()
+            except sqlite3.Error:
+                time.sleep(self.flush_interval)
+
+    def _pending(self, pending, flushing, key):
+        # Returns (found, value) so readers see writes that have not been committed yet
+        with self.lock:
+            if key in pending:
+                return True, pending[key]
+            if key in flushing:
+                return True, flushing[key]
+        return False, None
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                self.flushing_downloads, self.pending_downloads = self.pending_downloads, {}
+                self.flushing_mappings, self.pending_mappings = self.pending_mappings, {}
+                downloads = self.flushing_downloads
+                mappings = self.flushing_mappings
+            if not downloads and not mappings:
+                return
+            now = time.time()
+            conn = self.connect()
+            try:
+                self._write(conn, now, downloads, mappings)
+            except sqlite3.Error:
+                # Put the batch back so a later flush retries it, unless newer writes replaced it
+                with self.lock:
+                    for filename, record in downloads.items():
+                        self.pending_downloads.setdefault(filename, record)
+                    for filename, custom_url in mappings.items():
+                        self.pending_mappings.setdefault(filename, custom_url)
+                raise
+            finally:
+                with self.lock:
+                    self.flushing_downloads = {}
+                    self.flushing_mappings = {}
+
+    def _write(self, conn, now, downloads, mappings):
+        with conn:
+            # Every batch gets a new version so other processes can pull only what changed
+            version = conn.execute("INSERT INTO change_batches DEFAULT VALUES").lastrowid
+            conn.execute("DELETE FROM change_batches WHERE id < ?", (version,))
+            saved = [(filename, record) for filename, record in downloads.items() if record is not None]
+            deleted = [(filename,) for filename, record in downloads.items() if record is None]
+            conn.executemany(
+                "INSERT OR REPLACE INTO downloads (filename, status, url, updated_at, record, version) VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (filename, record.get('status'), record.get('url'), now, json.dumps(record), version)
+                    for filename, record in saved
+                ]
+            )
+            conn.executemany("DELETE FROM download_deletions WHERE filename = ?", [(filename,) for filename, _ in saved])
+            conn.executemany("DELETE FROM downloads WHERE filename = ?", deleted)
+            conn.executemany(
+                "INSERT OR REPLACE INTO download_deletions (filename, version) VALUES (?, ?)",
+                [(filename, version) for filename, in deleted]
+            )
+            if version % 1000 == 0:
+                conn.execute("DELETE FROM download_deletions WHERE version < ?", (version - MAX_DELETION_VERSIONS,))
+            conn.executemany(
+                "INSERT OR REPLACE INTO file_mappings (filename, custom_url) VALUES (?, ?)",
+                [(filename, custom_url) for filename, custom_url in mappings.items() if custom_url is not None]
+            )
+            conn.executemany(
+                "DELETE FROM file_mappings WHERE filename = ?",
+                [(filename,) for filename, custom_url in mappings.items() if custom_url is None]
+            )
+
+    def latest_version(self):
+        row = self.connect().execute("SELECT MAX(id) FROM change_batches").fetchone()
+        return row[0] or 0
+
+    def changes_since(self, version):
+        conn = self.connect()
+        with self.lock:
+            local = set(self.pending_downloads) | set(self.flushing_downloads)
+        # Read both tables from one snapshot
+        conn.execute("BEGIN")
+        try:
+            rows = conn.execute(
+                "SELECT filename, record, version FROM downloads WHERE version > ?", (version,)
+            ).fetchall()
+            deletions = conn.execute(
+                "SELECT filename, version FROM download_deletions WHERE version > ?", (version,)
+            ).fetchall()
+        finally:
+            conn.commit()
+        latest = max([version] + [row[2] for row in rows] + [row[1] for row in deletions])
+        records = {filename: json.loads(record) for filename, record, _ in rows if filename not in local}
+        deleted = [filename for filename, _ in deletions if filename not in local]
+        return latest, records, deleted
+
+    def load_downloads(self, limit):
+        placeholders = ', '.join('?' * len(ACTIVE_STATUSES))
+        rows = self.connect().execute(f"""
+            SELECT filename, record, updated_at FROM downloads WHERE status IN ({placeholders})
+            UNION ALL
+            SELECT * FROM (
+                SELECT filename, record, updated_at FROM downloads WHERE status NOT IN ({placeholders})
+                ORDER BY updated_at DESC LIMIT ?
+            )
+        """, ACTIVE_STATUSES + ACTIVE_STATUSES + (limit,)).fetchall()
+        rows.sort(key=lambda row: row[2])
+        return {filename: json.loads(record) for filename, record, _ in rows}
+
+    def get_download(self, filename):
+        found, record = self._pending(self.pending_downloads, self.flushing_downloads, filename)
+        if found:
+            return record
+        row = self.connect().execute("SELECT record FROM downloads WHERE filename = ?", (filename,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def save_download(self, filename, record):
+        with self.lock:
+            self.pending_downloads[filename] = record
+        if record.get('status') in TERMINAL_STATUSES:
+            self.wake.set()
+
+    def delete_download(self, filename):
+        with self.lock:
+            self.pending_downloads[filename] = None
+        self.wake.set()
+
+    def unflushed_downloads(self):
+        # Written but not yet committed, None for a deletion
+        with self.lock:
+            changed = dict(self.flushing_downloads)
+            changed.update(self.pending_downloads)
+        return changed
+
+    def filenames(self, statuses=None):
+        # Read before the rows, a batch committed in between is already in changed
+        changed = self.unflushed_downloads()
+        conn = self.connect()
+        if statuses is None:
+            rows = conn.execute("SELECT filename FROM downloads")
+        else:
+            placeholders = ', '.join('?' * len(statuses))
+            rows = conn.execute(f"SELECT filename FROM downloads WHERE status IN ({placeholders})", tuple(statuses))
+        names = [row[0] for row in rows if row[0] not in changed]
+        return names + [
+            filename for filename, record in changed.items()
+            if record is not None and (statuses is None or record.get('status') in statuses)
+        ]
+
+    def find_downloads(self, url):
+        changed = self.unflushed_downloads()
+        found = [filename for filename, record in changed.items() if record is not None and record.get('url') == url]
+        rows = self.connect().execute("SELECT filename FROM downloads WHERE url = ? ORDER BY updated_at DESC", (url,))
+        return found + [row[0] for row in rows if row[0] not in changed]
+
+    def load_mappings(self, filenames):
+        filenames = list(filenames)
+        mappings = {}
+        conn = self.connect()
+        for i in range(0, len(filenames), 500):
+            batch = filenames[i:i + 500]
+            placeholders = ', '.join('?' * len(batch))
+            rows = conn.execute(f"SELECT filename, custom_url FROM file_mappings WHERE filename IN ({placeholders})", batch)
+            mappings.update(rows)
+        return mappings
+
+    def get_mapping(self, filename):
+        found, custom_url = self._pending(self.pending_mappings, self.flushing_mappings, filename)
+        if found:
+            return custom_url
+        row = self.connect().execute("SELECT custom_url FROM file_mappings WHERE filename = ?", (filename,)).fetchone()
+        return row[0] if row else None
+
+    def find_mapping(self, custom_url):
+        with self.lock:
+            changed = dict(self.flushing_mappings)
+            changed.update(self.pending_mappings)
+        for filename, pending_url in changed.items():
+            if pending_url == custom_url:
+                return filename
+        row = self.connect().execute("SELECT filename FROM file_mappings WHERE custom_url = ?", (custom_url,)).fetchone()
+        if row and row[0] not in changed:
+            return row[0]
+        return None
+
+    def save_mapping(self, filename, custom_url):
+        with self.lock:
+            self.pending_mappings[filename] = custom_url
+        self.wake.set()
+
+    def delete_mapping(self, filename):
+        with self.lock:
+            self.pending_mappings[filename] = None
+        self.wake.set()
+
+    # Hash index entries are written straight through, every process deduplicates against the same rows
+
+    def get_file_hash(self, filename):
+        row = self.connect().execute(
+            "SELECT hash, size, mtime, crc32 FROM file_hashes WHERE filename = ?", (filename,)
+        ).fetchone()
+        return dict(zip(HASH_ENTRY_FIELDS, row)) if row else None
+
+    def find_file_hashes(self, file_hash):
+        rows = self.connect().execute(
+            "SELECT filename, hash, size, mtime, crc32 FROM file_hashes WHERE hash = ?", (file_hash,)
+        )
+        return [(row[0], dict(zip(HASH_ENTRY_FIELDS, row[1:]))) for row in rows]
+
+    def save_file_hashes(self, entries, replace=True):
+        with self.connect() as conn:
+            conn.executemany(
+                f"INSERT OR {'REPLACE' if replace else 'IGNORE'} INTO file_hashes (filename, hash, size, mtime, crc32) VALUES (?, ?, ?, ?, ?)",
+                [(filename, entry['hash'], entry['size'], entry['mtime'], entry.get('crc32')) for filename, entry in entries.items()]
+            )
+
+    def delete_file_hash(self, filename):
+        with self.connect() as conn:
+            conn.execute("DELETE FROM file_hashes WHERE filename = ?", (filename,))
+
+    def rename_file_hash(self, old_filename, new_filename):
+        with self.connect() as conn:
+            conn.execute("DELETE FROM file_hashes WHERE filename = ?", (new_filename,))
+            conn.execute("UPDATE file_hashes SET filename = ? WHERE filename = ?", (new_filename, old_filename))
+
+    def get_folder_totals(self):
+        return self.connect().execute("SELECT size, count FROM folder_totals").fetchone()
+
+    def set_folder_totals(self, size, count):
+        with self.connect() as conn:
+            conn.execute("UPDATE folder_totals SET size = ?, count = ?", (size, count))
+
+    def adjust_folder_totals(self, size_delta, count_delta):
+        # One statement, so deltas from several processes all land
+        with self.connect() as conn:
+            conn.execute(
+                "UPDATE folder_totals SET size = MAX(size + ?, 0), count = MAX(count + ?, 0)",
+                (size_delta, count_delta)
+            )
+
+class SQLiteJobQueue:
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        with self.connect() as conn:
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    save_filename TEXT NOT NULL UNIQUE,
+                    url TEXT NOT NULL,
+                    original_name TEXT NOT NULL,
+                    host TEXT NOT NULL,
+                    priority INTEGER NOT NULL DEFAULT 0,
+                    queued_at REAL NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    lease_owner TEXT,
+                    lease_expires REAL
+                );
+                CREATE INDEX IF NOT EXISTS jobs_by_priority ON jobs (priority DESC, id);
+                CREATE INDEX IF NOT EXISTS jobs_by_lease ON jobs (lease_expires);
+            """)
+
+    def connect(self):
+        return open_connection(self.local, self.path)
+
+    def enqueue(self, url, save_filename, original_name, host, priority=0, held_by=None, hold_seconds=0):
+        # A held job is leased to its submitter, no worker claims it until it is released or the hold runs out
+        now = time.time()
+        try:
+            with self.connect() as conn:
+                cursor = conn.execute(
+                    "INSERT INTO jobs (save_filename, url, original_name, host, priority, queued_at, lease_owner, lease_expires) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (save_filename, url, original_name, host, priority, now, held_by, now + hold_seconds if held_by else None)
+                )
+            return cursor.lastrowid
+        except sqlite3.IntegrityError:
+            return None
+
+    def release(self, job_id, owner):
+        with self.connect() as conn:
+            conn.execute("UPDATE jobs SET lease_owner = NULL, lease_expires = NULL WHERE id = ? AND lease_owner = ?", (job_id, owner))
+
+    def is_pending(self, save_filename):
+        return self.get_url(save_filename) is not None
+
+    def get_url(self, save_filename):
+        row = self.connect().execute("SELECT url FROM jobs WHERE save_filename = ?", (save_filename,)).fetchone()
+        return row[0] if row else None
+
+    def claim(self, owner, lease_seconds, per_host):
+        now = time.time()
+        conn = self.connect()
+        # BEGIN IMMEDIATE takes the write lock up front so two workers never claim the same job
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            busy = [row[0] for row in conn.execute(
+                "SELECT host FROM jobs WHERE lease_expires >= ? GROUP BY host HAVING COUNT(*) >= ?", (now, per_host)
+            )]
+            host_filter = f"AND host NOT IN ({', '.join('?' * len(busy))})" if busy else ""
+            row = conn.execute(f"""
+                SELECT id, url, save_filename, original_name, host, priority, queued_at, attempts FROM jobs
+                WHERE (lease_expires IS NULL OR lease_expires < ?) {host_filter}
+                ORDER BY priority DESC, id LIMIT 1
+            """, [now] + busy).fetchone()
+            if row:
+                conn.execute(
+                    "UPDATE jobs SET lease_owner = ?, lease_expires = ?, attempts = attempts + 1 WHERE id = ?",
+                    (owner, now + lease_seconds, row[0])
+                )
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        if row is None:
+            return None
+        keys = ('id', 'url', 'save_filename', 'original_name', 'host', 'priority', 'queued_at', 'attempts')
+        return dict(zip(keys, row))
+
+    def heartbeat(self, job_id, owner, lease_seconds):
+        with self.connect() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET lease_expires = ? WHERE id = ? AND lease_owner = ?",
+                (time.time() + lease_seconds, job_id, owner)
+            )
+        return cursor.rowcount == 1
+
+    def complete(self, job_id, owner):
+        with self.connect() as conn:
+            conn.execute("DELETE FROM jobs WHERE id = ? AND lease_owner = ?", (job_id, owner))
+
+    def stats(self):
+        now = time.time()
+        hosts = {}
+        rows = self.connect().execute("""
+            SELECT host,
+                   SUM(CASE WHEN lease_expires >= ? THEN 0 ELSE 1 END),
+                   SUM(CASE WHEN lease_expires >= ? THEN 1 ELSE 0 END),
+                   MIN(CASE WHEN lease_expires >= ? THEN NULL ELSE queued_at END)
+            FROM jobs GROUP BY host
+        """, (now, now, now))
+        for host, queued, running, oldest in rows:
+            hosts[host] = {
+                'queued': queued,
+                'running': running,
+                'oldest_wait': round(now - oldest, 3) if oldest else 0
+            }
+        return {
+            'running': sum(host['running'] for host in hosts.values()),
+            'queued': sum(host['queued'] for host in hosts.values()),
+            'hosts': hosts
+        }
+
+def create_state_store(backend, path, flush_interval):
+    if backend == 'memory':
+        return MemoryStateStore()
+    if backend == 'sqlite':
+        return SQLiteStateStore(path, flush_interval)
+    raise ValueError(f"Unknown state backend: {backend}")
@@ -0,0 +1,8 @@
+import os
+import sys
+import tempfile
+
+# app creates its download folder and state database in the working directory when imported
+os.chdir(tempfile.mkdtemp(prefix='fdl-tests-'))
+os.environ.setdefault('STATE_BACKEND', 'memory')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
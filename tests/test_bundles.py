@@ -0,0 +1,88 @@
+import io
+import os
+import struct
+import tarfile
+import zipfile
+import zlib
+
+import pytest
+
+import app
+
+@pytest.fixture
+def stored_files():
+    files = {'known.bin': os.urandom(70000), 'unknown.txt': b'hello bundle\n' * 100, 'empty.bin': b''}
+    for name, data in files.items():
+        with open(os.path.join(app.UPLOAD_FOLDER, name), 'wb') as f:
+            f.write(data)
+    # One entry with its CRC on record, the others get theirs computed into a data descriptor
+    app.index_file_hash('known.bin', 'unused', zlib.crc32(files['known.bin']))
+    yield files
+    for name in files:
+        app.remove_file_hash(name)
+        os.remove(os.path.join(app.UPLOAD_FOLDER, name))
+
+def fetch_bundle(names, archive_format):
+    response = app.app.test_client().get('/bundle', query_string={'files': ','.join(names), 'format': archive_format})
+    assert response.status_code == 200
+    body = response.get_data()
+    assert len(body) == response.content_length
+    return body
+
+def test_zip_bundle(stored_files):
+    body = fetch_bundle(list(stored_files), 'zip')
+    with zipfile.ZipFile(io.BytesIO(body)) as archive:
+        assert archive.testzip() is None
+        assert archive.namelist() == list(stored_files)
+        for name, data in stored_files.items():
+            assert archive.read(name) == data
+        flags = {info.filename: info.flag_bits for info in archive.infolist()}
+    assert not flags['known.bin'] & 0x08
+    assert flags['unknown.txt'] & 0x08
+
+def test_tar_bundle(stored_files):
+    body = fetch_bundle(list(stored_files), 'tar')
+    with tarfile.open(fileobj=io.BytesIO(body)) as archive:
+        assert archive.getnames() == list(stored_files)
+        for name, data in stored_files.items():
+            assert archive.extractfile(name).read() == data
+
+def test_missing_files_are_reported(stored_files):
+    response = app.app.test_client().get('/bundle', query_string={'files': 'known.bin,nope.bin'})
+    assert response.status_code == 404
+    assert response.get_json()['missing'] == ['nope.bin']
+
+def large_entry(descriptor=False, offset=0):
+    return {'name': 'large.bin', 'size': app.ZIP64_LIMIT + 10, 'mtime': 1700000000, 'crc32': 1234,
+            'descriptor': descriptor, 'offset': offset}
+
+def test_zip64_local_header():
+    header = app.zip_local_header(large_entry())
+    fields = struct.unpack('<IHHHHHIIIHH', header[:30])
+    assert fields[1] == 45
+    assert fields[7] == fields[8] == app.ZIP64_LIMIT
+    extra = header[30 + fields[9]:]
+    assert struct.unpack('<HHQQ', extra) == (1, 16, app.ZIP64_LIMIT + 10, app.ZIP64_LIMIT + 10)
+
+def test_zip64_descriptor_has_8_byte_sizes():
+    descriptor = app.zip_descriptor(large_entry(descriptor=True))
+    assert struct.unpack('<IIQQ', descriptor) == (0x08074b50, 1234, app.ZIP64_LIMIT + 10, app.ZIP64_LIMIT + 10)
+
+def test_zip64_central_header_moves_sizes_and_offset_to_extra():
+    header = app.zip_central_header(large_entry(offset=app.ZIP64_LIMIT + 5))
+    fields = struct.unpack('<IHHHHHHIIIHHHHHII', header[:46])
+    assert fields[8] == fields[9] == fields[16] == app.ZIP64_LIMIT
+    extra = header[46 + fields[10]:]
+    assert struct.unpack('<HH3Q', extra) == (1, 24, app.ZIP64_LIMIT + 10, app.ZIP64_LIMIT + 10, app.ZIP64_LIMIT + 5)
+
+def test_zip64_end_records():
+    cd_offset = app.ZIP64_LIMIT + 100
+    end = app.zip_end(3, cd_offset, 200)
+    record = struct.unpack('<IQHHIIQQQQ', end[:56])
+    assert record[0] == 0x06064b50 and record[6:] == (3, 3, 200, cd_offset)
+    locator = struct.unpack('<IIQI', end[56:76])
+    assert locator == (0x07064b50, 0, cd_offset + 200, 1)
+    eocd = struct.unpack('<IHHHHIIH', end[76:])
+    assert eocd[6] == app.ZIP64_LIMIT
+    # Small archives keep the plain end record only
+    assert len(app.zip_end(3, 1000, 200)) == 22
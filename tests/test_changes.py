@@ -0,0 +1,132 @@
+import threading
+import time
+
+import app
+import state
+
+def put(name):
+    app.downloads_status[name] = {'status': 'queued', 'progress': 0, 'size': 0, 'downloaded': 0, 'url': f'http://example.com/{name}'}
+
+def test_cursor_returns_only_newer_changes():
+    client = app.app.test_client()
+    put('first.bin')
+    cursor = client.get('/api/downloads', query_string={'since': 'unknown.0'}).get_json()['version']
+    put('second.bin')
+    data = client.get('/api/downloads', query_string={'since': cursor}).get_json()
+    assert not data['reset']
+    assert list(data['downloads']) == ['second.bin']
+    assert client.get('/api/downloads', query_string={'since': data['version']}).get_json()['downloads'] == {}
+
+def test_cursor_from_another_process_resets():
+    client = app.app.test_client()
+    put('third.bin')
+    version = app.downloads_status.version
+    for since in (f'otherepoch.{version}', str(version), f'{app.downloads_status.epoch}.{version + 5}'):
+        data = client.get('/api/downloads', query_string={'since': since}).get_json()
+        assert data['reset'] and 'third.bin' in data['downloads']
+
+def test_poll_honours_last_event_id():
+    client = app.app.test_client()
+    put('fourth.bin')
+    cursor = app.downloads_status.cursor()
+    put('fifth.bin')
+    data = client.get('/events', query_string={'poll': 1, 'since': 'stale.0'}, headers={'Last-Event-ID': cursor}).get_json()
+    assert not data['reset'] and list(data['downloads']) == ['fifth.bin']
+    assert client.get('/events', query_string={'poll': 1, 'since': 'stale.0'}).get_json()['reset']
+
+def test_list_etag_changes_with_epoch():
+    client = app.app.test_client()
+    etag = client.get('/downloads/list').headers['ETag']
+    assert client.get('/downloads/list', headers={'If-None-Match': etag}).status_code == 304
+    epoch = app.downloads_status.epoch
+    app.downloads_status.new_epoch()
+    try:
+        assert client.get('/downloads/list', headers={'If-None-Match': etag}).status_code == 200
+    finally:
+        app.downloads_status.epoch = epoch
+
+def test_event_streams_are_capped(monkeypatch):
+    monkeypatch.setattr(app, 'event_waiters', threading.BoundedSemaphore(1))
+    client = app.app.test_client()
+    stream = client.get('/events', buffered=False)
+    assert stream.status_code == 200
+    assert client.get('/events').status_code == 503
+    # A poll with no slot left is answered without waiting for a change
+    started = time.monotonic()
+    client.get('/events', query_string={'poll': 1, 'since': app.downloads_status.cursor()})
+    assert time.monotonic() - started < 1
+    stream.close()
+    assert client.get('/events', buffered=False).status_code == 200
+
+def test_event_stream_ends_after_its_time(monkeypatch):
+    monkeypatch.setattr(app, 'EVENTS_STREAM_SECONDS', 0)
+    body = app.app.test_client().get('/events').get_data(as_text=True)
+    assert body == 'retry: 2000\n\n'
+
+def test_item_html_follows_custom_url():
+    client = app.app.test_client()
+    app.downloads_status['mapped.bin'] = {'status': 'completed', 'progress': 100, 'size': 1, 'downloaded': 1}
+    assert 'download/my-link' not in client.get('/downloads/list').get_data(as_text=True)
+    app.file_mappings['mapped.bin'] = 'my-link'
+    assert 'download/my-link' in client.get('/downloads/list', headers={'Cache-Control': 'no-cache'}).get_data(as_text=True)
+
+def test_custom_url_on_queued_entry_is_a_change():
+    url = 'http://example.com/queued.bin'
+    app.downloads_status['queued.bin'] = {'status': 'downloading', 'progress': 0, 'size': 0, 'downloaded': 0, 'url': url}
+    cursor = app.downloads_status.cursor()
+    assert app.submit_download(url, custom_url='queued-link') == ('queued.bin', False)
+    data = app.app.test_client().get('/api/downloads', query_string={'since': cursor}).get_json()
+    assert list(data['downloads']) == ['queued.bin']
+
+def test_states_are_filtered_before_paging():
+    client = app.app.test_client()
+    cursor = app.downloads_status.cursor()
+    for name, status in (('page-a.bin', 'queued'), ('page-b.bin', 'failed'), ('page-c.bin', 'queued')):
+        app.downloads_status[name] = {'status': status, 'progress': 0, 'size': 0, 'downloaded': 0}
+    data = client.get('/api/downloads', query_string={'since': cursor, 'state': 'queued', 'limit': 1}).get_json()
+    assert list(data['downloads']) == ['page-a.bin'] and data['total'] == 2 and data['next_offset'] == 1
+    data = client.get('/api/downloads', query_string={'ids': 'page-a.bin,page-b.bin,page-c.bin', 'state': 'queued', 'limit': 1, 'offset': 1}).get_json()
+    assert list(data['downloads']) == ['page-c.bin'] and data['total'] == 2 and data['next_offset'] is None
+
+def shared_table(path):
+    table = app.DownloadStatusTable()
+    table.attach(state.SQLiteStateStore(path, flush_interval=3600), 100)
+    table.share()
+    return table
+
+def test_shared_cursor_continues_in_another_process(tmp_path):
+    # Two web processes on one store, a client's polls may land on either
+    first, second = shared_table(str(tmp_path / 'state.db')), shared_table(str(tmp_path / 'state.db'))
+    first['a.bin'] = {'status': 'queued'}
+    first.store.flush()
+    cursor = first.cursor()
+    assert second.parse_cursor(cursor) is not None
+    second['b.bin'] = {'status': 'queued'}
+    version, changed, removed, reset = second.changes_since(second.parse_cursor(cursor))
+    # Not committed yet, sent from the writing process's pending batch
+    assert not reset and list(changed) == ['b.bin']
+    assert first.changes_since(first.parse_cursor(cursor))[1] == {}
+    second.store.flush()
+    version, changed, removed, reset = first.changes_since(first.parse_cursor(cursor))
+    assert not reset and list(changed) == ['b.bin']
+    del first['a.bin']
+    first.store.flush()
+    version, changed, removed, reset = second.changes_since(version)
+    assert not reset and changed == {} and removed == ['a.bin']
+    assert second.changes_since(version + 1)[3]
+    assert second.wait_for_change(version - 1, 0.1) and not second.wait_for_change(second.current_version(), 0.1)
+
+def test_store_keeps_the_tables_last_write(tmp_path):
+    table = app.DownloadStatusTable()
+    table.attach(state.SQLiteStateStore(str(tmp_path / 'state.db'), flush_interval=3600), 100)
+
+    def update(writer):
+        for n in range(2000):
+            table['race.bin'] = {'status': 'downloading', 'writer': writer, 'n': n}
+
+    threads = [threading.Thread(target=update, args=(writer,)) for writer in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert table.store.get_download('race.bin') == table['race.bin']
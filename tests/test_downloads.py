@@ -0,0 +1,105 @@
+import hashlib
+import os
+import time
+
+import pytest
+
+import app
+import state
+
+def write(name, data):
+    path = os.path.join(app.UPLOAD_FOLDER, name)
+    with open(path, 'wb') as f:
+        f.write(data)
+    return path
+
+def finish(name, data, url):
+    path = os.path.join(app.UPLOAD_FOLDER, name)
+    write(os.path.basename(app.get_part_path(path)), data)
+    app.finish_download(url, name, name, path, hashlib.md5(data).hexdigest(), len(data), time.time(), {}, {'etag': '"new"'})
+
+@pytest.fixture
+def cleanup():
+    names = []
+    yield names
+    for name in names:
+        app.downloads_status.pop(name, None)
+        app.remove_file_hash(name)
+        if os.path.exists(os.path.join(app.UPLOAD_FOLDER, name)):
+            os.remove(os.path.join(app.UPLOAD_FOLDER, name))
+
+def test_new_download_matching_another_file_is_a_duplicate(cleanup):
+    cleanup += ['orig.bin', 'copy.bin']
+    write('orig.bin', b'same body')
+    app.index_file_hash('orig.bin', hashlib.md5(b'same body').hexdigest())
+    finish('copy.bin', b'same body', 'http://example.com/copy.bin')
+    assert app.downloads_status['copy.bin']['status'] == 'duplicate'
+    assert not os.path.exists(os.path.join(app.UPLOAD_FOLDER, 'copy.bin'))
+
+def test_revalidated_file_is_replaced_not_marked_duplicate(cleanup):
+    cleanup += ['other.bin', 'served.bin']
+    write('other.bin', b'new body')
+    app.index_file_hash('other.bin', hashlib.md5(b'new body').hexdigest())
+    write('served.bin', b'old body')
+    url = 'http://example.com/served.bin'
+    app.downloads_status['served.bin'] = {'status': 'completed', 'url': url, 'original_name': 'served.bin', 'revalidating': True}
+    finish('served.bin', b'new body', url)
+    record = app.downloads_status['served.bin']
+    assert record['status'] == 'completed' and record['etag'] == '"new"' and 'revalidating' not in record
+    with open(os.path.join(app.UPLOAD_FOLDER, 'served.bin'), 'rb') as f:
+        assert f.read() == b'new body'
+    assert not os.path.exists(app.get_part_path(os.path.join(app.UPLOAD_FOLDER, 'served.bin')))
+
+def test_disk_writer_batches_aligned_writes(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, 'WRITE_BATCH_SIZE', 64 * 1024)
+    monkeypatch.setattr(app, 'WRITE_LINGER', 60)
+    writes = []
+    write_at = app.write_at
+    monkeypatch.setattr(app, 'write_at', lambda fd, offset, data: (writes.append((offset, len(data))), write_at(fd, offset, data)))
+    data = os.urandom(1000 * 1000)
+    with open(tmp_path / 'out.bin', 'wb') as f:
+        writer = app.DiskWriter(f.fileno())
+        for offset in range(0, len(data), 1000):
+            writer.write(offset, data[offset:offset + 1000])
+        writer.close()
+        block_size = writer.block_size
+    assert (tmp_path / 'out.bin').read_bytes() == data
+    # Only the tail left at close is short or unaligned
+    assert len(writes) < 20
+    for offset, size in writes[:-1]:
+        assert size >= app.WRITE_BATCH_SIZE - block_size and (offset + size) % block_size == 0
+
+def test_disk_writer_flushes_after_linger(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, 'WRITE_LINGER', 0.05)
+    written = []
+    with open(tmp_path / 'out.bin', 'wb') as f:
+        writer = app.DiskWriter(f.fileno(), lambda stream, end: written.append(end))
+        writer.write(0, b'partial')
+        # Below the batch size, it still reaches the file for readers tailing it
+        deadline = time.monotonic() + 2
+        while not written and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert written == [7]
+        writer.close()
+
+def test_restart_completes_finished_download_instead_of_requeuing(cleanup, monkeypatch, tmp_path):
+    cleanup += ['landed.bin', 'partial.bin']
+    # The memory backend keeps no list of active records to resume from
+    store = state.SQLiteStateStore(str(tmp_path / 'state.db'), flush_interval=3600)
+    monkeypatch.setattr(app, 'state_store', store)
+    monkeypatch.setattr(app.downloads_status, 'store', store)
+    queued = []
+    monkeypatch.setattr(app, 'queue_download', lambda url, save_filename, *args, **kwargs: queued.append(save_filename))
+    write('landed.bin', b'whole body')
+    write('partial.bin', b'old body')
+    write(os.path.basename(app.get_part_path(os.path.join(app.UPLOAD_FOLDER, 'partial.bin'))), b'new')
+    for name in cleanup:
+        app.downloads_status[name] = {'status': 'downloading', 'url': 'http://example.com/' + name, 'original_name': name}
+    try:
+        app.resume_pending_downloads()
+    finally:
+        os.remove(app.get_part_path(os.path.join(app.UPLOAD_FOLDER, 'partial.bin')))
+    record = app.downloads_status['landed.bin']
+    assert record['status'] == 'completed' and record['size'] == len(b'whole body')
+    assert record['hash'] == hashlib.md5(b'whole body').hexdigest()
+    assert queued == ['partial.bin']
@@ -0,0 +1,49 @@
+import os
+
+import pytest
+
+import app
+
+@pytest.fixture
+def stored_file():
+    data = bytes(range(256)) * 4
+    path = os.path.join(app.UPLOAD_FOLDER, 'ranges.bin')
+    with open(path, 'wb') as f:
+        f.write(data)
+    yield 'ranges.bin', data
+    os.remove(path)
+
+def test_overlapping_and_adjacent_ranges_merge():
+    assert app.get_byte_ranges([(0, 10), (5, 20), (20, 30)], 100) == [[0, 30]]
+
+def test_ranges_are_sorted():
+    assert app.get_byte_ranges([(50, 60), (0, 10)], 100) == [[0, 10], [50, 60]]
+
+def test_open_ended_and_suffix_ranges():
+    assert app.get_byte_ranges([(90, None)], 100) == [[90, 100]]
+    assert app.get_byte_ranges([(-10, None)], 100) == [[90, 100]]
+    assert app.get_byte_ranges([(-500, None)], 100) == [[0, 100]]
+
+def test_ranges_are_clamped_to_the_file():
+    assert app.get_byte_ranges([(90, 200)], 100) == [[90, 100]]
+
+def test_unsatisfiable_ranges_are_dropped():
+    assert app.get_byte_ranges([(100, 200), (150, None)], 100) == []
+    assert app.get_byte_ranges([(0, 10)], 0) == []
+
+def test_multiple_ranges_are_sent_as_multipart(stored_file):
+    filename, data = stored_file
+    response = app.app.test_client().get(f'/download/{filename}', headers={'Range': 'bytes=0-9,100-109'})
+    assert response.status_code == 206
+    assert response.mimetype == 'multipart/byteranges'
+    body = response.get_data()
+    assert response.content_length == len(body)
+    assert b'Content-Range: bytes 0-9/1024\r\n\r\n' + data[0:10] in body
+    assert b'Content-Range: bytes 100-109/1024\r\n\r\n' + data[100:110] in body
+
+def test_adjacent_ranges_collapse_to_one_part(stored_file):
+    filename, data = stored_file
+    response = app.app.test_client().get(f'/download/{filename}', headers={'Range': 'bytes=0-9,10-19'})
+    assert response.status_code == 206
+    assert response.headers['Content-Range'] == 'bytes 0-19/1024'
+    assert response.get_data() == data[:20]
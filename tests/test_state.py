@@ -0,0 +1,203 @@
+import sqlite3
+import time
+
+import pytest
+
+import state
+
+@pytest.fixture
+def store(tmp_path):
+    return state.SQLiteStateStore(str(tmp_path / 'state.db'), flush_interval=3600)
+
+@pytest.fixture
+def job_queue(tmp_path):
+    return state.SQLiteJobQueue(str(tmp_path / 'state.db'))
+
+def test_downloads_round_trip(store, tmp_path):
+    store.save_download('a.bin', {'status': 'completed', 'url': 'http://example.com/a.bin'})
+    store.save_download('b.bin', {'status': 'queued', 'url': 'http://example.com/b.bin'})
+    # Visible before the batch is committed
+    assert store.get_download('b.bin')['status'] == 'queued'
+    store.flush()
+
+    reopened = state.SQLiteStateStore(str(tmp_path / 'state.db'))
+    assert reopened.get_download('a.bin') == {'status': 'completed', 'url': 'http://example.com/a.bin'}
+    assert sorted(reopened.filenames()) == ['a.bin', 'b.bin']
+    assert reopened.filenames(('queued',)) == ['b.bin']
+    assert reopened.find_downloads('http://example.com/a.bin') == ['a.bin']
+
+    store.delete_download('a.bin')
+    assert store.get_download('a.bin') is None
+    store.flush()
+    assert reopened.get_download('a.bin') is None
+
+def test_load_downloads_keeps_active_and_recent(store):
+    for i in range(5):
+        store.save_download(f'done{i}', {'status': 'completed'})
+        store.flush()
+    store.save_download('running', {'status': 'downloading'})
+    store.flush()
+    loaded = store.load_downloads(2)
+    assert set(loaded) == {'running', 'done3', 'done4'}
+
+def test_mappings_round_trip(store):
+    store.save_mapping('a.bin', 'latest')
+    assert store.find_mapping('latest') == 'a.bin'
+    store.flush()
+    assert store.get_mapping('a.bin') == 'latest'
+    assert store.load_mappings(['a.bin', 'b.bin']) == {'a.bin': 'latest'}
+    store.delete_mapping('a.bin')
+    assert store.find_mapping('latest') is None
+    store.flush()
+    assert store.get_mapping('a.bin') is None
+
+def test_changes_since(store):
+    start = store.latest_version()
+    store.save_download('a.bin', {'status': 'queued'})
+    store.save_download('b.bin', {'status': 'queued'})
+    store.flush()
+    version, records, deleted = store.changes_since(start)
+    assert version > start
+    assert set(records) == {'a.bin', 'b.bin'} and deleted == []
+
+    store.save_download('a.bin', {'status': 'completed'})
+    store.delete_download('b.bin')
+    store.flush()
+    newer, records, deleted = store.changes_since(version)
+    assert newer > version
+    assert records == {'a.bin': {'status': 'completed'}}
+    assert deleted == ['b.bin']
+    assert store.changes_since(newer) == (newer, {}, [])
+
+def test_changes_since_skips_local_writes(store):
+    # Records this process has not committed yet are newer than anything in the store
+    store.save_download('a.bin', {'status': 'queued'})
+    store.flush()
+    store.save_download('a.bin', {'status': 'downloading'})
+    _, records, _ = store.changes_since(0)
+    assert records == {}
+
+def test_filenames_include_unflushed_writes(store):
+    store.save_download('a.bin', {'status': 'completed'})
+    store.save_download('b.bin', {'status': 'completed'})
+    store.flush()
+    store.save_download('a.bin', {'status': 'queued'})
+    store.delete_download('b.bin')
+    store.save_download('c.bin', {'status': 'queued'})
+    assert sorted(store.filenames()) == ['a.bin', 'c.bin']
+    assert sorted(store.filenames(('queued',))) == ['a.bin', 'c.bin']
+    assert store.filenames(('completed',)) == []
+
+def test_store_id_is_kept(tmp_path):
+    path = str(tmp_path / 'state.db')
+    assert state.SQLiteStateStore(path).store_id == state.SQLiteStateStore(path).store_id
+    assert state.SQLiteStateStore(str(tmp_path / 'other.db')).store_id != state.SQLiteStateStore(path).store_id
+
+def test_adds_version_column_to_old_databases(tmp_path):
+    path = str(tmp_path / 'old.db')
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE downloads (filename TEXT PRIMARY KEY, status TEXT, url TEXT, updated_at REAL, record TEXT NOT NULL)")
+    conn.execute("INSERT INTO downloads VALUES ('a.bin', 'completed', 'http://example.com/a.bin', 0, '{\"status\": \"completed\"}')")
+    conn.commit()
+    conn.close()
+
+    store = state.SQLiteStateStore(path)
+    assert store.get_download('a.bin') == {'status': 'completed'}
+    store.save_download('b.bin', {'status': 'queued'})
+    store.flush()
+    _, records, _ = store.changes_since(0)
+    assert set(records) == {'b.bin'}
+
+@pytest.mark.parametrize('backend', ['memory', 'sqlite'])
+def test_file_hashes(backend, tmp_path):
+    store = state.create_state_store(backend, str(tmp_path / 'state.db'), 3600)
+    entry = {'hash': 'abc', 'size': 3, 'mtime': 1.5, 'crc32': 7}
+    store.save_file_hashes({'a.bin': entry, 'b.bin': dict(entry, crc32=None)})
+    assert store.get_file_hash('a.bin') == entry
+    assert sorted(name for name, _ in store.find_file_hashes('abc')) == ['a.bin', 'b.bin']
+
+    store.save_file_hashes({'a.bin': dict(entry, hash='other')}, replace=False)
+    assert store.get_file_hash('a.bin') == entry
+
+    store.rename_file_hash('a.bin', 'c.bin')
+    assert store.get_file_hash('a.bin') is None
+    assert store.get_file_hash('c.bin') == entry
+    store.delete_file_hash('c.bin')
+    assert [name for name, _ in store.find_file_hashes('abc')] == ['b.bin']
+
+@pytest.mark.parametrize('backend', ['memory', 'sqlite'])
+def test_folder_totals(backend, tmp_path):
+    store = state.create_state_store(backend, str(tmp_path / 'state.db'), 3600)
+    assert tuple(store.get_folder_totals()) == (0, 0)
+    store.set_folder_totals(100, 2)
+    store.adjust_folder_totals(50, 1)
+    store.adjust_folder_totals(-500, -1)
+    assert tuple(store.get_folder_totals()) == (0, 2)
+
+def test_folder_totals_are_shared(tmp_path):
+    # A worker process finishing a download updates what the web process reports
+    web = state.SQLiteStateStore(str(tmp_path / 'state.db'), 3600)
+    worker = state.SQLiteStateStore(str(tmp_path / 'state.db'), 3600)
+    web.set_folder_totals(10, 1)
+    worker.adjust_folder_totals(5, 1)
+    assert tuple(web.get_folder_totals()) == (15, 2)
+
+def test_enqueue_is_unique_per_filename(job_queue):
+    assert job_queue.enqueue('http://example.com/a', 'a.bin', 'a', 'example.com')
+    assert not job_queue.enqueue('http://example.com/other', 'a.bin', 'a', 'example.com')
+    assert job_queue.is_pending('a.bin')
+
+def test_held_job_waits_for_release(job_queue):
+    job_id = job_queue.enqueue('http://example.com/a', 'a.bin', 'a', 'example.com', held_by='submitter', hold_seconds=60)
+    assert job_queue.get_url('a.bin') == 'http://example.com/a'
+    assert job_queue.claim('w', 60, 10) is None
+    job_queue.release(job_id, 'other')
+    assert job_queue.claim('w', 60, 10) is None
+    job_queue.release(job_id, 'submitter')
+    assert job_queue.claim('w', 60, 10)['id'] == job_id
+
+def test_expired_hold_is_claimed(job_queue):
+    # A submitter that died between the claim and the release does not strand the job
+    job_id = job_queue.enqueue('http://example.com/a', 'a.bin', 'a', 'example.com', held_by='submitter', hold_seconds=0.01)
+    time.sleep(0.05)
+    assert job_queue.claim('w', 60, 10)['id'] == job_id
+
+def test_claim_takes_highest_priority_first(job_queue):
+    job_queue.enqueue('http://a.example/1', 'low.bin', 'low', 'a.example', priority=-1)
+    job_queue.enqueue('http://b.example/2', 'high.bin', 'high', 'b.example', priority=1)
+    job_queue.enqueue('http://c.example/3', 'normal.bin', 'normal', 'c.example')
+    claimed = [job_queue.claim('w', 60, 10)['save_filename'] for _ in range(3)]
+    assert claimed == ['high.bin', 'normal.bin', 'low.bin']
+    assert job_queue.claim('w', 60, 10) is None
+
+def test_leased_jobs_are_not_claimed_twice(job_queue):
+    job_queue.enqueue('http://example.com/a', 'a.bin', 'a', 'example.com')
+    job = job_queue.claim('w1', 60, 10)
+    # Attempts made before this claim
+    assert job['attempts'] == 0
+    assert job_queue.claim('w2', 60, 10) is None
+
+def test_expired_lease_is_claimed_again(job_queue):
+    job_queue.enqueue('http://example.com/a', 'a.bin', 'a', 'example.com')
+    job = job_queue.claim('w1', 0.01, 10)
+    time.sleep(0.05)
+    again = job_queue.claim('w2', 60, 10)
+    assert again['id'] == job['id'] and again['attempts'] == 1
+    # The first owner lost the lease, it can neither renew nor complete the job
+    assert not job_queue.heartbeat(job['id'], 'w1', 60)
+    job_queue.complete(job['id'], 'w1')
+    assert job_queue.is_pending('a.bin')
+    assert job_queue.heartbeat(job['id'], 'w2', 60)
+    job_queue.complete(job['id'], 'w2')
+    assert not job_queue.is_pending('a.bin')
+
+def test_claim_respects_per_host_limit(job_queue):
+    job_queue.enqueue('http://example.com/a', 'a.bin', 'a', 'example.com')
+    job_queue.enqueue('http://example.com/b', 'b.bin', 'b', 'example.com')
+    job_queue.enqueue('http://other.example/c', 'c.bin', 'c', 'other.example')
+    assert job_queue.claim('w', 60, 1)['save_filename'] == 'a.bin'
+    assert job_queue.claim('w', 60, 1)['save_filename'] == 'c.bin'
+    assert job_queue.claim('w', 60, 1) is None
+    stats = job_queue.stats()
+    assert stats['running'] == 2 and stats['queued'] == 1
+    assert stats['hosts']['example.com']['queued'] == 1
@@ -0,0 +1,110 @@
+import os
+import socket
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+os.environ.setdefault("DOWNLOAD_MODE", "queue")
+
+import app
+import metrics
+
+WORKER_THREADS = int(os.environ.get("WORKER_THREADS", app.MAX_CONCURRENT_DOWNLOADS))
+WORKER_METRICS_PORT = int(os.environ.get("WORKER_METRICS_PORT", 0))
+
+leases = {}
+leases_lock = threading.Lock()
+
+def keep_leases(job_queue):
+    # One thread renews every lease this process holds, however many jobs are running
+    while True:
+        time.sleep(app.JOB_HEARTBEAT_INTERVAL)
+        with leases_lock:
+            held = list(leases.items())
+        for job_id, owner in held:
+            try:
+                job_queue.heartbeat(job_id, owner, app.JOB_LEASE_SECONDS)
+            except sqlite3.OperationalError:
+                pass
+
+def start_job(job, owner):
+    with leases_lock:
+        leases[job['id']] = owner
+    # The process that queued the job wrote its record after this one last synced from the store
+    app.downloads_status.reload(job['save_filename'])
+    app.mark_starting(job['save_filename'])
+
+def finish_job(job_queue, job, owner):
+    with leases_lock:
+        leases.pop(job['id'], None)
+    app.state_store.flush()
+    job_queue.complete(job['id'], owner)
+
+def claim_job(job_queue, owner):
+    try:
+        return job_queue.claim(owner, app.JOB_LEASE_SECONDS, app.MAX_DOWNLOADS_PER_HOST)
+    except sqlite3.OperationalError:
+        return None
+
+def run_job(job_queue, job, owner):
+    start_job(job, owner)
+    try:
+        app.download_file_async(job['url'], job['save_filename'], job['original_name'])
+    finally:
+        finish_job(job_queue, job, owner)
+
+def work(job_queue, owner):
+    while True:
+        job = claim_job(job_queue, owner)
+        if job is None:
+            time.sleep(app.JOB_POLL_INTERVAL)
+            continue
+        run_job(job_queue, job, owner)
+
+def work_async(job_queue, owner, engine):
+    slots = threading.Semaphore(app.MAX_CONCURRENT_DOWNLOADS)
+    # Completion flushes the store, keep that off the event loop thread
+    finisher = ThreadPoolExecutor(1, thread_name_prefix='job-finisher')
+
+    def done(job):
+        finish_job(job_queue, job, owner)
+        slots.release()
+
+    while True:
+        slots.acquire()
+        job = claim_job(job_queue, owner)
+        if job is None:
+            slots.release()
+            time.sleep(app.JOB_POLL_INTERVAL)
+            continue
+        start_job(job, owner)
+        future = engine.submit(job['url'], job['save_filename'], job['original_name'])
+        future.add_done_callback(lambda _, job=job: finisher.submit(done, job))
+
+def main():
+    if app.DOWNLOAD_MODE != 'queue':
+        raise SystemExit("worker.py needs DOWNLOAD_MODE=queue")
+    job_queue = app.scheduler.job_queue
+    app.verify_state_store()
+    app.resume_pending_downloads()
+    app.start_evictor()
+    if WORKER_METRICS_PORT:
+        metrics.start_metrics_server(WORKER_METRICS_PORT)
+    threading.Thread(target=keep_leases, args=(job_queue,), daemon=True).start()
+
+    worker_id = f"{socket.gethostname()}:{os.getpid()}"
+    if app.download_engine:
+        threads = [threading.Thread(target=work_async, args=(job_queue, worker_id, app.download_engine), daemon=True)]
+    else:
+        threads = [
+            threading.Thread(target=work, args=(job_queue, f"{worker_id}:{i}"), daemon=True)
+            for i in range(WORKER_THREADS)
+        ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+if __name__ == "__main__":
+    main()